@@ -0,0 +1,591 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+备份脚本（bak_to_aliyun.py / bak_to_aliyun2.py / db_to_oss.py）的打包、压缩、加密和上传性能测试。
+
+生成几类固定的测试数据（大量小文件、少量大文件、可压缩的 sql 文本、不可压缩的随机数据），对每类数据跑各个
+打包/压缩/加密选项和上传到本地模拟的 oss 服务，统计吞吐率、峰值内存（RSS）和临时磁盘占用，并可以保存为基线，
+之后的结果和基线对比，吞吐率下降超过阈值时返回非 0。
+
+每个测试用例在单独的子进程中执行（峰值内存互不影响），被测脚本用它自己的 python 版本运行：
+    python2 bak_benchmark.py --script bak_to_aliyun.py --save-baseline baseline_py2.json
+    python2 bak_benchmark.py --script bak_to_aliyun.py --compare baseline_py2.json
+    python3 bak_benchmark.py --script db_to_oss.py --datasets sql_text --cases tar,upload
+"""
+from __future__ import division, print_function
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+CURR_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 测试数据的大小（scale 为 1 时），通过 --scale 按比例缩放
+__datasets__ = {
+    # 大量小文件：文件数和每个文件的大小范围
+    'small_files': {'count': 10000, 'min_size': 512, 'max_size': 8 * 1024},
+    # 少量大文件：一半可压缩文本、一半随机数据交替写入
+    'huge_files': {'count': 2, 'size': 128 * 1024 * 1024},
+    # mysqldump 风格的 INSERT 语句，压缩比高
+    'sql_text': {'size': 128 * 1024 * 1024},
+    # 随机数据，不可压缩
+    'random_blob': {'size': 128 * 1024 * 1024},
+}
+DATASET_SEED = 20190101
+RESULT_PREFIX = 'BENCH_RESULT '
+WORDS = ['backup', 'mysql', 'oss', 'aliyun', 'archive', 'table', 'index', 'value', 'status', 'user', 'order',
+         'create', 'update', 'delete', 'insert', 'select', 'where', 'null', 'default', 'primary', 'key', 'text']
+
+
+def find_command(name):
+    try:
+        return shutil.which(name)
+    except AttributeError:
+        from distutils.spawn import find_executable
+        return find_executable(name)
+
+
+def get_path_size(file_path_list):
+    """
+    统计文件和目录的总大小（不跟随软链接）
+    :param file_path_list: 文件路径名所组成的数组
+    :return: 字节数
+    """
+    total_size = 0
+    for file_path in file_path_list:
+        if not os.path.exists(file_path):
+            continue
+        if os.path.islink(file_path) or not os.path.isdir(file_path):
+            total_size += os.lstat(file_path).st_size
+            continue
+        for root, dirs, files in os.walk(file_path):
+            for name in files:
+                try:
+                    total_size += os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+    return total_size
+
+
+def random_text(rng, size):
+    """
+    生成可压缩的文本数据
+    :param rng: random.Random
+    :param size: 大概的字节数
+    :return: bytes
+    """
+    lines = []
+    total = 0
+    while total < size:
+        line = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 16))) + ' {}\n'.format(rng.randint(0, 10 ** 9))
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines).encode('utf-8')
+
+
+def sql_rows(rng, size):
+    """
+    生成 mysqldump 风格的 INSERT 语句
+    :param rng: random.Random
+    :param size: 大概的字节数
+    :return: bytes
+    """
+    rows = []
+    total = 0
+    row_id = 0
+    while total < size:
+        values = []
+        for _ in range(100):
+            row_id += 1
+            values.append("({},'{}','{}@example.com',{},'2019-{:02d}-{:02d} {:02d}:{:02d}:00',{:.2f})".format(
+                row_id, rng.choice(WORDS) + str(rng.randint(0, 99999)), rng.choice(WORDS), rng.randint(0, 3),
+                rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59), rng.random() * 10000))
+        row = "INSERT INTO `orders` VALUES {};\n".format(','.join(values))
+        rows.append(row)
+        total += len(row)
+    return ''.join(rows).encode('utf-8')
+
+
+def write_chunks(file_path, size, make_chunk, chunk_size=4 * 1024 * 1024):
+    with open(file_path, 'wb') as f:
+        written = 0
+        while written < size:
+            chunk = make_chunk(min(chunk_size, size - written))
+            f.write(chunk)
+            written += len(chunk)
+
+
+def generate_dataset(name, dataset_dir, scale):
+    """
+    生成测试数据（已经生成过并且参数相同时直接使用）
+    :param name: __datasets__ 中的数据名
+    :param dataset_dir: 数据目录
+    :param scale: 大小缩放比例
+    :return: 数据的路径数组
+    """
+    config = __datasets__[name]
+    marker = os.path.join(dataset_dir, '.done')
+    params = json.dumps({'name': name, 'config': config, 'scale': scale, 'seed': DATASET_SEED}, sort_keys=True)
+    data_path = os.path.join(dataset_dir, name)
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if f.read() == params:
+                return [data_path]
+    if os.path.exists(dataset_dir):
+        shutil.rmtree(dataset_dir)
+    os.makedirs(data_path)
+
+    rng = random.Random(DATASET_SEED)
+    start_time = time.time()
+    if name == 'small_files':
+        for i in range(max(1, int(config['count'] * scale))):
+            sub_dir = os.path.join(data_path, '{:03d}'.format(i // 500))
+            if not os.path.exists(sub_dir):
+                os.makedirs(sub_dir)
+            with open(os.path.join(sub_dir, 'file_{:05d}.txt'.format(i)), 'wb') as f:
+                f.write(random_text(rng, rng.randint(config['min_size'], config['max_size'])))
+    elif name == 'huge_files':
+        size = int(config['size'] * scale)
+        for i in range(config['count']):
+            state = {'compressible': True}
+
+            def make_chunk(n):
+                state['compressible'] = not state['compressible']
+                return random_text(rng, n)[:n] if state['compressible'] else os.urandom(n)
+
+            write_chunks(os.path.join(data_path, 'huge_{}.bin'.format(i)), size, make_chunk)
+    elif name == 'sql_text':
+        write_chunks(os.path.join(data_path, 'dump.sql'), int(config['size'] * scale),
+                     lambda n: sql_rows(rng, n))
+    elif name == 'random_blob':
+        write_chunks(os.path.join(data_path, 'blob.bin'), int(config['size'] * scale), os.urandom)
+    with open(marker, 'w') as f:
+        f.write(params)
+    print("generate dataset [{}], size: {:.1f} MB, use seconds: {:.2f}s".format(
+        name, get_path_size([data_path]) / 1024 / 1024, time.time() - start_time))
+    return [data_path]
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端关闭长连接时的 connection reset 不影响测试结果
+        pass
+
+
+class FakeOssHandler(BaseHTTPRequestHandler):
+    """
+    模拟 oss 的对象上传接口（put_object、分片上传、列出已上传的分片），上传的数据只计数不保存。
+    endpoint 为 ip 地址时 oss2 使用 path-style 的地址：/{bucket}/{key}
+    """
+    protocol_version = 'HTTP/1.1'
+    lock = threading.Lock()
+    received_bytes = 0
+    requests = 0
+    upload_id = 0
+    # {upload_id: {part_number: (etag, size)}}
+    uploads = {}
+
+    def read_body(self):
+        md5 = hashlib.md5()
+        size = 0
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                chunk_size = int(self.rfile.readline().strip().split(b';')[0], 16)
+                if chunk_size == 0:
+                    self.rfile.readline()
+                    break
+                data = self.rfile.read(chunk_size)
+                md5.update(data)
+                size += len(data)
+                self.rfile.readline()
+        else:
+            remain = int(self.headers.get('Content-Length', 0))
+            while remain > 0:
+                data = self.rfile.read(min(remain, 1024 * 1024))
+                if not data:
+                    break
+                md5.update(data)
+                size += len(data)
+                remain -= len(data)
+        with FakeOssHandler.lock:
+            FakeOssHandler.received_bytes += size
+            FakeOssHandler.requests += 1
+        return size, md5.hexdigest()
+
+    def reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        self.send_header('x-oss-request-id', 'bench')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def do_PUT(self):
+        query = parse_qs(urlparse(self.path).query, keep_blank_values=True)
+        size, etag = self.read_body()
+        etag = etag.upper()
+        if 'uploadId' in query:
+            with FakeOssHandler.lock:
+                parts = FakeOssHandler.uploads.setdefault(query['uploadId'][0], {})
+                parts[int(query['partNumber'][0])] = (etag, size)
+        self.reply(200, headers={'ETag': '"{}"'.format(etag)})
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query, keep_blank_values=True)
+        if 'uploadId' not in query:
+            body = b'<?xml version="1.0" encoding="UTF-8"?><Error><Code>NoSuchKey</Code></Error>'
+            self.reply(404, body, {'Content-Type': 'application/xml'})
+            return
+        with FakeOssHandler.lock:
+            parts = sorted(FakeOssHandler.uploads.get(query['uploadId'][0], {}).items())
+        body = ''.join('<Part><PartNumber>{}</PartNumber><LastModified>2019-01-01T00:00:00.000Z</LastModified>'
+                       '<ETag>"{}"</ETag><Size>{}</Size></Part>'.format(number, etag, size)
+                       for number, (etag, size) in parts)
+        body = ('<?xml version="1.0" encoding="UTF-8"?><ListPartsResult><Bucket>bench</Bucket><Key>key</Key>'
+                '<UploadId>{}</UploadId><PartNumberMarker>0</PartNumberMarker><NextPartNumberMarker>{}'
+                '</NextPartNumberMarker><MaxParts>1000</MaxParts><IsTruncated>false</IsTruncated>{}'
+                '</ListPartsResult>').format(query['uploadId'][0], parts[-1][0] if parts else 0, body)
+        self.reply(200, body.encode('utf-8'), {'Content-Type': 'application/xml'})
+
+    def do_POST(self):
+        query = parse_qs(urlparse(self.path).query, keep_blank_values=True)
+        self.read_body()
+        if 'uploads' in query:
+            with FakeOssHandler.lock:
+                FakeOssHandler.upload_id += 1
+                upload_id = 'bench{}'.format(FakeOssHandler.upload_id)
+            body = ('<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult>'
+                    '<Bucket>bench</Bucket><Key>key</Key><UploadId>{}</UploadId>'
+                    '</InitiateMultipartUploadResult>').format(upload_id).encode('utf-8')
+            self.reply(200, body, {'Content-Type': 'application/xml'})
+        else:
+            body = ('<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult>'
+                    '<Bucket>bench</Bucket><Key>key</Key><ETag>"BENCH"</ETag>'
+                    '</CompleteMultipartUploadResult>').encode('utf-8')
+            self.reply(200, body, {'Content-Type': 'application/xml', 'ETag': '"BENCH"'})
+
+    def do_DELETE(self):
+        self.reply(204)
+
+    def do_HEAD(self):
+        self.reply(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_oss():
+    """
+    在后台线程中启动模拟的 oss 服务
+    :return: endpoint
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeOssHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def load_script(script, work_dir):
+    """
+    加载被测的备份脚本，并把日志、指标、邮件等副作用改到测试目录
+    :param script: 脚本路径
+    :param work_dir: 测试目录
+    :return: module
+    """
+    script = os.path.abspath(script)
+    module_name = os.path.splitext(os.path.basename(script))[0].replace('-', '_')
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(module_name, script)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except ImportError:
+        import imp
+        module = imp.load_source(module_name, script)
+
+    module.CURR_DIR = work_dir
+    module.send_email = lambda *args, **kw: None
+    if hasattr(module, '__log_file__'):
+        module.__log_file__ = os.path.join(work_dir, 'bench.log')
+    metrics_config = getattr(module, '__metrics__', None) or getattr(module, '_config_', {}).get('metrics')
+    if metrics_config is not None:
+        metrics_config['json_file'] = os.path.join(work_dir, 'bench_metrics.jsonl')
+        metrics_config['prom_file'] = ''
+    return module
+
+
+def get_oss_config(module):
+    return getattr(module, '__aliyun__', None) or getattr(module, '_config_', {}).get('oss')
+
+
+def get_cases(module):
+    """
+    被测脚本支持的测试用例
+    :param module:
+    :return: [用例名]
+    """
+    cases = []
+    compress_list = sorted(getattr(module, 'COMPRESS_EXTENSIONS', {'gzip': '.tar.gz'}).keys())
+    for compress in compress_list:
+        if compress in ('zstd', 'lz4') and not find_command(compress):
+            continue
+        cases.append('tar:{}'.format(compress))
+    if find_command('7z'):
+        cases.append('zip')
+    if hasattr(module, 'single_pass_archive'):
+        for compress in compress_list:
+            if compress in ('zstd', 'lz4') and not find_command(compress):
+                continue
+            cases.append('single_pass:aes:{}'.format(compress))
+        if find_command('7z'):
+            cases.append('single_pass:7z:gzip')
+        cases.append('single_pass_upload:aes:gzip')
+    cases.append('upload')
+    return cases
+
+
+class ScratchSampler(threading.Thread):
+    """
+    定时统计临时目录的大小，记录峰值
+    """
+
+    def __init__(self, scratch_dir, interval=0.05):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.scratch_dir = scratch_dir
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, get_path_size([self.scratch_dir]))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, get_path_size([self.scratch_dir]))
+
+
+def run_case(args):
+    """
+    子进程中执行一个测试用例，结果以 RESULT_PREFIX 开头的一行 JSON 输出到标准输出
+    :param args:
+    :return:
+    """
+    work_dir = os.path.abspath(args.work_dir)
+    module = load_script(args.script, work_dir)
+    oss_config = get_oss_config(module)
+    if oss_config is not None:
+        oss_config.update({'oss_endpoint': args.oss_endpoint, 'oss_bucket': 'bench', 'access_key': 'bench',
+                           'access_secret': 'bench', 'multipart_threshold': args.multipart_threshold})
+    paths = generate_dataset(args.dataset, os.path.join(work_dir, 'datasets', args.dataset), args.scale)
+    scratch_dir = os.path.join(work_dir, 'scratch')
+    setup_dir = os.path.join(work_dir, 'setup')
+    for path in (scratch_dir, setup_dir, os.path.join(work_dir, 'oss_checkpoint')):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+    os.makedirs(scratch_dir)
+    os.makedirs(setup_dir)
+    password = getattr(module, '__archive_password__', None) or 'bench'
+    parts = args.run_case.split(':')
+
+    upload_file = None
+    if parts[0] == 'upload':
+        # 上传用例的数据先打成不压缩的 tar 包，不计入耗时和临时空间
+        upload_file = os.path.join(setup_dir, '{}.tar'.format(args.dataset))
+        with tarfile.open(upload_file, 'w') as tar:
+            for path in paths:
+                tar.add(path, arcname=os.path.basename(path))
+
+    bytes_in = get_path_size([upload_file] if upload_file else paths)
+    sampler = ScratchSampler(scratch_dir)
+    sampler.start()
+    start_time = time.time()
+    start_cpu = os.times()
+    if parts[0] == 'tar':
+        compress = parts[1]
+        if hasattr(module, 'get_tar_extension'):
+            name = os.path.join(scratch_dir, 'bench' + module.get_tar_extension(compress))
+            module.tar_gz_file(name, paths, compress)
+        else:
+            name = os.path.join(scratch_dir, 'bench.tar.gz')
+            module.tar_gz_file(name, paths)
+    elif parts[0] == 'zip':
+        name = os.path.join(scratch_dir, 'bench.zip')
+        module.zip_file(name, paths, password=password)
+    elif parts[0] in ('single_pass', 'single_pass_upload'):
+        encrypt, compress = parts[1], parts[2]
+        module.__backup__ = {'bench': paths}
+        module.__single_pass__.update({'enabled': True, 'encrypt': encrypt, 'compress': compress})
+        name = os.path.join(scratch_dir, 'bench' + module.get_single_pass_extension())
+        module.single_pass_archive(name, None, upload=parts[0] == 'single_pass_upload')
+    elif parts[0] == 'upload':
+        name = upload_file
+        module.upload_to_aliyun_oss(upload_file)
+    else:
+        raise Exception('unknown case: {}'.format(args.run_case))
+    wall_seconds = time.time() - start_time
+    end_cpu = os.times()
+    sampler.stop()
+
+    bytes_out = get_path_size([name]) if os.path.exists(name) and parts[0] != 'upload' else None
+    result = {
+        'case': args.run_case,
+        'dataset': args.dataset,
+        'bytes_in': bytes_in,
+        'bytes_out': bytes_out,
+        'ratio': round(bytes_in / bytes_out, 3) if bytes_out else None,
+        'wall_seconds': round(wall_seconds, 3),
+        'cpu_seconds': round(sum(end_cpu[:4]) - sum(start_cpu[:4]), 3),
+        'throughput_mb_s': round(bytes_in / 1024 / 1024 / wall_seconds, 2) if wall_seconds > 0 else None,
+        # linux 上 ru_maxrss 的单位为 KB
+        'rss_peak_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'child_rss_peak_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        'scratch_peak_mb': round(sampler.peak / 1024 / 1024, 1),
+    }
+    shutil.rmtree(scratch_dir)
+    shutil.rmtree(setup_dir)
+    print(RESULT_PREFIX + json.dumps(result))
+
+
+def run_benchmark(args):
+    """
+    生成测试数据，每个数据和用例的组合在子进程中执行，汇总结果
+    :param args:
+    :return: ({数据名/用例名: 结果}, 执行失败的 [数据名/用例名])
+    """
+    work_dir = os.path.abspath(args.work_dir)
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    module = load_script(args.script, work_dir)
+    cases = get_cases(module)
+    if args.cases:
+        cases = [case for case in cases if any(case == name or case.startswith(name + ':')
+                                               for name in args.cases.split(','))]
+    datasets = args.datasets.split(',') if args.datasets else sorted(__datasets__.keys())
+    oss_endpoint = args.oss_endpoint or start_fake_oss()
+
+    results = {}
+    failures = []
+    for dataset in datasets:
+        generate_dataset(dataset, os.path.join(work_dir, 'datasets', dataset), args.scale)
+        for case in cases:
+            command = [sys.executable, os.path.abspath(__file__), '--script', args.script, '--work-dir', work_dir,
+                       '--scale', str(args.scale), '--oss-endpoint', oss_endpoint,
+                       '--multipart-threshold', str(args.multipart_threshold),
+                       '--run-case', case, '--dataset', dataset]
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            out, err = process.communicate()
+            out = out.decode('utf-8', 'replace')
+            result = None
+            for line in out.splitlines():
+                if line.startswith(RESULT_PREFIX):
+                    result = json.loads(line[len(RESULT_PREFIX):])
+            key = '{}/{}'.format(dataset, case)
+            if process.returncode != 0 or not result:
+                print("{:<44} FAIL\n{}".format(key, out[-2000:]))
+                failures.append(key)
+                continue
+            results[key] = result
+            print("{:<44} {:>9.2f} MB/s  wall {:>8.2f}s  cpu {:>8.2f}s  ratio {:>6}  rss {:>7.1f} MB  "
+                  "child rss {:>7.1f} MB  scratch {:>8.1f} MB".format(
+                      key, result['throughput_mb_s'] or 0, result['wall_seconds'], result['cpu_seconds'],
+                      result['ratio'] or '-', result['rss_peak_mb'], result['child_rss_peak_mb'],
+                      result['scratch_peak_mb']))
+    return results, failures
+
+
+def compare_baseline(results, failures, baseline_file, tolerance):
+    """
+    和基线对比：吞吐率下降、峰值内存或临时空间增长超过 tolerance 的用例记为退化，执行失败的用例也记为退化
+    :param results: run_benchmark 的结果
+    :param failures: run_benchmark 中执行失败的用例
+    :param baseline_file: 基线文件
+    :param tolerance: 允许的波动比例
+    :return: 退化的用例数
+    """
+    with open(baseline_file) as f:
+        baseline = json.load(f).get('results', {})
+    regressions = len(failures)
+    print("\ncompare with baseline [{}], tolerance: {:.0%}".format(baseline_file, tolerance))
+    for key in sorted(failures):
+        print("{:<44} FAILED{}".format(key, "" if key in baseline else " (no baseline)"))
+    for key in sorted(set(baseline.keys()) - set(results.keys()) - set(failures)):
+        # 本次没有选中的数据和用例（--datasets、--cases）
+        print("{:<44} (not run)".format(key))
+    for key in sorted(results.keys()):
+        if key not in baseline:
+            print("{:<44} (no baseline)".format(key))
+            continue
+        old, new = baseline[key], results[key]
+        items = []
+        regressed = False
+        for name, higher_is_better in (('throughput_mb_s', True), ('rss_peak_mb', False), ('scratch_peak_mb', False)):
+            if not old.get(name) or new.get(name) is None:
+                continue
+            change = (new[name] - old[name]) / old[name]
+            items.append("{} {:+.1%}".format(name, change))
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressed = True
+        regressions += 1 if regressed else 0
+        print("{:<44} {}  {}".format(key, "REGRESSED" if regressed else "ok       ", ", ".join(items)))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark archive, compression, encryption and upload of backup scripts")
+    parser.add_argument("--script", default=os.path.join(CURR_DIR, "bak_to_aliyun.py"), help="backup script to benchmark")
+    parser.add_argument("--work-dir", default=os.path.join(CURR_DIR, "bench_dir"), help="datasets and scratch directory")
+    parser.add_argument("--scale", type=float, default=1.0, help="dataset size scale")
+    parser.add_argument("--datasets", help="comma separated datasets, default all: {}".format(",".join(sorted(__datasets__))))
+    parser.add_argument("--cases", help="comma separated cases or case prefixes, e.g. tar,upload,single_pass:aes")
+    parser.add_argument("--oss-endpoint", help="oss compatible endpoint to upload to, default a local fake server")
+    parser.add_argument("--multipart-threshold", type=int, default=100 * 1024 * 1024, help="multipart upload threshold")
+    parser.add_argument("--save-baseline", metavar="FILE", help="save results as baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare results with baseline, exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed change ratio when comparing")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    parser.add_argument("--dataset", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        run_case(args)
+        sys.exit(0)
+
+    results, failures = run_benchmark(args)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'host': platform.node(),
+                       'python': platform.python_version(), 'script': os.path.basename(args.script),
+                       'scale': args.scale, 'results': results}, f, indent=2, sort_keys=True)
+        print("baseline saved to {}".format(args.save_baseline))
+    if args.compare and compare_baseline(results, failures, args.compare, args.tolerance):
+        sys.exit(1)
+    if failures:
+        sys.exit(1)
@@ -1,19 +1,52 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import Queue
+import atexit
+import cProfile
+import errno
+import fnmatch
+import grp
+import gzip
+import hashlib
+import hmac
+import io
+import json
 import math
+import multiprocessing
 import os
+import pickle
+import pwd
+import re
 import smtplib
+import socket
+import sqlite3
+import stat
+import struct
 import subprocess
+import sys
+import threading
 import time
 import traceback
+import zlib
 from email.mime.text import MIMEText
-from tarfile import TarFile
+from multiprocessing.pool import ThreadPool
+from tarfile import BLKTYPE, BLOCKSIZE, CHRTYPE, DIRTYPE, FIFOTYPE, LNKTYPE, REGTYPE, SYMTYPE, TarFile, TarInfo
 
 import oss2
 import shutil
+from Crypto.Cipher import AES
 from oas.ease.vault import Vault
 from oas.oas_api import OASAPI
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # python2 需要安装 scandir 模块（pip install scandir），没有安装时用 os.listdir + os.lstat 遍历目录
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 CURR_DIR = os.path.dirname(os.path.abspath(__file__))
 # 日志文件
 __log_file__ = os.path.join(CURR_DIR, '<hidden>.log')
@@ -24,15 +57,203 @@ __aliyun__ = {
     'access_secret': '<hidden>',
     'oss_endpoint': 'http://oss-cn-beijing.aliyuncs.com',
     'oss_bucket': '<hidden>',
+    # 文件大于该值时采用分片并发上传，否则直接 put_object
+    'multipart_threshold': 100 * 1024 * 1024,
+    'part_size': 10 * 1024 * 1024,
+    'num_threads': 4,
+    # 分片上传中断后的重试次数，重试时从本地断点记录处继续上传
+    'upload_retry': 3,
+    # 边生成边上传时等待上传的分片数，限制内存占用
+    'upload_queue_size': 4,
     'oas_server': 'cn-hangzhou.oas.aliyuncs.com',
     'oas_vault': '<hidden>'
 }
 
+# 每一项可以是文件路径数组，也可以是字典，单独指定压缩方式和压缩级别，比如：
+# 'database': {'paths': ['/var/lib/mysql/', '/etc/mysql/my.cnf'], 'compress': 'zstd', 'level': 3}
+# 字典中还可以指定遍历目录时的包含/排除规则（fnmatch 通配符，匹配完整路径或者文件名），排除的目录不会被遍历，
+# 指定 include 时只打包匹配的文件，比如：
+# 'web': {'paths': ['/var/www/'], 'exclude': ['*/cache', '*/logs', '*.log'], 'include': ['*.php', '*.html']}
 __backup__ = {
     'web': ['/var/www/', '/etc/apache2/'],
     'database': ['/var/lib/mysql/', '/etc/mysql/my.cnf']
 }
 
+# 压缩配置
+__compress__ = {
+    # 默认压缩方式：gzip（单线程）、pgzip（多进程并行 gzip）、zstd（多线程）、lz4（速度优先）
+    'default': 'gzip',
+    # 并行压缩的进程/线程数，为空时使用 cpu 核数
+    'processes': None,
+    # pgzip 每个独立压缩块的大小
+    'block_size': 4 * 1024 * 1024
+}
+# 各压缩方式对应的 tar 包后缀
+COMPRESS_EXTENSIONS = {
+    'gzip': '.tar.gz',
+    'pgzip': '.tar.gz',
+    'zstd': '.tar.zst',
+    'lz4': '.tar.lz4'
+}
+
+# 遍历备份目录：多线程并行遍历目录树，小文件按批并发读取后再写入 tar 包
+__scan__ = {
+    # 并行遍历目录、读取小文件的线程数
+    'threads': 8,
+    # 不超过该大小的文件按批并发读取到内存中
+    'small_file_size': 64 * 1024,
+    # 每批并发读取的文件数
+    'batch_size': 256
+}
+# 文件系统快照：打包前在很短的暂停时间内给备份目录所在的文件系统做快照，之后从快照中慢慢打包，打包完成后删除快照。
+# 服务暂停的时间只是做快照的时间，不随数据量增长
+__fs_snapshot__ = {
+    # 也可以在 __backup__ 的字典项中用 'snapshot': True/False 单独指定
+    'enabled': False,
+    # auto：依次尝试 btrfs 只读快照、LVM 快照、reflink 暂存目录；也可以指定其中一种，或者 hardlink
+    # （hardlink 暂存目录不是写时复制的，只适合文件总是整体替换而不是原地修改的目录）
+    'method': 'auto',
+    # 做快照前后执行的命令（shell），比如暂停服务的写入、fsfreeze 等，快照失败时也会执行 post_command
+    'pre_command': '',
+    'post_command': '',
+    # LVM 快照的写时复制空间大小，打包期间原卷的修改量不能超过该大小
+    'lvm_size': '5G',
+    # LVM 快照的挂载目录
+    'mount_dir': os.path.join(CURR_DIR, 'snapshot_mnt'),
+    # 快照失败时直接打包源目录，为 False 时备份失败
+    'fallback': True
+}
+# btrfs 子卷根目录的 inode 号
+BTRFS_SUBVOL_INODE = 256
+# 备份路径到快照中对应路径的映射，见 get_source_path
+_snapshot_paths_ = {}
+# reflink 复制的快照中文件的 inode 号每次都不同，这些备份路径生成文件清单时不比较 inode，见 is_copy_snapshot_path
+_copy_snapshot_paths_ = set()
+# 文件属主的用户名和组名缓存
+_user_names_ = {}
+_group_names_ = {}
+
+# 增量备份：只打包相对上一次备份新增或者修改的文件，定期做一次全量备份作为备份链的起点。
+# 开启后备份文件名从 <hidden>_bak_<时间>.zip 变为 <hidden>_bak_<时间>_full|incr.zip，单个增量备份文件不再包含全部数据，
+# 恢复时需要按备份链从全量备份开始依次恢复（依赖本地的文件清单 manifest_file），默认关闭以保持原有的备份方式
+__incremental__ = {
+    'enabled': False,
+    # 距离上一次全量备份超过该天数时做全量备份
+    'full_interval_days': 7,
+    # 本地的文件清单，记录每个文件的 size、mtime、inode 和 hash
+    'manifest_file': os.path.join(CURR_DIR, 'backup_manifest.json')
+}
+# 增量备份压缩包中记录已删除文件列表的文件名
+DELETED_FILE_LIST = '.deleted'
+# 文件清单、已删除文件列表中的路径是原始字节（文件名不一定是 utf-8），写入 json 时按 latin-1 一一对应成字符
+PATH_ENCODING = 'latin-1'
+# 备份文件名中的备份时间和备份类型
+BAK_FILE_PATTERN = re.compile(r'_bak_(\d{12})_(full|incr)\.(?:zip|tar\.\w+\.(?:enc|7z))$')
+
+# 单次打包：所有备份项打包成一个 tar 流，边打包边压缩、加密，直接写成最终的备份文件，不生成中间的 .tar.gz 文件
+__single_pass__ = {
+    'enabled': False,
+    # 压缩方式和压缩级别，见 COMPRESS_EXTENSIONS（单次打包时 __backup__ 各项单独指定的压缩方式不生效）
+    'compress': 'zstd',
+    'level': 3,
+    # aes：程序内 AES-GCM 分帧加密（带认证）；7z：通过管道交给 7z -si 加密
+    'encrypt': 'aes',
+    # 边打包边上传：加密后的数据按分片直接上传到oss，不写本地文件（只支持 aes 加密）
+    'stream_upload': False
+}
+# 程序内加密文件的文件头和每帧明文大小
+AES_MAGIC = b'BKAES01\n'
+AES_FRAME_SIZE = 1024 * 1024
+# 流式处理时每次读取的数据块大小
+STREAM_CHUNK_SIZE = 1024 * 1024
+# oss 分片上传的最大分片数；边打包边上传时总大小未知，每上传 OSS_PART_GROW_STEP 个分片后分片大小翻倍
+OSS_MAX_PARTS = 10000
+OSS_PART_GROW_STEP = 2000
+
+# 备份目录：单次打包（aes 加密）时在本地 SQLite 数据库中记录每次备份的每个文件在备份文件中的位置，加密后同步到oss。
+# 开启后单次打包固定使用分块的 gzip 压缩（每块独立压缩成一个 gzip member 并单独成帧加密），__single_pass__ 中的压缩方式不生效，
+# 恢复单个文件或目录（restore --path）时只按范围下载覆盖它的几个块，不需要下载整个备份文件
+__catalog__ = {
+    'enabled': False,
+    'db_file': os.path.join(CURR_DIR, 'backup_catalog.db'),
+    'oss_key': 'catalog/backup_catalog.db.enc',
+    # 每个独立压缩块的大小（压缩前），越小恢复单个文件时多下载的数据越少，但压缩率越低
+    'block_size': 4 * 1024 * 1024,
+    # 备份目录中保留的天数，0 为一直保留。应和oss上备份文件的生命周期规则一致，否则备份目录会一直增长（每次备份都要整个重新上传），
+    # 或者记录着已经被删除的备份文件。清理时保留最后一个早于保留期的全量备份，保证保留期内的备份链完整
+    'keep_days': 30
+}
+CATALOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    bak_time TEXT PRIMARY KEY, bak_type TEXT NOT NULL, oss_key TEXT NOT NULL, file_size INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS blocks (
+    bak_time TEXT NOT NULL, plain_offset INTEGER NOT NULL, plain_size INTEGER NOT NULL,
+    frame_index INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL,
+    PRIMARY KEY (bak_time, plain_offset));
+CREATE TABLE IF NOT EXISTS files (
+    bak_time TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL, hash TEXT NOT NULL,
+    offset INTEGER NOT NULL, mode INTEGER NOT NULL, mtime INTEGER NOT NULL,
+    PRIMARY KEY (bak_time, path));
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+'''
+
+# 去重备份：备份数据按内容分块后上传到oss，已经存在的块不再重复上传，每次备份只上传一个很小的快照索引。
+# 注意：oss 上 prefix 下的块会被多次备份共用，块的上传时间不代表它是否还在使用，生命周期规则必须排除 prefix，
+# 过期清理由 prune_dedup_store 完成（每次去重备份后删除超过 keep_days 的快照索引和不再被引用的块）
+__dedup__ = {
+    'enabled': False,
+    'prefix': 'dedup',
+    # 快照索引保留的天数，0 为一直保留（不清理）
+    'keep_days': 30,
+    'min_chunk_size': 512 * 1024,
+    'max_chunk_size': 4 * 1024 * 1024,
+    # 分块边界的判断条件（gear hash 的高 mask_bits 位为 0），平均块大小约为 min_chunk_size + 2^mask_bits
+    'mask_bits': 16,
+    'num_threads': 4
+}
+# 临时空间：备份前根据备份数据大小和磁盘剩余空间预估需要的临时空间，选择落盘打包还是流式打包，并限制临时空间的占用
+__scratch__ = {
+    # 落盘打包（各备份项的压缩包 + zip）放不下时自动改用单次打包，单次打包的本地文件也放不下时改用边打包边上传
+    'auto_stream': True,
+    # 临时空间上限（字节），0 为不限制（只受磁盘剩余空间限制）
+    'budget': 0,
+    # 磁盘上至少保留的剩余空间
+    'reserve': 1024 * 1024 * 1024,
+    # 预估的压缩率（压缩后/压缩前），按偏大取值
+    'compress_ratio': 0.7
+}
+# 预检时依次尝试的打包方式，越往后占用的临时空间越少
+BACKUP_MODES = ['staged', 'single_pass', 'stream_upload']
+# 待上传的备份文件：上传前移到该目录，上传失败时连同上传记录（.pending）和断点文件一起保留，下一次运行时先断点续传完成再做新的备份
+PENDING_UPLOAD_DIR = os.path.join(CURR_DIR, 'pending_upload')
+PENDING_RECORD_SUFFIX = '.pending'
+
+# 内容分块的 gear hash：32 位 hash 每个字节左移一位，只取决于最近 CDC_WINDOW 个字节。
+# gear 表由固定的算法生成，每次运行（python2/3）都相同，否则分块边界变化后无法去重
+CDC_WINDOW = 32
+CDC_GEAR = [struct.unpack('>I', hashlib.md5(struct.pack('>I', i)).digest()[:4])[0] for i in range(256)]
+_archive_keys_ = {}
+
+# 备份阶段的指标和性能分析
+__metrics__ = {
+    # 每个备份阶段（导出、打包、加密压缩、上传）一行 JSON 记录，为空时不记录
+    'json_file': os.path.join(CURR_DIR, 'backup_metrics.jsonl'),
+    # node_exporter textfile collector 目录下的 .prom 文件，为空时不输出，比如 /var/lib/node_exporter/textfile_collector/backup.prom
+    'prom_file': '',
+    # cProfile 结果文件，为空时不开启
+    'profile_file': '',
+    # 采样式 profiler 的采样间隔（秒），0 为不开启
+    'sample_interval': 0,
+    'sample_file': os.path.join(CURR_DIR, 'backup_stacks.folded'),
+}
+_stage_records_ = []
+_stage_lock_ = threading.Lock()
+
+# 共用的 oss2.Bucket 和 smtp 连接，见 get_oss_bucket、get_smtp_server
+_oss_bucket_ = None
+_smtp_server_ = None
+_client_lock_ = threading.Lock()
+
 # 备份文件加密密码
 __archive_password__ = "<hidden>"
 
@@ -104,12 +325,476 @@ def log_exception(func):
     return wrapper
 
 
+def get_path_size(file_path_list):
+    """
+    统计文件和目录的总大小（不跟随软链接）
+    :param file_path_list: 文件路径名所组成的数组
+    :return: 字节数
+    """
+    total_size = 0
+    for file_path in file_path_list:
+        if os.path.islink(file_path) or not os.path.isdir(file_path):
+            total_size += os.lstat(file_path).st_size
+            continue
+        for root, dirs, files in os.walk(file_path):
+            for name in files:
+                try:
+                    total_size += os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+    return total_size
+
+
+def cpu_seconds():
+    """
+    当前进程以及已经结束的子进程（mysqldump、7z 等）的 CPU 时间（用户态 + 内核态）
+    :return:
+    """
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+class StageTimer(object):
+    """
+    记录一个备份阶段的墙钟时间、CPU 时间、输入输出字节数、压缩比和吞吐率，结束时由 record_stage 输出。
+    CPU 时间是进程级别的，多个阶段并发执行时会互相包含
+        with StageTimer('tar', name) as stage:
+            ...
+            stage.bytes_in = ...
+            stage.bytes_out = ...
+    """
+
+    def __init__(self, stage, target):
+        self.stage = stage
+        self.target = target
+        self.bytes_in = None
+        self.bytes_out = None
+        self.wall_seconds = 0
+        self.cpu_seconds = 0
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.start_cpu = cpu_seconds()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.wall_seconds = time.time() - self.start_time
+        self.cpu_seconds = cpu_seconds() - self.start_cpu
+        try:
+            record_stage(self, exc_type is None)
+        except Exception:
+            write_log("record stage metrics fail: {}".format(traceback.format_exc()))
+        return False
+
+    def get_ratio(self):
+        if self.bytes_in and self.bytes_out:
+            return float(self.bytes_in) / self.bytes_out
+        return None
+
+    def get_speed(self):
+        """
+        吞吐率（MB/s），按输入字节数计算，没有输入字节数时按输出字节数计算
+        :return:
+        """
+        nbytes = self.bytes_in if self.bytes_in is not None else self.bytes_out
+        if nbytes is None or self.wall_seconds <= 0:
+            return None
+        return nbytes / 1024.0 / 1024.0 / self.wall_seconds
+
+    def summary(self):
+        items = ["use seconds:  {:.2f}s".format(self.wall_seconds), "cpu: {:.2f}s".format(self.cpu_seconds)]
+        if self.bytes_in is not None:
+            items.append("in: {}".format(human_size(self.bytes_in)))
+        if self.bytes_out is not None:
+            items.append("out: {}".format(human_size(self.bytes_out)))
+        if self.get_ratio():
+            items.append("ratio: {:.2f}".format(self.get_ratio()))
+        if self.get_speed() is not None:
+            items.append("speed: {:.2f} MB/s".format(self.get_speed()))
+        return ", ".join(items)
+
+
+def record_stage(stage, success):
+    """
+    输出阶段指标：追加一行 JSON 到 json_file，并重写 prom_file（node_exporter 的 textfile collector 格式）
+    :param stage: StageTimer
+    :param success: 阶段是否成功
+    :return:
+    """
+    metrics_config = __metrics__
+    record = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'stage': stage.stage,
+        'target': stage.target,
+        'success': success,
+        'wall_seconds': round(stage.wall_seconds, 3),
+        'cpu_seconds': round(stage.cpu_seconds, 3),
+        'bytes_in': stage.bytes_in,
+        'bytes_out': stage.bytes_out,
+        'ratio': round(stage.get_ratio(), 3) if stage.get_ratio() else None,
+        'mb_per_second': round(stage.get_speed(), 3) if stage.get_speed() is not None else None,
+    }
+    with _stage_lock_:
+        _stage_records_.append(record)
+        if metrics_config.get('json_file'):
+            with open(metrics_config.get('json_file'), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        if metrics_config.get('prom_file'):
+            write_stage_prom(metrics_config.get('prom_file'))
+
+
+def write_stage_prom(prom_file):
+    """
+    把本次备份各阶段的指标（按阶段汇总）写入 prom 文件，先写临时文件再改名，避免 node_exporter 读到不完整的文件
+    :param prom_file:
+    :return:
+    """
+    script = os.path.splitext(os.path.basename(__file__))[0]
+    stages = {}
+    for record in _stage_records_:
+        values = stages.setdefault(record['stage'], {'count': 0, 'failures': 0, 'wall_seconds': 0, 'cpu_seconds': 0,
+                                                      'bytes_in': 0, 'bytes_out': 0})
+        values['count'] += 1
+        values['failures'] += 0 if record['success'] else 1
+        for name in ('wall_seconds', 'cpu_seconds', 'bytes_in', 'bytes_out'):
+            values[name] += record[name] or 0
+    lines = []
+    for name, help_text in (('count', 'stage runs'), ('failures', 'failed stage runs'),
+                            ('wall_seconds', 'stage wall clock seconds'), ('cpu_seconds', 'stage cpu seconds'),
+                            ('bytes_in', 'stage input bytes'), ('bytes_out', 'stage output bytes')):
+        lines.append('# HELP backup_stage_{} {}'.format(name, help_text))
+        lines.append('# TYPE backup_stage_{} gauge'.format(name))
+        for stage in sorted(stages.keys()):
+            lines.append('backup_stage_{}{{script="{}",stage="{}"}} {}'.format(name, script, stage, stages[stage][name]))
+    lines.append('# TYPE backup_last_stage_timestamp_seconds gauge')
+    lines.append('backup_last_stage_timestamp_seconds{{script="{}"}} {}'.format(script, int(time.time())))
+    with open(prom_file + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(prom_file + '.tmp', prom_file)
+
+
+class StackSampler(threading.Thread):
+    """
+    采样式 profiler：每隔 interval 秒抓取一次所有线程的调用栈并计数，结果为 folded stacks 格式（每行 "栈;栈 次数"），
+    可以用 flamegraph.pl 生成火焰图，开销只跟采样间隔有关，适合长时间运行的备份
+    """
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.stacks = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        own_id = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self, out_file):
+        self.stopped.set()
+        self.join()
+        with open(out_file, 'w') as f:
+            for key, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write('{} {}\n'.format(key, count))
+
+
+def start_profiling():
+    """
+    按配置开启 cProfile（profile_file）和采样式 profiler（sample_interval），默认都不开启
+    :return: (cProfile.Profile, StackSampler)
+    """
+    metrics_config = __metrics__
+    profile = None
+    sampler = None
+    if metrics_config.get('profile_file'):
+        profile = cProfile.Profile()
+        profile.enable()
+    if metrics_config.get('sample_interval'):
+        sampler = StackSampler(float(metrics_config.get('sample_interval')))
+        sampler.start()
+    return profile, sampler
+
+
+def stop_profiling(profiling):
+    """
+    停止 profiler 并保存结果（cProfile 结果可以用 python -m pstats 查看）
+    :param profiling: start_profiling 的返回值
+    :return:
+    """
+    metrics_config = __metrics__
+    profile, sampler = profiling
+    if profile:
+        profile.disable()
+        profile.dump_stats(metrics_config.get('profile_file'))
+        write_log("cProfile stats saved to {}".format(metrics_config.get('profile_file')))
+    if sampler:
+        sampler.stop(metrics_config.get('sample_file'))
+        write_log("sampled stacks ({} kinds) saved to {}".format(len(sampler.stacks), metrics_config.get('sample_file')))
+
+
+def get_backup_files(backup_item):
+    """
+    __backup__ 中的每一项可以是文件路径数组，也可以是包含 paths 和其他选项（compress、level 等）的字典
+    :param backup_item: __backup__ 中的一项
+    :return: 文件路径数组
+    """
+    return backup_item.get('paths', []) if isinstance(backup_item, dict) else backup_item
+
+
+def get_backup_option(backup_item, name, default=None):
+    return backup_item.get(name, default) if isinstance(backup_item, dict) else default
+
+
+def get_tar_extension(compress):
+    if compress not in COMPRESS_EXTENSIONS:
+        raise Exception('unsupported compress method: {compress}'.format(compress=compress))
+    return COMPRESS_EXTENSIONS[compress]
+
+
+def gzip_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class GzipWriter(gzip.GzipFile):
+    """
+    单线程 gzip 压缩，关闭时同时关闭输出的文件对象
+    """
+
+    def close(self):
+        fileobj = self.fileobj
+        gzip.GzipFile.close(self)
+        if fileobj:
+            fileobj.close()
+
+    def abort(self):
+        """
+        出错时放弃输出（不写入 gzip 结尾），见 abort_writer
+        """
+        fileobj = self.fileobj
+        self.fileobj = None
+        if fileobj:
+            abort_writer(fileobj)
+
+
+class ParallelGzipWriter(object):
+    """
+    多进程并行 gzip 压缩：数据按 block_size 切块，每块在进程池中独立压缩成一个 gzip member 后按顺序写入文件。
+    多个 gzip member 首尾相接仍然是标准的 gzip 文件，gzip、tar 等工具都可以直接解压
+    """
+
+    def __init__(self, fileobj, level):
+        self.level = level
+        self.block_size = __compress__.get('block_size', 4 * 1024 * 1024)
+        processes = __compress__.get('processes') or multiprocessing.cpu_count()
+        self.max_pending = processes * 2
+        self.pool = multiprocessing.Pool(processes)
+        self.file = fileobj
+        self.pieces = []
+        self.pieces_size = 0
+        self.pending = []
+
+    def write(self, data):
+        self.pieces.append(data)
+        self.pieces_size += len(data)
+        if self.pieces_size >= self.block_size:
+            self._submit()
+
+    def close(self):
+        try:
+            if self.pieces_size:
+                self._submit()
+            for result in self.pending:
+                self._write_result(result)
+            self.pending = []
+            self.pool.close()
+            self.pool.join()
+        except Exception:
+            self.abort()
+            raise
+        self.file.close()
+
+    def abort(self):
+        """
+        出错时结束压缩进程池并放弃输出，见 abort_writer
+        """
+        self.pending = []
+        self.pool.terminate()
+        self.pool.join()
+        abort_writer(self.file)
+
+    def _submit(self):
+        block = b''.join(self.pieces)
+        self.pieces = []
+        self.pieces_size = 0
+        # 限制正在压缩的块数量，保证内存占用有上限
+        while len(self.pending) >= self.max_pending:
+            self._write_result(self.pending.pop(0))
+        self.pending.append(self.pool.apply_async(gzip_block, (block, self.level)))
+
+    def _write_result(self, result):
+        self.file.write(result.get())
+
+
+class CommandCompressWriter(object):
+    """
+    通过外部压缩命令（zstd、lz4）压缩：数据写入命令的标准输入，命令的标准输出由后台线程写入输出的文件对象
+    """
+
+    def __init__(self, fileobj, command):
+        self.file = fileobj
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.error = None
+        self.thread = threading.Thread(target=self._pump)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        self.process.stdin.close()
+        self.thread.join()
+        rc = self.process.wait()
+        if self.error or rc != 0:
+            abort_writer(self.file)
+            if self.error:
+                raise self.error
+            raise Exception('compress command fail, rc: {rc}'.format(rc=rc))
+        self.file.close()
+
+    def abort(self):
+        """
+        出错时结束压缩命令并放弃输出，见 abort_writer
+        """
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.thread.join()
+        abort_writer(self.file)
+
+    def _pump(self):
+        try:
+            for chunk in iter(lambda: self.process.stdout.read(STREAM_CHUNK_SIZE), b''):
+                self.file.write(chunk)
+        except Exception as e:
+            self.error = e
+            self.process.kill()
+
+
+def open_compress_writer(fileobj, compress, level=None):
+    """
+    创建压缩数据的写入对象
+    :param fileobj: 压缩后数据的输出文件对象（写入对象关闭时会同时关闭它）
+    :param compress: 压缩方式，见 COMPRESS_EXTENSIONS
+    :param level: 压缩级别，为空时使用各压缩方式的默认级别
+    :return: 包含 write、close 方法的写入对象
+    """
+    if compress == 'gzip':
+        return GzipWriter(fileobj=fileobj, mode='wb', compresslevel=9 if level is None else level)
+    if compress == 'pgzip':
+        return ParallelGzipWriter(fileobj, 6 if level is None else level)
+    if compress == 'zstd':
+        level = 3 if level is None else level
+        command = ['zstd', '-q', '-c', '-T{threads}'.format(threads=__compress__.get('processes') or 0), '-{level}'.format(level=level)]
+        if level > 19:
+            command.insert(1, '--ultra')
+        return CommandCompressWriter(fileobj, command)
+    if compress == 'lz4':
+        return CommandCompressWriter(fileobj, ['lz4', '-q', '-c', '-{level}'.format(level=1 if level is None else level)])
+    raise Exception('unsupported compress method: {compress}'.format(compress=compress))
+
+
+def abort_writer(fileobj):
+    """
+    出错时释放写入对象占用的资源（压缩进程池、外部命令、文件句柄、未完成的分片上传），不再写入剩余的数据。
+    写入对象有 abort 方法时调用 abort（会继续放弃它的输出对象），否则直接关闭；不抛出异常，以免覆盖原来的错误
+    :param fileobj: 写入对象
+    :return:
+    """
+    try:
+        if hasattr(fileobj, 'abort'):
+            fileobj.abort()
+        else:
+            fileobj.close()
+    except Exception as e:
+        write_log('abort writer fail: {error}'.format(error=e))
+
+
+def open_tar_archive(name, compress='gzip', level=None):
+    """
+    创建压缩的 tar 包
+    :param name: 打包文件名
+    :param compress: 压缩方式，见 COMPRESS_EXTENSIONS
+    :param level: 压缩级别
+    :return: (tarfile, writer)，writer 需要在 tarfile 关闭后关闭（gzip 时为 None），出错时调用 abort_tar_archive
+    """
+    if compress == 'gzip':
+        return TarFile.open(name, "w:gz", compresslevel=9 if level is None else level), None
+    fileobj = open(name, 'wb')
+    try:
+        writer = open_compress_writer(fileobj, compress, level)
+    except Exception:
+        fileobj.close()
+        raise
+    try:
+        return TarFile.open(fileobj=writer, mode="w|"), writer
+    except Exception:
+        abort_writer(writer)
+        raise
+
+
+def abort_tar_archive(tarfile, writer):
+    """
+    打包出错时关闭 tar 包，结束压缩进程（池）并关闭文件，避免进程和文件句柄泄露
+    :param tarfile: open_tar_archive 返回的 tar 包
+    :param writer: open_tar_archive 返回的 writer
+    :return:
+    """
+    if writer:
+        abort_writer(writer)
+    else:
+        abort_writer(tarfile)
+
+
+def open_tar_reader(name):
+    """
+    按文件后缀解压读取 tar 包
+    :param name: 压缩文件名
+    :return: (tarfile, process)，process 为解压命令的进程（gzip 时为 None）
+    """
+    if name.endswith('.tar.gz'):
+        return TarFile.open(name, "r:gz"), None
+    if name.endswith('.tar.zst'):
+        command = ['zstd', '-q', '-d', '-c', name]
+    elif name.endswith('.tar.lz4'):
+        command = ['lz4', '-q', '-d', '-c', name]
+    else:
+        raise Exception('unsupported archive: {name}'.format(name=name))
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    return TarFile.open(fileobj=process.stdout, mode="r|"), process
+
+
 @log_exception
-def tar_gz_file(name, file_path_list):
+def tar_gz_file(name, file_path_list, compress='gzip', level=None, includes=None, excludes=None):
     """
     打包并且压缩(gz)文件
     :param name: 打包文件名（不包含路径则打包当前脚本目录下）
     :param file_path_list: 需要打包文件的全路径名所组成的数组
+    :param compress: 压缩方式，见 COMPRESS_EXTENSIONS
+    :param level: 压缩级别
+    :param includes: 包含规则，见 scan_files
+    :param excludes: 排除规则，见 scan_files
     :return:
     """
     if not isinstance(file_path_list, list):
@@ -118,15 +803,384 @@ def tar_gz_file(name, file_path_list):
         if not os.path.exists(file_path):
             raise Exception('file is not exist: {file_path}'.format(file_path=file_path))
 
-    start_time = time.time()
-    tarfile = TarFile.open(name, "w:gz")
+    with StageTimer('tar', name) as stage:
+        tarfile, writer = open_tar_archive(name, compress, level)
+        try:
+            stage.bytes_in = add_scanned_files(tarfile, scan_files(file_path_list, includes, excludes))
+            tarfile.close()
+        except Exception:
+            abort_tar_archive(tarfile, writer)
+            raise
+        if writer:
+            writer.close()
+        stage.bytes_out = os.path.getsize(name)
+
+    message = "tar and {compress} file [{file_name}], {summary}".format(compress=compress, file_name=name, summary=stage.summary())
+    write_log(message)
+
+
+@log_exception
+def incremental_tar_gz_file(name, file_path_list, old_files, compress='gzip', level=None, includes=None, excludes=None):
+    """
+    增量打包并且压缩(gz)文件：只打包相对上一次备份新增或者修改的文件，并把已删除的文件列表写入压缩包的 .deleted 文件中
+    :param name: 打包文件名（不包含路径则打包当前脚本目录下）
+    :param file_path_list: 需要打包文件的全路径名所组成的数组
+    :param old_files: 上一次备份的文件清单，为空时即为全量备份
+    :param compress: 压缩方式，见 COMPRESS_EXTENSIONS
+    :param level: 压缩级别
+    :param includes: 包含规则，见 scan_files
+    :param excludes: 排除规则，见 scan_files
+    :return: 本次备份的文件清单
+    """
+    if not isinstance(file_path_list, list):
+        raise TypeError('parameter [file_path_list] must be list, current type:{type}'.format(type=type(file_path_list)))
     for file_path in file_path_list:
-        tarfile.add(file_path)
-    tarfile.close()
-    use_time = math.floor(time.time() - start_time)
+        if not os.path.exists(file_path):
+            raise Exception('file is not exist: {file_path}'.format(file_path=file_path))
 
-    message = "tar and gz file [{file_name}], use seconds:  {second}s".format(file_name=name, second=use_time)
+    with StageTimer('tar', name) as stage:
+        tarfile, writer = open_tar_archive(name, compress, level)
+        try:
+            new_files, changed, deleted, stage.bytes_in = add_incremental_files(tarfile, file_path_list, old_files,
+                                                                                DELETED_FILE_LIST, includes, excludes)
+            tarfile.close()
+        except Exception:
+            abort_tar_archive(tarfile, writer)
+            raise
+        if writer:
+            writer.close()
+        stage.bytes_out = os.path.getsize(name)
+
+    message = "incremental tar and gz file [{file_name}], changed: {changed}, deleted: {deleted}, {summary}" \
+        .format(file_name=name, changed=changed, deleted=deleted, summary=stage.summary())
     write_log(message)
+    return new_files
+
+
+def add_incremental_files(tarfile, file_path_list, old_files, deleted_name, includes=None, excludes=None):
+    """
+    把相对上一次备份新增或者修改的文件添加到 tar 包中，并把已删除的文件列表写入名为 deleted_name 的文件中
+    :param tarfile: tar 包
+    :param file_path_list: 需要备份文件的全路径名所组成的数组
+    :param old_files: 上一次备份的文件清单，为空时即为全量备份
+    :param deleted_name: 已删除文件列表在 tar 包中的文件名
+    :param includes: 包含规则，见 scan_files
+    :param excludes: 排除规则，见 scan_files（排除的文件视为已删除）
+    :return: (本次备份的文件清单, 新增或修改的文件数, 删除的文件数, 写入的文件数据大小)
+    """
+    entries = scan_files(file_path_list, includes, excludes)
+    new_files = build_file_manifest(entries, old_files)
+    changed_files = set(path for path, info in new_files.items()
+                        if path not in old_files or old_files[path].get('hash') != info.get('hash'))
+    deleted_files = sorted(path for path in old_files if path not in new_files)
+
+    data_size = add_scanned_files(tarfile, [(file_path, st) for file_path, st in entries if file_path in changed_files])
+    deleted_data = json.dumps({'encoding': PATH_ENCODING, 'files': deleted_files}, encoding=PATH_ENCODING)
+    tarinfo = TarInfo(deleted_name)
+    tarinfo.size = len(deleted_data)
+    tarinfo.mtime = time.time()
+    tarfile.addfile(tarinfo, io.BytesIO(deleted_data))
+    return new_files, len(changed_files), len(deleted_files), data_size
+
+
+def build_file_manifest(entries, old_files):
+    """
+    生成文件清单: {文件路径: {size, mtime, inode, hash}}。
+    文件的 size、mtime、inode 和上一次的清单一致时直接沿用上一次的 hash，不再重新读取文件内容（reflink 快照中的文件不比较 inode）
+    :param entries: scan_files 得到的 [(路径, stat)] 数组
+    :param old_files: 上一次备份的文件清单
+    :return: 文件清单
+    """
+    manifest = {}
+    for file_path, st in entries:
+        info = {'size': st.st_size, 'mtime': st.st_mtime, 'inode': st.st_ino}
+        old_info = old_files.get(file_path)
+        keys = ('size', 'mtime') if is_copy_snapshot_path(file_path) else ('size', 'mtime', 'inode')
+        if stat.S_ISDIR(st.st_mode):
+            info['hash'] = 'dir'
+        elif old_info and all(old_info.get(k) == info[k] for k in keys):
+            info['hash'] = old_info.get('hash')
+        elif stat.S_ISLNK(st.st_mode):
+            info['hash'] = 'link:' + os.readlink(get_source_path(file_path))
+        elif not stat.S_ISREG(st.st_mode):
+            # 管道、设备文件等不读取内容，否则打开管道会一直阻塞
+            info['hash'] = 'special'
+        else:
+            info['hash'] = file_md5(get_source_path(file_path))
+        manifest[file_path] = info
+    return manifest
+
+
+def match_patterns(file_path, patterns):
+    """
+    文件路径或者文件名是否匹配任意一个通配符（fnmatch）
+    """
+    name = os.path.basename(file_path.rstrip('/'))
+    return any(fnmatch.fnmatch(file_path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def list_dir(dir_path):
+    """
+    列出目录下的文件和子目录（不跟随软链接），有 scandir 时直接使用 DirEntry 的 stat 结果。
+    有快照时读取快照中对应的目录，见 get_source_path
+    :param dir_path: 目录
+    :return: [(文件名, stat)] 数组，遍历期间被删除的文件不包含在内
+    """
+    source_dir = get_source_path(dir_path)
+    if scandir is None:
+        names = os.listdir(source_dir)
+        stat_func = lambda name: os.lstat(os.path.join(source_dir, name))
+    else:
+        names = list(scandir(source_dir))
+        stat_func = lambda entry: entry.stat(follow_symlinks=False)
+    entries = []
+    for name in names:
+        try:
+            entries.append((name if scandir is None else name.name, stat_func(name)))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return entries
+
+
+def scan_files(file_path_list, includes=None, excludes=None):
+    """
+    多线程并行遍历需要备份的文件和目录（不跟随软链接），遍历时得到的 stat 结果在打包和生成文件清单时直接使用，不再逐个 lstat。
+    匹配 excludes 的文件和目录被跳过（排除的目录不会被遍历）；指定 includes 时只保留匹配的文件，目录仍然会被遍历
+    :param file_path_list: 需要备份文件的全路径名所组成的数组（总是保留，除非匹配 excludes）
+    :param includes: 包含规则（fnmatch 通配符），匹配完整路径或者文件名
+    :param excludes: 排除规则（fnmatch 通配符），匹配完整路径或者文件名
+    :return: 按路径排序的 [(路径, stat)] 数组
+    """
+    entries = []
+    errors = []
+    lock = threading.Lock()
+    dir_queue = Queue.Queue()
+
+    def scan_worker():
+        while True:
+            dir_path = dir_queue.get()
+            try:
+                if dir_path is None:
+                    return
+                found = []
+                for name, st in list_dir(dir_path):
+                    file_path = os.path.join(dir_path, name)
+                    if excludes and match_patterns(file_path, excludes):
+                        continue
+                    if stat.S_ISDIR(st.st_mode):
+                        dir_queue.put(file_path)
+                        if includes:
+                            continue
+                    elif includes and not match_patterns(file_path, includes):
+                        continue
+                    found.append((file_path, st))
+                with lock:
+                    entries.extend(found)
+            except Exception as e:
+                # 遍历期间被删除的目录直接跳过，其他错误（比如没有权限）在遍历结束后抛出
+                if not isinstance(e, OSError) or e.errno != errno.ENOENT:
+                    with lock:
+                        errors.append(e)
+            finally:
+                dir_queue.task_done()
+
+    for file_path in file_path_list:
+        if excludes and match_patterns(file_path, excludes):
+            continue
+        st = os.lstat(get_source_path(file_path))
+        entries.append((file_path, st))
+        if stat.S_ISDIR(st.st_mode):
+            dir_queue.put(file_path)
+
+    threads = []
+    for i in range(max(1, __scan__.get('threads', 8))):
+        thread = threading.Thread(target=scan_worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    dir_queue.join()
+    for thread in threads:
+        dir_queue.put(None)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    entries.sort(key=lambda entry: entry[0])
+    return entries
+
+
+def get_user_name(uid):
+    if uid not in _user_names_:
+        try:
+            _user_names_[uid] = pwd.getpwuid(uid)[0]
+        except KeyError:
+            _user_names_[uid] = ''
+    return _user_names_[uid]
+
+
+def get_group_name(gid):
+    if gid not in _group_names_:
+        try:
+            _group_names_[gid] = grp.getgrgid(gid)[0]
+        except KeyError:
+            _group_names_[gid] = ''
+    return _group_names_[gid]
+
+
+def get_tarinfo(tarfile, file_path, st):
+    """
+    用遍历时得到的 stat 生成 TarInfo（同 TarFile.gettarinfo，但不再 lstat，用户名和组名也只查询一次）
+    :param tarfile: tar 包
+    :param file_path: 文件路径
+    :param st: 文件的 stat
+    :return: TarInfo，tar 包本身和不支持的文件类型（socket）返回 None
+    """
+    if tarfile.name is not None and os.path.abspath(file_path) == tarfile.name:
+        return None
+    arcname = os.path.splitdrive(file_path)[1].replace(os.sep, '/').lstrip('/')
+    linkname = ''
+    if stat.S_ISREG(st.st_mode):
+        inode = (st.st_ino, st.st_dev)
+        if st.st_nlink > 1 and inode in tarfile.inodes and arcname != tarfile.inodes[inode]:
+            # 硬链接到已经打包的文件
+            file_type, linkname = LNKTYPE, tarfile.inodes[inode]
+        else:
+            file_type = REGTYPE
+            if inode[0]:
+                tarfile.inodes[inode] = arcname
+    elif stat.S_ISDIR(st.st_mode):
+        file_type = DIRTYPE
+    elif stat.S_ISLNK(st.st_mode):
+        file_type, linkname = SYMTYPE, os.readlink(get_source_path(file_path))
+    elif stat.S_ISFIFO(st.st_mode):
+        file_type = FIFOTYPE
+    elif stat.S_ISCHR(st.st_mode):
+        file_type = CHRTYPE
+    elif stat.S_ISBLK(st.st_mode):
+        file_type = BLKTYPE
+    else:
+        return None
+
+    tarinfo = tarfile.tarinfo(arcname)
+    tarinfo.tarfile = tarfile
+    tarinfo.mode = st.st_mode
+    tarinfo.uid = st.st_uid
+    tarinfo.gid = st.st_gid
+    tarinfo.size = st.st_size if file_type == REGTYPE else 0
+    tarinfo.mtime = st.st_mtime
+    tarinfo.type = file_type
+    tarinfo.linkname = linkname
+    tarinfo.uname = get_user_name(st.st_uid)
+    tarinfo.gname = get_group_name(st.st_gid)
+    if file_type in (CHRTYPE, BLKTYPE):
+        tarinfo.devmajor = os.major(st.st_rdev)
+        tarinfo.devminor = os.minor(st.st_rdev)
+    return tarinfo
+
+
+def read_small_file(file_path):
+    """
+    读取小文件的全部内容，文件已经被删除时返回 None
+    """
+    try:
+        with open(get_source_path(file_path), 'rb') as f:
+            return f.read()
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+
+def add_scanned_files(tarfile, entries):
+    """
+    把 scan_files 得到的文件添加到 tar 包中（不递归）：用遍历时得到的 stat 生成 TarInfo，
+    小文件按批由线程池并发读取到内存后再依次写入，大文件边读边写
+    :param tarfile: tar 包
+    :param entries: [(路径, stat)] 数组
+    :return: 写入的文件数据大小
+    """
+    small_file_size = __scan__.get('small_file_size', 64 * 1024)
+    batch_size = max(1, __scan__.get('batch_size', 256))
+    pool = ThreadPool(max(1, __scan__.get('threads', 8)))
+    total_size = 0
+    try:
+        for i in range(0, len(entries), batch_size):
+            batch = []
+            for file_path, st in entries[i:i + batch_size]:
+                tarinfo = get_tarinfo(tarfile, file_path, st)
+                if tarinfo is not None:
+                    batch.append((file_path, tarinfo))
+            small_paths = [file_path for file_path, tarinfo in batch if tarinfo.isreg() and tarinfo.size <= small_file_size]
+            contents = dict(zip(small_paths, pool.map(read_small_file, small_paths)))
+            for file_path, tarinfo in batch:
+                if not tarinfo.isreg():
+                    tarfile.addfile(tarinfo)
+                elif file_path in contents:
+                    data = contents[file_path]
+                    if data is None:
+                        continue
+                    # 遍历之后文件内容有变化时以读取到的内容为准
+                    tarinfo.size = len(data)
+                    tarfile.addfile(tarinfo, io.BytesIO(data))
+                else:
+                    with open(get_source_path(file_path), 'rb') as f:
+                        tarfile.addfile(tarinfo, f)
+                total_size += tarinfo.size
+    finally:
+        pool.close()
+        pool.join()
+    return total_size
+
+
+def file_md5(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def load_manifest():
+    """
+    读取本地的增量备份清单
+    :return: {'last_full_time': 上一次全量备份时间, 'files': {备份名: 文件清单}}
+    """
+    manifest_file = __incremental__.get('manifest_file')
+    if not os.path.exists(manifest_file):
+        return {'last_full_time': None, 'files': {}}
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+    # 路径和软链接的 hash 还原成原始字节（旧版本的清单按 utf-8 保存）
+    encoding = manifest.pop('path_encoding', 'utf-8')
+    for base_name, files in manifest.get('files', {}).items():
+        for info in files.values():
+            if isinstance(info.get('hash'), unicode):
+                info['hash'] = info['hash'].encode(encoding)
+        manifest['files'][base_name] = dict((path.encode(encoding), info) for path, info in files.items())
+    return manifest
+
+
+def save_manifest(manifest):
+    manifest_file = __incremental__.get('manifest_file')
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(dict(manifest, path_encoding=PATH_ENCODING), f, encoding=PATH_ENCODING)
+    os.rename(manifest_file + '.tmp', manifest_file)
+
+
+def get_bak_type(manifest):
+    """
+    判断本次备份是全量还是增量：没有全量备份或者距离上一次全量备份超过 full_interval_days 天时做全量备份
+    :param manifest: 增量备份清单
+    :return: full / incr
+    """
+    last_full_time = manifest.get('last_full_time')
+    if not last_full_time:
+        return 'full'
+    last_full_seconds = time.mktime(time.strptime(last_full_time, '%Y%m%d%H%M'))
+    if time.time() - last_full_seconds >= __incremental__.get('full_interval_days', 7) * 24 * 3600:
+        return 'full'
+    return 'incr'
 
 
 @log_exception
@@ -144,21 +1198,38 @@ def zip_file(name, file_path_list, password=None):
         if not os.path.exists(file_path):
             raise Exception('file is not exist: {file_path}'.format(file_path=file_path))
 
-    start_time = time.time()
-    os_command = ['7z', 'a', '-y']
-    if password:
-        os_command.append("-p{password}".format(password=password))
-    os_command.append(name)
+    with StageTimer('zip', name) as stage:
+        os_command = ['7z', 'a', '-y']
+        if password:
+            os_command.append("-p{password}".format(password=password))
+        os_command.append(name)
 
-    for file_path in file_path_list:
-        os_command.append(file_path)
+        for file_path in file_path_list:
+            os_command.append(file_path)
 
-    rc = subprocess.call(os_command)
-    use_time = math.floor(time.time() - start_time)
-    message = "zip file [{file_name}], use seconds:  {second}s".format(file_name=name, second=use_time)
+        rc = subprocess.call(os_command)
+        stage.bytes_in = get_path_size(file_path_list)
+        stage.bytes_out = os.path.getsize(name) if os.path.exists(name) else None
+    message = "zip file [{file_name}], {summary}".format(file_name=name, summary=stage.summary())
     write_log(message)
 
 
+def get_oss_bucket():
+    """
+    获取共用的 oss2.Bucket：同一次运行中所有的上传、下载共用一个连接池，复用已经建立的 HTTP 连接，
+    连接池大小不小于并发上传的线程数
+    :return: oss2.Bucket
+    """
+    global _oss_bucket_
+    with _client_lock_:
+        if _oss_bucket_ is None:
+            pool_size = max(oss2.defaults.connection_pool_size, __aliyun__.get('num_threads', 4), __dedup__.get('num_threads', 4))
+            auth = oss2.Auth(__aliyun__.get('access_key'), __aliyun__.get('access_secret'))
+            _oss_bucket_ = oss2.Bucket(auth, __aliyun__.get('oss_endpoint'), __aliyun__.get('oss_bucket'),
+                                       session=oss2.Session(pool_size=pool_size))
+        return _oss_bucket_
+
+
 @log_exception
 def upload_to_aliyun_oss(file_path):
     """
@@ -169,17 +1240,111 @@ def upload_to_aliyun_oss(file_path):
     if not os.path.exists(file_path):
         raise Exception('file is not exist: {file_path}'.format(file_path=file_path))
 
-    start_time = time.time()
-    auth = oss2.Auth(__aliyun__.get('access_key'), __aliyun__.get('access_secret'))
-    bucket = oss2.Bucket(auth, __aliyun__.get('oss_endpoint'), __aliyun__.get('oss_bucket'))
-    with open(file_path, 'rb') as f:
-        bucket.put_object(os.path.basename(f.name), f)
+    with StageTimer('upload', file_path) as stage:
+        bucket = get_oss_bucket()
+        oss_key = os.path.basename(file_path)
+        stage.bytes_in = stage.bytes_out = os.path.getsize(file_path)
+        if stage.bytes_in < __aliyun__.get('multipart_threshold', 100 * 1024 * 1024):
+            with open(file_path, 'rb') as f:
+                bucket.put_object(oss_key, f)
+        else:
+            resumable_upload_to_oss(bucket, oss_key, file_path)
 
-    use_time = math.floor(time.time() - start_time)
-    message = "upload file to aliyun oss [{file_name}], use seconds:  {second}s".format(file_name=file_path, second=use_time)
+    message = "upload file to aliyun oss [{file_name}], {summary}".format(file_name=file_path, summary=stage.summary())
     write_log(message)
 
 
+def upload_backup_file(bak_file, record):
+    """
+    上传备份文件：先写入上传记录并把备份文件移到 PENDING_UPLOAD_DIR 中再上传。上传失败时备份文件、上传记录和断点文件都保留，
+    下一次运行时由 resume_pending_uploads 从断点继续上传（断点按文件路径记录，移动后路径不再变化）
+    :param bak_file: 备份文件
+    :param record: 上传记录，见 finish_backup_upload
+    :return:
+    """
+    if not os.path.exists(PENDING_UPLOAD_DIR):
+        os.makedirs(PENDING_UPLOAD_DIR)
+    pending_file = os.path.join(PENDING_UPLOAD_DIR, os.path.basename(bak_file))
+    with open(pending_file + PENDING_RECORD_SUFFIX + '.tmp', 'wb') as f:
+        pickle.dump(record, f, 2)
+    os.rename(pending_file + PENDING_RECORD_SUFFIX + '.tmp', pending_file + PENDING_RECORD_SUFFIX)
+    shutil.move(bak_file, pending_file)
+    upload_pending_file(pending_file, record)
+
+
+def upload_pending_file(pending_file, record):
+    """
+    上传 PENDING_UPLOAD_DIR 中的备份文件，成功后更新文件清单和备份目录，并删除备份文件和上传记录
+    :param pending_file: 备份文件
+    :param record: 上传记录，见 finish_backup_upload
+    :return:
+    """
+    upload_to_aliyun_oss(pending_file)
+    finish_backup_upload(os.path.basename(pending_file), record)
+    os.remove(pending_file)
+    os.remove(pending_file + PENDING_RECORD_SUFFIX)
+
+
+def finish_backup_upload(oss_key, record):
+    """
+    备份文件上传成功后才更新本地文件清单和备份目录，保证下一次增量备份的基准和oss上的备份链一致
+    :param oss_key: 备份文件的 oss key
+    :param record: 上传记录 {bak_time, bak_type, bak_size, manifest（不做增量备份时为 None）, catalog（没有开启备份目录时为 None）}
+    :return:
+    """
+    if record['manifest'] is not None:
+        save_manifest(record['manifest'])
+    if record['catalog'] is not None:
+        save_catalog(record['bak_time'], record['bak_type'], oss_key, record['bak_size'], record['catalog'])
+
+
+def resume_pending_uploads():
+    """
+    按备份时间顺序上传以前的运行中上传失败的备份文件（从断点继续上传），有失败时抛出异常，不再开始新的备份
+    :return:
+    """
+    if not os.path.isdir(PENDING_UPLOAD_DIR):
+        return
+    for name in sorted(os.listdir(PENDING_UPLOAD_DIR)):
+        if not name.endswith(PENDING_RECORD_SUFFIX):
+            continue
+        pending_file = os.path.join(PENDING_UPLOAD_DIR, name[:-len(PENDING_RECORD_SUFFIX)])
+        if not os.path.exists(pending_file):
+            # 写入上传记录后、移动备份文件前中断，备份文件已经随临时目录删除
+            write_log("pending backup file is missing, drop the record: {file_name}".format(file_name=pending_file))
+            os.remove(pending_file + PENDING_RECORD_SUFFIX)
+            continue
+        with open(pending_file + PENDING_RECORD_SUFFIX, 'rb') as f:
+            record = pickle.load(f)
+        write_log("resume pending upload [{file_name}]".format(file_name=pending_file))
+        upload_pending_file(pending_file, record)
+
+
+def resumable_upload_to_oss(bucket, oss_key, file_path):
+    """
+    分片并发上传大文件。已完成的分片记录在本地断点文件中，上传中断后重试时只上传剩余的分片。
+    重试全部失败时保留断点文件，下一次运行时从断点继续上传（见 upload_backup_file）
+    :param bucket: oss2.Bucket
+    :param oss_key: 对象名
+    :param file_path: 文件路径名
+    :return:
+    """
+    store = oss2.ResumableStore(root=CURR_DIR, dir='oss_checkpoint')
+    retry = max(1, int(__aliyun__.get('upload_retry', 3)))
+    for i in range(retry):
+        try:
+            oss2.resumable_upload(bucket, oss_key, file_path, store=store,
+                                  multipart_threshold=__aliyun__.get('multipart_threshold', 100 * 1024 * 1024),
+                                  part_size=__aliyun__.get('part_size', 10 * 1024 * 1024),
+                                  num_threads=__aliyun__.get('num_threads', 4))
+            return
+        except oss2.exceptions.OssError as e:
+            if i == retry - 1:
+                raise
+            write_log("multipart upload interrupted, retry({}/{}), oss-key {}: {}".format(i + 1, retry - 1, oss_key, e))
+            time.sleep(2 ** i)
+
+
 @log_exception
 def upload_to_aliyun_oas(file_path, desc=None):
     """
@@ -211,7 +1376,35 @@ def upload_to_aliyun_oas(file_path, desc=None):
     return archive_id
 
 
-def send_email(subject, content, to_addrs):
+def get_smtp_server(reconnect=False):
+    """
+    获取共用的 smtp 连接：连接和登录一次，之后的邮件（比如连续的失败通知）都复用该连接，程序退出时关闭
+    :param reconnect: 为 True 时丢弃已有的连接重新连接
+    :return: smtplib.SMTP
+    """
+    global _smtp_server_
+    if _smtp_server_ is not None and not reconnect:
+        return _smtp_server_
+    close_smtp_server()
+    server = smtplib.SMTP(__email_smtp__.get('server'), __email_smtp__.get('port'))
+    server.login(__email_smtp__.get('username'), __email_smtp__.get('password'))
+    _smtp_server_ = server
+    return server
+
+
+@atexit.register
+def close_smtp_server():
+    global _smtp_server_
+    if _smtp_server_ is None:
+        return
+    try:
+        _smtp_server_.quit()
+    except (smtplib.SMTPException, socket.error):
+        pass
+    _smtp_server_ = None
+
+
+def send_email(subject, content, to_addrs):
     """
     邮件发送
     :param subject: 主题
@@ -227,51 +1420,1383 @@ def send_email(subject, content, to_addrs):
     msg['To'] = ' , '.join(to_addrs)
     msg['Subject'] = subject
 
-    server = smtplib.SMTP(__email_smtp__.get('server'), __email_smtp__.get('port'))
-    server.login(__email_smtp__.get('username'), __email_smtp__.get('password'))
-    server.sendmail(__email_smtp__.get('username'), to_addrs, msg.as_string())
-    server.quit()
+    try:
+        get_smtp_server().sendmail(__email_smtp__.get('username'), to_addrs, msg.as_string())
+    except (smtplib.SMTPServerDisconnected, socket.error):
+        # 复用的连接已经被服务器关闭（比如空闲超时），重新连接后再发送一次
+        get_smtp_server(reconnect=True).sendmail(__email_smtp__.get('username'), to_addrs, msg.as_string())
 
     message = "send email to {to_addrs}".format(to_addrs=str(to_addrs))
     write_log(message)
 
 
+def get_archive_key(salt=None):
+    """
+    由备份加密密码派生出 AES 密钥（去重块、快照索引、单次打包等在程序内加密的数据使用该密钥）
+    :param salt: 为空时使用按 bucket 固定的 salt（去重块需要固定的密钥才能按内容命名）
+    """
+    if salt is None:
+        salt = 'bak-to-aliyun:{bucket}'.format(bucket=__aliyun__.get('oss_bucket'))
+    if salt not in _archive_keys_:
+        _archive_keys_[salt] = hashlib.pbkdf2_hmac('sha256', __archive_password__, salt, 100000)
+    return _archive_keys_[salt]
+
+
+def encrypt_bytes(data, aad=b''):
+    """
+    AES-GCM 加密（带认证），返回 nonce + 密文 + tag
+    :param data: 明文
+    :param aad: 参与认证但不加密的附加数据（比如对象名），防止密文被替换到其他位置
+    """
+    nonce = os.urandom(12)
+    cipher = AES.new(get_archive_key(), AES.MODE_GCM, nonce=nonce)
+    cipher.update(aad)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    return nonce + ciphertext + tag
+
+
+def decrypt_bytes(blob, aad=b''):
+    cipher = AES.new(get_archive_key(), AES.MODE_GCM, nonce=blob[:12])
+    cipher.update(aad)
+    return cipher.decrypt_and_verify(blob[12:-16], blob[-16:])
+
+
+class DedupChunkWriter(object):
+    """
+    按内容分块（content-defined chunking）并上传到oss的去重块存储，可以作为 tarfile 的输出文件对象。
+
+    分块边界由数据内容决定：从块的 min_chunk_size 处开始逐字节滚动计算 gear hash（只取决于最近 CDC_WINDOW 个字节），
+    hash 的高 mask_bits 位为 0 时切分，到 max_chunk_size 仍未切分时强制切分。边界只取决于局部内容，
+    文件中间插入或删除数据后，后面的块仍然和上一次相同；min_chunk_size 之前的字节不计算 hash。
+    块以 HMAC-SHA256 命名，oss 上已存在的块不再重复上传。
+    """
+
+    def __init__(self, bucket, pool):
+        self.bucket = bucket
+        self.pool = pool
+        self.min_size = __dedup__.get('min_chunk_size', 512 * 1024)
+        self.max_size = __dedup__.get('max_chunk_size', 4 * 1024 * 1024)
+        mask_bits = __dedup__.get('mask_bits', 16)
+        self.mask = ((1 << mask_bits) - 1) << (32 - mask_bits)
+        self.max_pending = __dedup__.get('num_threads', 4) * 2
+        self.pieces = []
+        self.pieces_size = 0
+        self.pending = []
+        self.chunk_ids = []
+        self.total_size = 0
+        self.upload_size = 0
+        self.upload_count = 0
+
+    def write(self, data):
+        self.pieces.append(data)
+        self.pieces_size += len(data)
+        if self.pieces_size >= self.max_size:
+            self._flush(final=False)
+
+    def close(self):
+        self._flush(final=True)
+        for result in self.pending:
+            self._collect(result)
+        self.pending = []
+
+    def _flush(self, final):
+        buf = b''.join(self.pieces)
+        start = 0
+        while len(buf) - start >= (1 if final else self.max_size):
+            cut = self._find_cut(buf, start)
+            self._add_chunk(buf[start:cut])
+            start = cut
+        self.pieces = [buf[start:]] if start < len(buf) else []
+        self.pieces_size = len(buf) - start
+
+    def _find_cut(self, buf, start):
+        limit = min(len(buf), start + self.max_size)
+        # 从 min_chunk_size 前 CDC_WINDOW 个字节开始计算，到 min_chunk_size 处的 hash 和从块开头一直滚动计算的相同
+        begin = start + max(self.min_size, CDC_WINDOW) - CDC_WINDOW
+        if begin + CDC_WINDOW >= limit:
+            return limit
+        gear, mask = CDC_GEAR, self.mask
+        h = 0
+        for i, b in enumerate(bytearray(buf[begin:limit])):
+            h = ((h << 1) + gear[b]) & 0xFFFFFFFF
+            if not h & mask and i >= CDC_WINDOW:
+                return begin + i + 1
+        return limit
+
+    def _add_chunk(self, chunk):
+        chunk_id = hmac.new(get_archive_key(), chunk, hashlib.sha256).hexdigest()
+        self.chunk_ids.append(chunk_id)
+        self.total_size += len(chunk)
+        # 限制正在上传的块数量，保证内存占用有上限
+        while len(self.pending) >= self.max_pending:
+            self._collect(self.pending.pop(0))
+        self.pending.append(self.pool.apply_async(upload_dedup_chunk, (self.bucket, chunk_id, chunk)))
+
+    def _collect(self, result):
+        upload_size = result.get()
+        if upload_size:
+            self.upload_size += upload_size
+            self.upload_count += 1
+
+
+def get_dedup_chunk_key(chunk_id):
+    return '{prefix}/chunks/{dir}/{chunk_id}'.format(prefix=__dedup__.get('prefix'), dir=chunk_id[:2], chunk_id=chunk_id)
+
+
+def get_dedup_snapshot_key(bak_time):
+    return '{prefix}/snapshots/{bak_time}.idx'.format(prefix=__dedup__.get('prefix'), bak_time=bak_time)
+
+
+def upload_dedup_chunk(bucket, chunk_id, chunk):
+    """
+    上传一个去重块（压缩并加密），oss 上已存在时跳过
+    :return: 实际上传的字节数，跳过时为 0
+    """
+    oss_key = get_dedup_chunk_key(chunk_id)
+    if bucket.object_exists(oss_key):
+        return 0
+    data = encrypt_bytes(zlib.compress(chunk, 6), oss_key)
+    bucket.put_object(oss_key, data)
+    return len(data)
+
+
+@log_exception
+def dedup_backup(bak_time):
+    """
+    去重备份：把 __backup__ 中的每一项打包成 tar 流，按内容分块后只上传 oss 上不存在的块，
+    最后上传本次备份的快照索引（每一项对应的块列表）
+    :param bak_time: 备份时间
+    :return: (快照索引的 oss key, 备份数据总大小, 新上传的块数, 新上传的字节数)
+    """
+    start_time = time.time()
+    bucket = get_oss_bucket()
+    pool = ThreadPool(__dedup__.get('num_threads', 4))
+    snapshot = {'bak_time': bak_time, 'entries': {}}
+    total_size = upload_count = upload_size = 0
+    try:
+        for base_name, backup_item in __backup__.items():
+            files = get_backup_files(backup_item)
+            for file_path in files:
+                if not os.path.exists(file_path):
+                    raise Exception('file is not exist: {file_path}'.format(file_path=file_path))
+            writer = DedupChunkWriter(bucket, pool)
+            # 不压缩的 tar 流，压缩后的数据内容稍有变化就会整体改变，无法去重
+            tarfile = TarFile.open(fileobj=writer, mode="w|")
+            add_scanned_files(tarfile, scan_files(files, get_backup_option(backup_item, 'include'),
+                                                  get_backup_option(backup_item, 'exclude')))
+            tarfile.close()
+            writer.close()
+            snapshot['entries'][base_name] = writer.chunk_ids
+            total_size += writer.total_size
+            upload_count += writer.upload_count
+            upload_size += writer.upload_size
+    finally:
+        pool.close()
+        pool.join()
+
+    snapshot_key = get_dedup_snapshot_key(bak_time)
+    bucket.put_object(snapshot_key, encrypt_bytes(json.dumps(snapshot), snapshot_key))
+
+    use_time = math.floor(time.time() - start_time)
+    message = "dedup backup [{snapshot_key}], data size: {total_size}, upload chunks: {upload_count}, upload size: {upload_size}, use seconds:  {second}s" \
+        .format(snapshot_key=snapshot_key, total_size=human_size(total_size), upload_count=upload_count,
+                upload_size=human_size(upload_size), second=use_time)
+    write_log(message)
+    return snapshot_key, total_size, upload_count, upload_size
+
+
+def read_buffer(reader, size):
+    """
+    从读取对象的 buffer 中 offset 处取出 size 个字节（size < 0 时取出全部）并后移 offset
+    :param reader: 包含 buffer、offset 属性的读取对象（DedupChunkReader、AesDecryptReader）
+    :param size: 读取的字节数
+    :return:
+    """
+    end = len(reader.buffer) if size < 0 else min(len(reader.buffer), reader.offset + size)
+    data = reader.buffer[reader.offset:end]
+    reader.offset = end
+    return data
+
+
+def prune_dedup_store(bucket, keep_bak_time):
+    """
+    清理去重块存储：删除超过 keep_days 的快照索引，再删除剩余快照索引都没有引用的块（包括失败的备份上传的块）
+    :param bucket: oss2.Bucket
+    :param keep_bak_time: 本次备份时间，本次的快照索引总是保留
+    :return: (删除的快照索引数, 删除的块数)
+    """
+    keep_days = __dedup__.get('keep_days', 30)
+    if not keep_days:
+        return 0, 0
+    keep_time = time.strftime('%Y%m%d%H%M', time.localtime(time.time() - keep_days * 24 * 3600))
+    snapshot_prefix = '{prefix}/snapshots/'.format(prefix=__dedup__.get('prefix'))
+    expired_keys = []
+    referenced = set()
+    for obj in oss2.ObjectIterator(bucket, prefix=snapshot_prefix):
+        bak_time = obj.key[len(snapshot_prefix):].split('.')[0]
+        if bak_time < keep_time and bak_time != keep_bak_time:
+            expired_keys.append(obj.key)
+            continue
+        snapshot = json.loads(decrypt_bytes(bucket.get_object(obj.key).read(), obj.key))
+        for chunk_ids in snapshot['entries'].values():
+            referenced.update(chunk_ids)
+    # 先删除快照索引，再删除块，中途失败时不会留下引用了已删除块的快照索引
+    delete_oss_objects(bucket, expired_keys)
+    chunk_prefix = '{prefix}/chunks/'.format(prefix=__dedup__.get('prefix'))
+    unused_keys = [obj.key for obj in oss2.ObjectIterator(bucket, prefix=chunk_prefix)
+                   if obj.key.rsplit('/', 1)[-1] not in referenced]
+    delete_oss_objects(bucket, unused_keys)
+    write_log("prune dedup store, delete snapshots: {snapshots}, delete chunks: {chunks}, referenced chunks: {referenced}"
+              .format(snapshots=len(expired_keys), chunks=len(unused_keys), referenced=len(referenced)))
+    return len(expired_keys), len(unused_keys)
+
+
+def delete_oss_objects(bucket, keys):
+    """
+    批量删除 oss 对象（每次请求最多删除 1000 个）
+    """
+    for i in range(0, len(keys), 1000):
+        bucket.batch_delete_objects(keys[i:i + 1000])
+
+
+class DedupChunkReader(object):
+    """
+    按顺序下载并解密去重块，作为 tarfile 的输入文件对象
+    """
+
+    def __init__(self, bucket, chunk_ids):
+        self.bucket = bucket
+        self.chunk_ids = list(chunk_ids)
+        self.buffer = b''
+        # buffer 中已经读取的位置，读取时不再复制整个 buffer
+        self.offset = 0
+
+    def read(self, size=-1):
+        while self.chunk_ids and (size < 0 or len(self.buffer) - self.offset < size):
+            oss_key = get_dedup_chunk_key(self.chunk_ids.pop(0))
+            self.buffer = self.buffer[self.offset:] + zlib.decompress(decrypt_bytes(self.bucket.get_object(oss_key).read(), oss_key))
+            self.offset = 0
+        return read_buffer(self, size)
+
+
+def dedup_restore(target_dir, bak_time):
+    """
+    从去重块存储恢复某一次备份
+    :param target_dir: 恢复到的目录
+    :param bak_time: 备份时间（格式: %Y%m%d%H%M）
+    :return:
+    """
+    bucket = get_oss_bucket()
+    snapshot_key = get_dedup_snapshot_key(bak_time)
+    snapshot = json.loads(decrypt_bytes(bucket.get_object(snapshot_key).read(), snapshot_key))
+    for base_name, chunk_ids in snapshot['entries'].items():
+        tarfile = TarFile.open(fileobj=DedupChunkReader(bucket, chunk_ids), mode="r|")
+        tarfile.extractall(target_dir)
+        tarfile.close()
+        write_log("restore dedup backup [{snapshot_key}/{base_name}] to {target_dir}"
+                  .format(snapshot_key=snapshot_key, base_name=base_name, target_dir=target_dir))
+
+
+class AesEncryptWriter(object):
+    """
+    AES-GCM 分帧加密（带认证）：数据按 AES_FRAME_SIZE 分帧，每帧独立加密并带认证 tag，
+    帧序号和是否为最后一帧参与认证，帧被调换、删除或者文件被截断都能在解密时发现。
+    文件格式：AES_MAGIC + salt(16) + 若干帧[标记(1) + 密文长度(4) + nonce(12) + 密文 + tag(16)]
+    """
+
+    def __init__(self, fileobj):
+        self.file = fileobj
+        self.salt = os.urandom(16)
+        self.key = get_archive_key(self.salt)
+        self.pieces = []
+        self.pieces_size = 0
+        self.index = 0
+        self.file.write(AES_MAGIC + self.salt)
+        # 已经写入的加密数据大小
+        self.offset = len(AES_MAGIC) + len(self.salt)
+
+    def write(self, data):
+        self.pieces.append(data)
+        self.pieces_size += len(data)
+        if self.pieces_size >= AES_FRAME_SIZE:
+            buf = b''.join(self.pieces)
+            start = 0
+            while len(buf) - start >= AES_FRAME_SIZE:
+                self._write_frame(buf[start:start + AES_FRAME_SIZE], last=False)
+                start += AES_FRAME_SIZE
+            self.pieces = [buf[start:]]
+            self.pieces_size = len(buf) - start
+
+    def flush(self):
+        """
+        把缓存的数据马上写成一帧（不足 AES_FRAME_SIZE），之后写入的数据从新的一帧开始
+        """
+        if self.pieces_size:
+            self._write_frame(b''.join(self.pieces), last=False)
+            self.pieces = []
+            self.pieces_size = 0
+
+    def close(self):
+        self._write_frame(b''.join(self.pieces), last=True)
+        self.pieces = []
+        self.file.close()
+
+    def abort(self):
+        """
+        出错时放弃输出（不写入最后一帧），见 abort_writer
+        """
+        self.pieces = []
+        abort_writer(self.file)
+
+    def _write_frame(self, data, last):
+        flag = 1 if last else 0
+        nonce = os.urandom(12)
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(struct.pack('>QB', self.index, flag))
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        self.file.write(struct.pack('>BI', flag, len(ciphertext)) + nonce + ciphertext + tag)
+        self.offset += 5 + len(nonce) + len(ciphertext) + len(tag)
+        self.index += 1
+
+
+class AesDecryptReader(object):
+    """
+    读取并解密 AesEncryptWriter 生成的文件
+    """
+
+    def __init__(self, fileobj, key=None, index=0):
+        """
+        :param fileobj: 加密文件
+        :param key: 为空时从文件头中读取 salt 得到密钥；不为空时 fileobj 为从第 index 帧开始的部分加密数据（见 read_catalog_block）
+        :param index: fileobj 中第一帧的帧序号
+        """
+        self.file = fileobj
+        if key is None:
+            header = self.file.read(len(AES_MAGIC) + 16)
+            if header[:len(AES_MAGIC)] != AES_MAGIC:
+                raise Exception('not an aes encrypted backup file')
+            key = get_archive_key(header[len(AES_MAGIC):])
+        self.key = key
+        self.index = index
+        self.finished = False
+        self.buffer = b''
+        # buffer 中已经读取的位置，读取时不再复制整个 buffer
+        self.offset = 0
+
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or len(self.buffer) - self.offset < size):
+            self.buffer = self.buffer[self.offset:] + self._read_frame()
+            self.offset = 0
+        return read_buffer(self, size)
+
+    def _read_frame(self):
+        frame_header = self.file.read(5)
+        if len(frame_header) < 5:
+            raise Exception('aes encrypted backup file is truncated')
+        flag, length = struct.unpack('>BI', frame_header)
+        nonce = self.file.read(12)
+        ciphertext = self.file.read(length)
+        tag = self.file.read(16)
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(struct.pack('>QB', self.index, flag))
+        data = cipher.decrypt_and_verify(ciphertext, tag)
+        self.index += 1
+        self.finished = flag == 1
+        return data
+
+
+def decrypt_file(name, out_name):
+    """
+    解密 AesEncryptWriter 生成的文件
+    :param name: 加密文件名
+    :param out_name: 解密后的文件名
+    :return:
+    """
+    with open(name, 'rb') as f, open(out_name, 'wb') as out:
+        reader = AesDecryptReader(f)
+        for chunk in iter(lambda: reader.read(STREAM_CHUNK_SIZE), b''):
+            out.write(chunk)
+
+
+class SevenZipWriter(object):
+    """
+    通过管道交给 7z -si 加密：数据已经压缩过，7z 只存储（-mx0）不再重复压缩
+    """
+
+    def __init__(self, name, inner_name, password=None):
+        command = ['7z', 'a', '-y', '-mx0', '-si{inner_name}'.format(inner_name=inner_name)]
+        if password:
+            command.append("-p{password}".format(password=password))
+        command.append(name)
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        self.process.stdin.close()
+        rc = self.process.wait()
+        if rc != 0:
+            raise Exception('7z fail, rc: {rc}'.format(rc=rc))
+
+    def abort(self):
+        """
+        出错时结束 7z 进程，见 abort_writer
+        """
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class OssMultipartWriter(object):
+    """
+    边生成边上传到oss：写入的数据按 part_size 切成分片放入有界队列，后台线程并发上传分片。
+    队列满时写入方阻塞等待，内存占用不超过 (upload_queue_size + num_threads + 1) * 当前分片大小。
+    oss 最多 OSS_MAX_PARTS 个分片，而总大小事先未知，因此每 OSS_PART_GROW_STEP 个分片后分片大小翻倍
+    （part_size 为 10MB 时最大约 600GB），超过分片数上限时报错
+    """
+
+    def __init__(self, bucket, oss_key):
+        self.bucket = bucket
+        self.oss_key = oss_key
+        self.part_size = __aliyun__.get('part_size', 10 * 1024 * 1024)
+        self.retry = max(1, int(__aliyun__.get('upload_retry', 3)))
+        self.upload_id = bucket.init_multipart_upload(oss_key).upload_id
+        self.aborted = False
+        self.queue = Queue.Queue(maxsize=__aliyun__.get('upload_queue_size', 4))
+        self.parts = []
+        self.error = None
+        self.size = 0
+        self.part_number = 0
+        self.pieces = []
+        self.pieces_size = 0
+        self.threads = []
+        for i in range(__aliyun__.get('num_threads', 4)):
+            thread = threading.Thread(target=self._upload)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def write(self, data):
+        self.pieces.append(data)
+        self.pieces_size += len(data)
+        if self.pieces_size >= self.get_part_size():
+            buf = b''.join(self.pieces)
+            start = 0
+            while len(buf) - start >= self.get_part_size():
+                part_size = self.get_part_size()
+                self._put(buf[start:start + part_size])
+                start += part_size
+            self.pieces = [buf[start:]]
+            self.pieces_size = len(buf) - start
+
+    def get_part_size(self):
+        """
+        下一个分片的大小
+        """
+        return self.part_size * 2 ** (self.part_number // OSS_PART_GROW_STEP)
+
+    def close(self):
+        if self.pieces_size or not self.part_number:
+            self._put(b''.join(self.pieces))
+        self.pieces = []
+        self._stop()
+        if self.error:
+            self.abort()
+            raise self.error
+        self.parts.sort(key=lambda part: part.part_number)
+        self.bucket.complete_multipart_upload(self.oss_key, self.upload_id, self.parts)
+
+    def abort(self):
+        """
+        取消分片上传，删除已经上传的分片（出错时 close 和调用方都可能调用，只执行一次）
+        """
+        if self.aborted:
+            return
+        self.aborted = True
+        self._stop()
+        try:
+            self.bucket.abort_multipart_upload(self.oss_key, self.upload_id)
+        except oss2.exceptions.OssError as e:
+            write_log("abort multipart upload fail, oss-key {}: {}".format(self.oss_key, e))
+
+    def _put(self, data):
+        if self.error:
+            raise self.error
+        if self.part_number >= OSS_MAX_PARTS:
+            raise Exception('stream upload exceeds {max_parts} parts, size: {size}, oss-key: {oss_key}'
+                            .format(max_parts=OSS_MAX_PARTS, size=human_size(self.size), oss_key=self.oss_key))
+        self.part_number += 1
+        self.size += len(data)
+        self.queue.put((self.part_number, data))
+
+    def _stop(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _upload(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error:
+                # 已经出错时只取出队列中的分片，避免写入方一直阻塞
+                continue
+            part_number, data = item
+            for i in range(self.retry):
+                try:
+                    result = self.bucket.upload_part(self.oss_key, self.upload_id, part_number, data)
+                    self.parts.append(oss2.models.PartInfo(part_number, result.etag, size=len(data)))
+                    break
+                except Exception as e:
+                    if i == self.retry - 1:
+                        self.error = e
+                    else:
+                        time.sleep(2 ** i)
+
+
+class SeekableGzipWriter(ParallelGzipWriter):
+    """
+    可按块随机读取的 gzip 压缩（用于备份目录）：每个 gzip member 写入后马上结束当前的加密帧，
+    并记录每块在 tar 流中的位置和在加密文件中的位置，恢复单个文件时只需要下载、解密、解压覆盖它的几个块。
+    输出的文件对象为 AesEncryptWriter，整个文件仍然可以按普通的 .tar.gz.enc 解密、解压
+    """
+
+    def __init__(self, fileobj, level):
+        ParallelGzipWriter.__init__(self, fileobj, level)
+        self.block_size = __catalog__.get('block_size', 4 * 1024 * 1024)
+        self.plain_offset = 0
+        self.plain_sizes = []
+        # [(块在 tar 流中的偏移, 块大小, 块的第一帧的帧序号, 块在加密文件中的偏移, 块在加密文件中的大小)]
+        self.blocks = []
+
+    def _submit(self):
+        self.plain_sizes.append(self.pieces_size)
+        ParallelGzipWriter._submit(self)
+
+    def _write_result(self, result):
+        frame_index, offset = self.file.index, self.file.offset
+        self.file.write(result.get())
+        self.file.flush()
+        plain_size = self.plain_sizes.pop(0)
+        self.blocks.append((self.plain_offset, plain_size, frame_index, offset, self.file.offset - offset))
+        self.plain_offset += plain_size
+
+
+class HashReader(object):
+    """
+    读取文件的同时计算读取到的内容的 md5
+    """
+
+    def __init__(self, fileobj):
+        self.file = fileobj
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.md5.update(data)
+        return data
+
+
+class CatalogTarFile(TarFile):
+    """
+    写入 tar 流的同时记录每个普通文件（包括硬链接）的数据在 tar 流中的偏移、大小和 md5，用于生成备份目录
+    """
+
+    def __init__(self, *args, **kwargs):
+        TarFile.__init__(self, *args, **kwargs)
+        # [(tar 包中的文件名, 大小, md5, 数据在 tar 流中的偏移, mode, mtime)]
+        self.catalog_files = []
+        self.catalog_names = {}
+
+    def addfile(self, tarinfo, fileobj=None):
+        if tarinfo.isreg() and fileobj is not None:
+            fileobj = HashReader(fileobj)
+        TarFile.addfile(self, tarinfo, fileobj)
+        if tarinfo.isreg() and fileobj is not None:
+            # 文件数据紧跟在文件头之后，按 BLOCKSIZE 补齐后写入，写入后 offset 指向文件数据的末尾
+            offset = self.offset - (tarinfo.size + BLOCKSIZE - 1) // BLOCKSIZE * BLOCKSIZE
+            entry = (tarinfo.name, tarinfo.size, fileobj.md5.hexdigest(), offset, tarinfo.mode, int(tarinfo.mtime))
+        elif tarinfo.islnk() and tarinfo.linkname in self.catalog_names:
+            entry = (tarinfo.name,) + self.catalog_names[tarinfo.linkname][1:4] + (tarinfo.mode, int(tarinfo.mtime))
+        else:
+            return
+        self.catalog_files.append(entry)
+        self.catalog_names[tarinfo.name] = entry
+
+
+def open_catalog():
+    """
+    打开本地的备份目录数据库，本地没有时从oss下载（比如在新的机器上恢复或者继续备份）
+    :return: sqlite3.Connection
+    """
+    db_file = __catalog__.get('db_file')
+    if not os.path.exists(db_file):
+        bucket = get_oss_bucket()
+        oss_key = __catalog__.get('oss_key')
+        if bucket.object_exists(oss_key):
+            data = zlib.decompress(decrypt_bytes(bucket.get_object(oss_key).read(), oss_key))
+            with open(db_file + '.tmp', 'wb') as f:
+                f.write(data)
+            os.rename(db_file + '.tmp', db_file)
+            write_log("download backup catalog [{oss_key}] to {db_file}".format(oss_key=oss_key, db_file=db_file))
+    conn = sqlite3.connect(db_file)
+    # 文件名按原始字节保存，不要求是 utf-8
+    conn.text_factory = str
+    conn.executescript(CATALOG_SCHEMA)
+    return conn
+
+
+@log_exception
+def save_catalog(bak_time, bak_type, oss_key, file_size, catalog):
+    """
+    把本次备份写入备份目录，并把备份目录压缩、加密后上传到oss
+    :param bak_time: 备份时间
+    :param bak_type: full / incr
+    :param oss_key: 备份文件的 oss key
+    :param file_size: 备份文件大小
+    :param catalog: single_pass_archive 返回的 (文件数组, 块数组)
+    :return:
+    """
+    files, blocks = catalog
+    with StageTimer('catalog', oss_key) as stage:
+        conn = open_catalog()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)', (bak_time, bak_type, oss_key, file_size))
+                conn.execute('DELETE FROM blocks WHERE bak_time = ?', (bak_time,))
+                conn.execute('DELETE FROM files WHERE bak_time = ?', (bak_time,))
+                conn.executemany('INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?)', ((bak_time,) + block for block in blocks))
+                conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', ((bak_time,) + entry for entry in files))
+                keep_days = __catalog__.get('keep_days', 30)
+                if keep_days:
+                    keep_time = time.strftime('%Y%m%d%H%M', time.localtime(time.time() - keep_days * 24 * 3600))
+                    # 保留期内的增量备份依赖保留期前最后一个全量备份，只清理它之前的备份
+                    keep_full_time = conn.execute("SELECT MAX(bak_time) FROM snapshots WHERE bak_type = 'full' AND bak_time <= ?",
+                                                  (keep_time,)).fetchone()[0]
+                    if keep_full_time:
+                        for table in ('snapshots', 'blocks', 'files'):
+                            conn.execute('DELETE FROM {table} WHERE bak_time < ?'.format(table=table), (keep_full_time,))
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+        db_file = __catalog__.get('db_file')
+        with open(db_file, 'rb') as f:
+            data = f.read()
+        catalog_key = __catalog__.get('oss_key')
+        blob = encrypt_bytes(zlib.compress(data, 6), catalog_key)
+        get_oss_bucket().put_object(catalog_key, blob)
+        stage.bytes_in = len(data)
+        stage.bytes_out = len(blob)
+
+    message = "save backup catalog [{oss_key}], files: {files}, blocks: {blocks}, catalog size: {size}, {summary}" \
+        .format(oss_key=oss_key, files=len(files), blocks=len(blocks), size=human_size(len(blob)), summary=stage.summary())
+    write_log(message)
+
+
+def read_catalog_block(bucket, oss_key, key, block):
+    """
+    按范围下载备份文件中的一块，解密、解压后返回该块在 tar 流中的数据
+    :param bucket: oss2.Bucket
+    :param oss_key: 备份文件的 oss key
+    :param key: 备份文件的 AES 密钥
+    :param block: (块在 tar 流中的偏移, 块大小, 块的第一帧的帧序号, 块在加密文件中的偏移, 块在加密文件中的大小)
+    :return: 块数据
+    """
+    plain_offset, plain_size, frame_index, offset, length = block
+    # 范围不合法时 oss 默认返回整个文件，这里要求按标准行为返回错误
+    data = bucket.get_object(oss_key, byte_range=(offset, offset + length - 1),
+                             headers={'x-oss-range-behavior': 'standard'}).read()
+    if len(data) != length:
+        raise Exception('read block fail, oss-key: {oss_key}, offset: {offset}'.format(oss_key=oss_key, offset=offset))
+    f = io.BytesIO(data)
+    reader = AesDecryptReader(f, key=key, index=frame_index)
+    pieces = []
+    while f.tell() < length:
+        pieces.append(reader._read_frame())
+    plain = zlib.decompress(b''.join(pieces), 16 + zlib.MAX_WBITS)
+    if len(plain) != plain_size:
+        raise Exception('block size mismatch, oss-key: {oss_key}, offset: {offset}'.format(oss_key=oss_key, offset=offset))
+    return plain
+
+
+def restore_path(file_path, target_dir, until_time=None):
+    """
+    根据备份目录恢复单个文件或者目录：找到不晚于 until_time 的备份链中该路径（目录时为目录下的所有文件）的最新版本，
+    只按范围下载覆盖这些文件的块，不下载整个备份文件
+    :param file_path: 需要恢复的文件或目录的路径（备份时的全路径）
+    :param target_dir: 恢复到的目录
+    :param until_time: 恢复到的时间点（格式: %Y%m%d%H%M），为空时恢复到最新的备份
+    :return:
+    """
+    arcname = file_path.strip('/')
+    conn = open_catalog()
+    try:
+        chain = conn.execute('SELECT bak_time, bak_type, oss_key FROM snapshots WHERE bak_time <= ? ORDER BY bak_time',
+                             (until_time or '9' * 12,)).fetchall()
+        full_indexes = [i for i, (bak_time, bak_type, oss_key) in enumerate(chain) if bak_type == 'full']
+        if not full_indexes:
+            raise Exception('no full backup found in catalog before: {until_time}'.format(until_time=until_time or 'now'))
+        # 按备份链依次取各文件的最新版本，增量备份中删除的文件 hash 为 deleted
+        files = {}
+        for bak_time, bak_type, oss_key in chain[full_indexes[-1]:]:
+            if arcname:
+                rows = conn.execute('SELECT path, size, hash, offset, mode, mtime FROM files WHERE bak_time = ? '
+                                    'AND (path = ? OR substr(path, 1, ?) = ?)', (bak_time, arcname, len(arcname) + 1, arcname + '/'))
+            else:
+                rows = conn.execute('SELECT path, size, hash, offset, mode, mtime FROM files WHERE bak_time = ?', (bak_time,))
+            for row in rows:
+                files[row[0]] = (bak_time, oss_key) + tuple(row)
+        files = sorted(info for info in files.values() if info[4] != 'deleted')
+        if not files:
+            raise Exception('file is not found in backup catalog: {file_path}'.format(file_path=file_path))
+
+        bucket = get_oss_bucket()
+        keys = {}
+        num_threads = max(1, __aliyun__.get('num_threads', 4))
+        pool = ThreadPool(num_threads)
+        try:
+            for bak_time, oss_key, path, size, file_hash, offset, mode, mtime in files:
+                if oss_key not in keys:
+                    header = bucket.get_object(oss_key, byte_range=(0, len(AES_MAGIC) + 15)).read()
+                    if header[:len(AES_MAGIC)] != AES_MAGIC:
+                        raise Exception('not an aes encrypted backup file: {oss_key}'.format(oss_key=oss_key))
+                    keys[oss_key] = get_archive_key(header[len(AES_MAGIC):])
+                blocks = conn.execute('SELECT plain_offset, plain_size, frame_index, offset, length FROM blocks '
+                                      'WHERE bak_time = ? AND plain_offset < ? AND plain_offset + plain_size > ? '
+                                      'ORDER BY plain_offset', (bak_time, offset + size, offset)).fetchall()
+                out_path = os.path.join(target_dir, path)
+                if not os.path.isdir(os.path.dirname(out_path)):
+                    os.makedirs(os.path.dirname(out_path))
+                md5 = hashlib.md5()
+                download_size = 0
+                with open(out_path, 'wb') as out:
+                    # 按下载线程数分批并发下载，内存中最多保留一批块
+                    for i in range(0, len(blocks), num_threads):
+                        batch = blocks[i:i + num_threads]
+                        for block, plain in zip(batch, pool.map(lambda b: read_catalog_block(bucket, oss_key, keys[oss_key], b), batch)):
+                            start = max(offset, block[0]) - block[0]
+                            end = min(offset + size, block[0] + block[1]) - block[0]
+                            out.write(plain[start:end])
+                            md5.update(plain[start:end])
+                            download_size += block[4]
+                if md5.hexdigest() != file_hash:
+                    raise Exception('file hash mismatch: {path}'.format(path=path))
+                os.chmod(out_path, mode)
+                os.utime(out_path, (mtime, mtime))
+                write_log("restore [{path}] from [{oss_key}] to {target_dir}, size: {size}, download: {download_size}"
+                          .format(path=path, oss_key=oss_key, target_dir=target_dir, size=human_size(size),
+                                  download_size=human_size(download_size)))
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        conn.close()
+
+
+def get_single_pass_extension():
+    encrypt = __single_pass__.get('encrypt', 'aes')
+    if encrypt not in ('aes', '7z'):
+        raise Exception('unsupported encrypt method: {encrypt}'.format(encrypt=encrypt))
+    if __catalog__.get('enabled'):
+        if encrypt != 'aes':
+            raise Exception('backup catalog only support aes encrypt')
+        return get_tar_extension('pgzip') + '.enc'
+    return get_tar_extension(__single_pass__.get('compress', 'gzip')) + ('.enc' if encrypt == 'aes' else '.7z')
+
+
+@log_exception
+def single_pass_archive(name, manifest_files=None, upload=False):
+    """
+    单次打包：所有备份项打包成一个 tar 流，边打包边压缩、加密，直接写成最终的备份文件，不生成中间的 .tar.gz 文件
+    :param name: 备份文件名（后缀见 get_single_pass_extension）
+    :param manifest_files: 增量备份时为上一次备份的文件清单 {备份名: 文件清单}（全量备份时为空字典），为 None 时不做增量备份
+    :param upload: 为 True 时边打包边分片上传到oss（oss key 为文件名），不写本地文件
+    :return: (本次备份的文件清单 {备份名: 文件清单}（不做增量备份时为 None）, 备份文件大小,
+              备份目录的 (文件数组, 块数组)（没有开启备份目录时为 None），见 save_catalog)
+    """
+    for backup_item in __backup__.values():
+        for file_path in get_backup_files(backup_item):
+            if not os.path.exists(file_path):
+                raise Exception('file is not exist: {file_path}'.format(file_path=file_path))
+
+    with StageTimer('single_pass', name) as stage:
+        uploader = None
+        if upload:
+            if __single_pass__.get('encrypt', 'aes') != 'aes':
+                raise Exception('stream upload only support aes encrypt')
+            bucket = get_oss_bucket()
+            uploader = OssMultipartWriter(bucket, os.path.basename(name))
+            try:
+                output = AesEncryptWriter(uploader)
+            except Exception:
+                abort_writer(uploader)
+                raise
+        elif __single_pass__.get('encrypt', 'aes') == 'aes':
+            fileobj = open(name, 'wb')
+            try:
+                output = AesEncryptWriter(fileobj)
+            except Exception:
+                fileobj.close()
+                raise
+        else:
+            inner_name = os.path.basename(name)[:-len('.7z')]
+            output = SevenZipWriter(name, inner_name, password=__archive_password__)
+        level = __single_pass__.get('level')
+        try:
+            if __catalog__.get('enabled'):
+                writer = SeekableGzipWriter(output, 6 if level is None else level)
+            else:
+                writer = open_compress_writer(output, __single_pass__.get('compress', 'gzip'), level)
+        except Exception:
+            abort_writer(output)
+            raise
+        new_manifest_files = None if manifest_files is None else {}
+        # 写入 tar 包的文件数据大小（用打包时得到的大小，不再遍历一次备份目录）
+        data_size = 0
+        try:
+            if __catalog__.get('enabled'):
+                tarfile = CatalogTarFile.open(fileobj=writer, mode="w|")
+            else:
+                tarfile = TarFile.open(fileobj=writer, mode="w|")
+            for base_name, backup_item in __backup__.items():
+                files = get_backup_files(backup_item)
+                includes = get_backup_option(backup_item, 'include')
+                excludes = get_backup_option(backup_item, 'exclude')
+                if manifest_files is None:
+                    data_size += add_scanned_files(tarfile, scan_files(files, includes, excludes))
+                else:
+                    new_manifest_files[base_name], changed, deleted, size = add_incremental_files(
+                        tarfile, files, manifest_files.get(base_name, {}), '{}_{}'.format(DELETED_FILE_LIST, base_name),
+                        includes, excludes)
+                    data_size += size
+            tarfile.close()
+            writer.close()
+        except Exception:
+            # 结束压缩进程池、关闭文件，边打包边上传时取消分片上传
+            abort_writer(writer)
+            raise
+        file_size = uploader.size if uploader else os.path.getsize(name)
+        catalog = None
+        if __catalog__.get('enabled'):
+            files = [entry for entry in tarfile.catalog_files if not entry[0].startswith(DELETED_FILE_LIST)]
+            if manifest_files is not None:
+                # 增量备份中删除的文件也记录到备份目录中，按备份链恢复时不再恢复
+                for base_name, old_files in manifest_files.items():
+                    new_files = new_manifest_files.get(base_name, {})
+                    files.extend((file_path.lstrip('/'), 0, 'deleted', -1, 0, 0)
+                                 for file_path in old_files if file_path not in new_files)
+            catalog = (files, writer.blocks)
+        stage.bytes_in = data_size
+        stage.bytes_out = file_size
+
+    message = "single pass archive [{file_name}]{upload}, size: {file_size}, {summary}" \
+        .format(file_name=name, upload=' and upload to aliyun oss' if upload else '', file_size=human_size(file_size), summary=stage.summary())
+    write_log(message)
+    return new_manifest_files, file_size, catalog
+
+
+def get_source_path(file_path):
+    """
+    获取读取备份文件时实际使用的路径：备份路径有文件系统快照时为快照中对应的路径，否则为原路径。
+    tar 包和文件清单中的文件名始终为原路径
+    :param file_path: 备份文件的原路径
+    :return:
+    """
+    for root, snapshot_root in _snapshot_paths_.items():
+        if file_path == root or file_path.startswith(root.rstrip('/') + '/'):
+            return snapshot_root + file_path[len(root.rstrip('/')):]
+    return file_path
+
+
+def is_copy_snapshot_path(file_path):
+    """
+    文件是否从 reflink 复制的快照中读取（复制出的文件 inode 号和原文件不同，且每次备份都不同）
+    :param file_path: 备份文件的原路径
+    :return:
+    """
+    return any(file_path == root or file_path.startswith(root.rstrip('/') + '/') for root in _copy_snapshot_paths_)
+
+
+def get_mount_info(path):
+    """
+    从 /proc/mounts 中找到路径所在的文件系统
+    :param path:
+    :return: (挂载点, 设备, 文件系统类型)
+    """
+    path = os.path.realpath(path)
+    mount_info = None
+    with open('/proc/mounts') as f:
+        for line in f:
+            device, mount_point, fs_type = line.split()[:3]
+            mount_point = mount_point.replace('\\040', ' ')
+            if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+                # 同一个挂载点被多次挂载时以最后一次为准
+                if mount_info is None or len(mount_point) >= len(mount_info[0]):
+                    mount_info = (mount_point, device, fs_type)
+    return mount_info
+
+
+def run_snapshot_command(command):
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as e:
+        raise Exception('{program} not available: {error}'.format(program=command[0], error=e))
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise Exception('{command} fail, rc: {rc}, {out}'.format(command=' '.join(command), rc=process.returncode, out=out.strip()))
+    return out
+
+
+def create_btrfs_snapshot(path, mount_info, name):
+    """
+    btrfs 只读快照：对路径所在的子卷做快照，快照放在子卷的根目录下（快照只能建在同一个文件系统中）
+    :return: 快照信息，见 release_fs_snapshots
+    """
+    if mount_info[2] != 'btrfs':
+        raise Exception('not a btrfs filesystem: {path}'.format(path=path))
+    subvol_root = os.path.realpath(path)
+    while os.stat(subvol_root).st_ino != BTRFS_SUBVOL_INODE and subvol_root != mount_info[0]:
+        subvol_root = os.path.dirname(subvol_root)
+    snapshot_root = os.path.join(subvol_root, name)
+    run_snapshot_command(['btrfs', 'subvolume', 'snapshot', '-r', subvol_root, snapshot_root])
+    return {'method': 'btrfs', 'source_root': subvol_root, 'snapshot_root': snapshot_root,
+            'release': [['btrfs', 'subvolume', 'delete', snapshot_root]]}
+
+
+def create_lvm_snapshot(path, mount_info, name):
+    """
+    LVM 快照：对路径所在的逻辑卷做快照，只读挂载到 mount_dir 下
+    :return: 快照信息，见 release_fs_snapshots
+    """
+    mount_point, device, fs_type = mount_info
+    vg_name, lv_name = run_snapshot_command(['lvs', '--noheadings', '-o', 'vg_name,lv_name', device]).split()
+    snapshot_lv = '{vg_name}/{lv_name}{name}'.format(vg_name=vg_name, lv_name=lv_name, name=name)
+    run_snapshot_command(['lvcreate', '-s', '-L', __fs_snapshot__.get('lvm_size', '5G'), '-n', snapshot_lv.split('/')[1],
+                          '{vg_name}/{lv_name}'.format(vg_name=vg_name, lv_name=lv_name)])
+    snapshot_root = os.path.join(__fs_snapshot__.get('mount_dir'), snapshot_lv.replace('/', '-'))
+    try:
+        if not os.path.exists(snapshot_root):
+            os.makedirs(snapshot_root)
+        # xfs 的快照和原卷 uuid 相同，需要 nouuid 才能同时挂载
+        run_snapshot_command(['mount', '-o', 'ro,nouuid' if fs_type == 'xfs' else 'ro', '/dev/' + snapshot_lv, snapshot_root])
+    except Exception:
+        run_snapshot_command(['lvremove', '-f', snapshot_lv])
+        raise
+    return {'method': 'lvm', 'source_root': mount_point, 'snapshot_root': snapshot_root,
+            'release': [['umount', snapshot_root], ['lvremove', '-f', snapshot_lv]], 'remove_dir': snapshot_root}
+
+
+def create_copy_snapshot(path, mount_info, name, method):
+    """
+    暂存目录：在同一个文件系统中用 cp --reflink=always（写时复制，不复制数据）或者 cp -l（硬链接）复制出一份目录树。
+    复制时间随文件数增长，但是不随数据量增长
+    :return: 快照信息，见 release_fs_snapshots
+    """
+    source_root = os.path.realpath(path)
+    staging_root = os.path.join(mount_info[0], name)
+    snapshot_root = os.path.join(staging_root, os.path.relpath(source_root, mount_info[0]))
+    try:
+        if not os.path.exists(os.path.dirname(snapshot_root)):
+            os.makedirs(os.path.dirname(snapshot_root))
+        run_snapshot_command(['cp', '-a', '--reflink=always' if method == 'reflink' else '-l', source_root, snapshot_root])
+    except Exception:
+        shutil.rmtree(staging_root, ignore_errors=True)
+        raise
+    return {'method': method, 'source_root': source_root, 'snapshot_root': snapshot_root, 'release': [],
+            'remove_dir': staging_root}
+
+
+def create_fs_snapshot(path, name):
+    """
+    按配置的方式给路径做快照，auto 时依次尝试 btrfs、LVM、reflink
+    :return: 快照信息
+    """
+    method = __fs_snapshot__.get('method', 'auto')
+    methods = ['btrfs', 'lvm', 'reflink'] if method == 'auto' else [method]
+    mount_info = get_mount_info(path)
+    errors = []
+    for method in methods:
+        try:
+            if method == 'btrfs':
+                return create_btrfs_snapshot(path, mount_info, name)
+            elif method == 'lvm':
+                return create_lvm_snapshot(path, mount_info, name)
+            elif method in ('reflink', 'hardlink'):
+                return create_copy_snapshot(path, mount_info, name, method)
+            raise Exception('unsupported snapshot method: {method}'.format(method=method))
+        except Exception as e:
+            errors.append('{method}: {error}'.format(method=method, error=e))
+    raise Exception('snapshot fail, {path}, {errors}'.format(path=path, errors='; '.join(errors)))
+
+
+@log_exception
+def capture_fs_snapshots(bak_time):
+    """
+    给需要做快照的备份路径做文件系统快照：执行 pre_command 后依次做快照，然后执行 post_command（pre_command 或快照失败时也会执行）。
+    同一个子卷/逻辑卷上的多个备份路径共用一个快照，这些路径的数据是同一个时间点的
+    :param bak_time: 备份时间
+    :return: 快照信息数组，打包完成后调用 release_fs_snapshots 删除
+    """
+    paths = []
+    for backup_item in __backup__.values():
+        if get_backup_option(backup_item, 'snapshot', __fs_snapshot__.get('enabled')):
+            paths.extend(f for f in get_backup_files(backup_item) if os.path.exists(f))
+    if not paths:
+        return []
+
+    name = '.bak_snapshot_{bak_time}'.format(bak_time=bak_time)
+    snapshots = []
+    with StageTimer('snapshot', ','.join(paths)) as stage:
+        try:
+            # pre_command 失败（比如只锁住了部分表）时也要执行 post_command
+            if __fs_snapshot__.get('pre_command'):
+                rc = subprocess.call(__fs_snapshot__.get('pre_command'), shell=True)
+                if rc != 0:
+                    raise Exception('snapshot pre command fail, rc: {rc}'.format(rc=rc))
+            for path in paths:
+                real_path = os.path.realpath(path)
+                snapshot = None
+                for s in snapshots:
+                    if real_path == s['source_root'] or real_path.startswith(s['source_root'].rstrip('/') + '/'):
+                        snapshot = s
+                        break
+                if snapshot is None:
+                    try:
+                        snapshot = create_fs_snapshot(path, name)
+                    except Exception as e:
+                        if not __fs_snapshot__.get('fallback', True):
+                            raise
+                        write_log('{error}, archive the live path instead'.format(error=e))
+                        continue
+                    snapshots.append(snapshot)
+                _snapshot_paths_[path] = snapshot['snapshot_root'] + real_path[len(snapshot['source_root'].rstrip('/')):]
+                if snapshot['method'] == 'reflink':
+                    _copy_snapshot_paths_.add(path)
+        except Exception:
+            release_fs_snapshots(snapshots)
+            raise
+        finally:
+            if __fs_snapshot__.get('post_command'):
+                subprocess.call(__fs_snapshot__.get('post_command'), shell=True)
+
+    message = "capture filesystem snapshots [{snapshots}], pause seconds: {second:.3f}s" \
+        .format(snapshots=', '.join('{method}:{root}'.format(method=s['method'], root=s['source_root']) for s in snapshots),
+                second=stage.wall_seconds)
+    write_log(message)
+    return snapshots
+
+
+def release_fs_snapshots(snapshots):
+    """
+    删除文件系统快照（LVM 快照先卸载），并清除备份路径到快照路径的映射
+    :param snapshots: capture_fs_snapshots 返回的快照信息数组，删除后清空
+    :return:
+    """
+    _snapshot_paths_.clear()
+    _copy_snapshot_paths_.clear()
+    while snapshots:
+        snapshot = snapshots.pop()
+        try:
+            for command in snapshot['release']:
+                run_snapshot_command(command)
+            if snapshot.get('remove_dir') and os.path.exists(snapshot['remove_dir']):
+                shutil.rmtree(snapshot['remove_dir'])
+            write_log("release {method} snapshot [{root}]".format(method=snapshot['method'], root=snapshot['snapshot_root']))
+        except Exception as e:
+            write_log("release {method} snapshot [{root}] fail: {error}".format(
+                method=snapshot['method'], root=snapshot['snapshot_root'], error=e))
+
+
+def get_free_space(path):
+    """
+    路径所在磁盘的剩余可用空间（即 df 的 Avail）
+    :param path:
+    :return: 字节数
+    """
+    disk = os.statvfs(path)
+    return disk.f_bavail * disk.f_frsize
+
+
+def get_scratch_budget(scratch_dir):
+    """
+    本次备份可以使用的临时空间：磁盘剩余空间减去保留空间，并且不超过配置的上限
+    :param scratch_dir: 临时目录
+    :return: 字节数
+    """
+    free_size = get_free_space(scratch_dir) - __scratch__.get('reserve', 0)
+    budget = __scratch__.get('budget', 0)
+    return max(0, min(free_size, budget) if budget else free_size)
+
+
+def estimate_scratch_size(source_size, mode):
+    """
+    预估各打包方式备份过程中同时存在的临时文件大小
+    staged：各备份项的压缩包 + 最终的 zip 文件；single_pass：只有最终的备份文件；stream_upload：不写本地文件
+    :param source_size: 备份数据大小
+    :param mode: 打包方式，见 BACKUP_MODES
+    :return: 字节数
+    """
+    compressed_size = source_size * __scratch__.get('compress_ratio', 1.0)
+    if mode == 'staged':
+        return int(compressed_size * 2)
+    if mode == 'single_pass':
+        return int(compressed_size)
+    return 0
+
+
+@log_exception
+def choose_backup_mode(scratch_dir):
+    """
+    备份前的临时空间预检：按备份数据大小和可用的临时空间选择打包方式。
+    配置的打包方式放不下时（auto_stream），依次改用占用临时空间更少的打包方式，都放不下时不开始备份
+    :param scratch_dir: 临时目录
+    :return: (打包方式, 可用的临时空间)
+    """
+    if not __single_pass__.get('enabled') and not __catalog__.get('enabled'):
+        # 备份目录只支持单次打包
+        mode = 'staged'
+    else:
+        mode = 'stream_upload' if __single_pass__.get('stream_upload') else 'single_pass'
+    modes = BACKUP_MODES[BACKUP_MODES.index(mode):] if __scratch__.get('auto_stream', True) else [mode]
+    if mode != 'stream_upload' and __single_pass__.get('encrypt', 'aes') != 'aes':
+        # 边打包边上传只支持 aes 加密
+        modes = [m for m in modes if m != 'stream_upload']
+
+    source_size = 0
+    for backup_item in __backup__.values():
+        source_size += get_path_size([f for f in get_backup_files(backup_item) if os.path.lexists(f)])
+    budget = get_scratch_budget(scratch_dir)
+    for m in modes:
+        need_size = estimate_scratch_size(source_size, m)
+        if need_size <= budget:
+            message = "scratch preflight, source size: {source_size}, budget: {budget}, need: {need_size}, mode: {mode}" \
+                .format(source_size=human_size(source_size), budget=human_size(budget), need_size=human_size(need_size), mode=m)
+            write_log(message if m == mode else message + ' (configured: {mode})'.format(mode=mode))
+            return m, budget
+    raise Exception('not enough scratch space, source size: {source_size}, budget: {budget}, need: {need_size}'
+                    .format(source_size=human_size(source_size), budget=human_size(budget),
+                            need_size=human_size(estimate_scratch_size(source_size, modes[-1]))))
+
+
+@log_exception
+def check_scratch_usage(scratch_dir, budget, next_size=0):
+    """
+    检查临时目录的占用加上下一步将要生成的文件大小是否超过临时空间预算，超过时停止备份，避免把磁盘写满
+    :param scratch_dir: 临时目录
+    :param budget: 临时空间预算
+    :param next_size: 下一步将要生成的文件的预估大小
+    :return:
+    """
+    used_size = get_path_size([scratch_dir])
+    if used_size + next_size > budget:
+        raise Exception('scratch space exceeds budget, used: {used_size}, next: {next_size}, budget: {budget}'
+                        .format(used_size=human_size(used_size), next_size=human_size(next_size), budget=human_size(budget)))
+
+
+def restore_backup(target_dir, until_time=None):
+    """
+    根据oss上的全量和增量备份链恢复文件：从不晚于 until_time 的最近一次全量备份开始，依次应用之后的增量备份
+    :param target_dir: 恢复到的目录
+    :param until_time: 恢复到的时间点（格式: %Y%m%d%H%M），为空时恢复到最新的备份
+    :return:
+    """
+    bucket = get_oss_bucket()
+    chain = []
+    for obj in oss2.ObjectIterator(bucket):
+        match = BAK_FILE_PATTERN.search(obj.key)
+        if match and (not until_time or match.group(1) <= until_time):
+            chain.append((match.group(1), match.group(2), obj.key))
+    chain.sort()
+    full_indexes = [i for i, (bak_time, bak_type, oss_key) in enumerate(chain) if bak_type == 'full']
+    if not full_indexes:
+        raise Exception('no full backup found before: {until_time}'.format(until_time=until_time or 'now'))
+    chain = chain[full_indexes[-1]:]
+
+    restore_dir = os.path.join(CURR_DIR, 'restore_dir')
+    for bak_time, bak_type, oss_key in chain:
+        if os.path.exists(restore_dir):
+            shutil.rmtree(restore_dir)
+        os.makedirs(restore_dir)
+        try:
+            bak_file = os.path.join(restore_dir, os.path.basename(oss_key))
+            bucket.get_object_to_file(oss_key, bak_file)
+            if bak_file.endswith('.enc'):
+                decrypt_file(bak_file, bak_file[:-len('.enc')])
+            else:
+                rc = subprocess.call(['7z', 'x', '-y', '-p{password}'.format(password=__archive_password__),
+                                      '-o{out_dir}'.format(out_dir=restore_dir), bak_file])
+                if rc != 0:
+                    raise Exception('unzip backup file fail: {oss_key}'.format(oss_key=oss_key))
+            for archive_name in os.listdir(restore_dir):
+                if not any(archive_name.endswith(extension) for extension in COMPRESS_EXTENSIONS.values()):
+                    continue
+                tarfile, process = open_tar_reader(os.path.join(restore_dir, archive_name))
+                deleted_files = []
+                for member in tarfile:
+                    if member.name.startswith(DELETED_FILE_LIST):
+                        deleted = json.loads(tarfile.extractfile(member).read())
+                        if isinstance(deleted, dict):
+                            deleted_files.extend(path.encode(deleted['encoding']) for path in deleted['files'])
+                        else:
+                            # 旧版本的备份中是按 utf-8 保存的路径数组
+                            deleted_files.extend(path.encode('utf-8') for path in deleted)
+                    else:
+                        tarfile.extract(member, target_dir)
+                tarfile.close()
+                if process and process.wait() != 0:
+                    raise Exception('uncompress archive fail: {archive_name}'.format(archive_name=archive_name))
+                for file_path in deleted_files:
+                    file_path = os.path.join(target_dir, file_path.lstrip('/'))
+                    if os.path.isdir(file_path) and not os.path.islink(file_path):
+                        shutil.rmtree(file_path)
+                    elif os.path.lexists(file_path):
+                        os.remove(file_path)
+            write_log("restore backup [{oss_key}] to {target_dir}".format(oss_key=oss_key, target_dir=target_dir))
+        finally:
+            shutil.rmtree(restore_dir)
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'dedup-restore':
+        if len(sys.argv) < 4:
+            print("usage: {script} dedup-restore <target_dir> <%Y%m%d%H%M>".format(script=sys.argv[0]))
+            sys.exit(1)
+        dedup_restore(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'restore':
+        if len(sys.argv) < 3 or (sys.argv[2] == '--path' and len(sys.argv) < 5):
+            print("usage: {script} restore <target_dir> [%Y%m%d%H%M]".format(script=sys.argv[0]))
+            print("       {script} restore --path <file_path> <target_dir> [%Y%m%d%H%M]".format(script=sys.argv[0]))
+            sys.exit(1)
+        if sys.argv[2] == '--path':
+            # 根据备份目录只恢复指定的文件或目录
+            restore_path(sys.argv[3], sys.argv[4], sys.argv[5] if len(sys.argv) > 5 else None)
+        else:
+            restore_backup(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'snapshot-check':
+        # 检查文件系统快照的配置（比如在 loop 设备上的 btrfs 镜像中测试）：做一次快照，列出快照中的文件数后删除快照
+        fs_snapshots = capture_fs_snapshots(time.strftime('%Y%m%d%H%M'))
+        try:
+            for path, snapshot_path in _snapshot_paths_.items():
+                print("{path} -> {snapshot_path}, files: {count}".format(path=path, snapshot_path=snapshot_path,
+                                                                         count=len(scan_files([path]))))
+        finally:
+            release_fs_snapshots(fs_snapshots)
+        sys.exit(0)
+
     write_log("=========================== start : backup data ==========================")
 
     data_dir = os.path.join(CURR_DIR, 'data_dir')
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
     archive_file_list = []
+    fs_snapshots = []
+    profiling = start_profiling()
 
     try:
+        # 0，先上传以前的运行中上传失败的备份文件，再开始新的备份（增量备份依赖前面的备份已经上传、清单已经更新）
+        resume_pending_uploads()
         bak_time = time.strftime('%Y%m%d%H%M')
+        # 0，给需要做快照的备份路径做文件系统快照，之后从快照中打包
+        fs_snapshots = capture_fs_snapshots(bak_time)
+        if __dedup__.get('enabled'):
+            # 1~3，去重备份：备份数据按内容分块，只上传oss上不存在的块和本次备份的快照索引
+            snapshot_key, total_size, upload_count, upload_size = dedup_backup(bak_time)
+            release_fs_snapshots(fs_snapshots)
+            try:
+                # 清理过期的快照索引和不再引用的块，清理失败不影响本次备份
+                prune_dedup_store(get_oss_bucket(), bak_time)
+            except Exception as e:
+                write_log("prune dedup store fail: {error}".format(error=e))
+            bak_info = u'''
+            <p><b>快照索引：</b>   {snapshot_key}</p>
+            <p><b>数据大小：</b>   {total_size}</p>
+            <p><b>新上传：</b>   {upload_count} 块 / {upload_size}</p>
+            '''.format(snapshot_key=snapshot_key, total_size=human_size(total_size), upload_count=upload_count,
+                       upload_size=human_size(upload_size))
+        else:
+            incremental = __incremental__.get('enabled')
+            if incremental:
+                manifest = load_manifest()
+                bak_type = get_bak_type(manifest)
+                new_manifest = {'last_full_time': bak_time if bak_type == 'full' else manifest.get('last_full_time'), 'files': {}}
+
+            if incremental:
+                bak_name = '<hidden>_bak_{bak_time}_{bak_type}'.format(bak_time=bak_time, bak_type=bak_type)
+            else:
+                bak_name = '<hidden>_bak_{bak_time}'.format(bak_time=bak_time)
 
-        # 1，打包备份文件
-        for archive_name, files in __backup__.items():
-            archive_name = os.path.join(data_dir, '{base_name}_{bak_time}.tar.gz'.format(base_name=archive_name, bak_time=bak_time))
-            tar_gz_file(archive_name, files)
-            archive_file_list.append(archive_name)
+            # 0，临时空间预检：按备份数据大小和磁盘剩余空间选择打包方式
+            bak_mode, scratch_budget = choose_backup_mode(data_dir)
+            stream_upload = bak_mode == 'stream_upload'
+            catalog = None
+            if bak_mode != 'staged':
+                # 1~2，单次打包：打包、压缩、加密一次完成，直接生成最终的备份文件
+                bak_file = os.path.join(data_dir, bak_name + get_single_pass_extension())
+                old_manifest_files = (manifest.get('files', {}) if bak_type == 'incr' else {}) if incremental else None
+                new_manifest_files, bak_size, catalog = single_pass_archive(bak_file, old_manifest_files, upload=stream_upload)
+                if incremental:
+                    new_manifest['files'] = new_manifest_files
+            else:
+                # 1，打包备份文件
+                for base_name, backup_item in __backup__.items():
+                    files = get_backup_files(backup_item)
+                    compress = get_backup_option(backup_item, 'compress', __compress__.get('default', 'gzip'))
+                    level = get_backup_option(backup_item, 'level')
+                    includes = get_backup_option(backup_item, 'include')
+                    excludes = get_backup_option(backup_item, 'exclude')
+                    archive_name = os.path.join(data_dir, '{base_name}_{bak_time}{extension}'
+                                                .format(base_name=base_name, bak_time=bak_time, extension=get_tar_extension(compress)))
+                    if incremental:
+                        old_files = manifest.get('files', {}).get(base_name, {}) if bak_type == 'incr' else {}
+                        new_manifest['files'][base_name] = incremental_tar_gz_file(archive_name, files, old_files, compress, level,
+                                                                                   includes, excludes)
+                    else:
+                        tar_gz_file(archive_name, files, compress, level, includes, excludes)
+                    archive_file_list.append(archive_name)
+                    check_scratch_usage(data_dir, scratch_budget)
 
-        # 2，打包并加密所有的已打包的备份文件
-        bak_file = os.path.join(data_dir, '<hidden>_bak_{bak_time}.zip'.format(bak_time=bak_time))
-        zip_file(bak_file, archive_file_list, password=__archive_password__)
+                # 2，打包并加密所有的已打包的备份文件（zip 文件大小和各压缩包的总大小相当）
+                check_scratch_usage(data_dir, scratch_budget, get_path_size(archive_file_list))
+                bak_file = os.path.join(data_dir, bak_name + '.zip')
+                zip_file(bak_file, archive_file_list, password=__archive_password__)
+                bak_size = os.path.getsize(bak_file)
+                # 各压缩包已经打包进 zip 文件，马上删除，不等到备份结束
+                for archive_name in archive_file_list:
+                    os.remove(archive_name)
+            # 打包已经完成，删除文件系统快照，不等到上传结束
+            release_fs_snapshots(fs_snapshots)
 
-        # 3、上传到阿里云对象存储（oss）服务器。
-        # 备注：当前阿里云的归档存储服务没有提供归档文件相应的查看和下载界面，所以这里用oss来存储备份文件，
-        # 而且oss具有很好的生命周期规则可以设置，从而不需要自己来控制数据的过期删除。
-        upload_to_aliyun_oss(bak_file)
+            # 3、上传到阿里云对象存储（oss）服务器（边打包边上传时已经上传完成）。
+            # 备注：当前阿里云的归档存储服务没有提供归档文件相应的查看和下载界面，所以这里用oss来存储备份文件，
+            # 而且oss具有很好的生命周期规则可以设置，从而不需要自己来控制数据的过期删除。
+            # 3.1、上传成功后更新本地清单，并把本次备份中每个文件的位置写入备份目录（见 finish_backup_upload）
+            record = {'bak_time': bak_time, 'bak_type': bak_type if incremental else 'full', 'bak_size': bak_size,
+                      'manifest': new_manifest if incremental else None, 'catalog': catalog}
+            if stream_upload:
+                finish_backup_upload(os.path.basename(bak_file), record)
+            else:
+                upload_backup_file(bak_file, record)
+            bak_info = u'''
+            <p><b>备份文件名：</b>   {bak_file}</p>
+            <p><b>文件大小：</b>   {file_size}</p>
+            '''.format(bak_file=os.path.basename(bak_file), file_size=human_size(bak_size))
 
         # 4、对备份状态进行邮件通知
         subject = u'<hidden>数据备份成功'
         content = __email_template__.format(bak_message=u'服务器数据已经备份并上传到阿里云对象存储（OSS）服务器上', bak_status=u'成功',
                                             bak_time=time.strftime('%Y-%m-%d %H:%M'))
-        content = content + u'''
-            <p><b>备份文件名：</b>   {bak_file}</p>
-            <p><b>文件大小：</b>   {file_size}</p>
+        content = content + bak_info + u'''
             <p><b>阿里云位置：</b>   {server_type} / {server_dir}</p>
-        '''.format(bak_file=os.path.basename(bak_file), file_size=human_size(os.path.getsize(bak_file)),
-                   server_type='OSS', server_dir=__aliyun__.get('oss_bucket'))
+        '''.format(server_type='OSS', server_dir=__aliyun__.get('oss_bucket'))
 
         try:
             '''获取硬盘信息'''
@@ -284,7 +2809,9 @@ if __name__ == "__main__":
             pass
         send_email(subject, content, ['<hidden>', '<hidden>'])
     finally:
-        # 5，删除备份过程中的中间文件
+        # 5，删除文件系统快照和备份过程中的中间文件
+        release_fs_snapshots(fs_snapshots)
         shutil.rmtree(data_dir)
+        stop_profiling(profiling)
 
     write_log("=========================== end : backup data ==========================")
@@ -1,9 +1,14 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
-import math
+import atexit
+import cProfile
+import json
 import os
 import smtplib
+import socket
 import subprocess
+import sys
+import threading
 import time
 import traceback
 from email.mime.text import MIMEText
@@ -22,6 +27,12 @@ __aliyun__ = {
     'access_secret': '<hidden>',
     'oss_endpoint': 'http://oss-cn-beijing.aliyuncs.com',
     'oss_bucket': '<hidden>',
+    # 文件大于该值时采用分片并发上传，否则直接 put_object
+    'multipart_threshold': 100 * 1024 * 1024,
+    'part_size': 10 * 1024 * 1024,
+    'num_threads': 4,
+    # 分片上传中断后的重试次数，重试时从本地断点记录处继续上传
+    'upload_retry': 3,
 }
 
 __backup__ = {
@@ -34,6 +45,36 @@ __mysql__ = {
     'port': '<hidden>'
 }
 
+# 临时空间：备份前根据备份数据大小和磁盘剩余空间预估需要的临时空间，放不下时不开始备份
+__scratch__ = {
+    # 临时空间上限（字节），0 为不限制（只受磁盘剩余空间限制）
+    'budget': 0,
+    # 磁盘上至少保留的剩余空间
+    'reserve': 1024 * 1024 * 1024,
+    # 预估的压缩率（压缩后/压缩前），按偏大取值
+    'compress_ratio': 0.7
+}
+
+# 备份阶段的指标和性能分析
+__metrics__ = {
+    # 每个备份阶段（导出、打包、加密压缩、上传）一行 JSON 记录，为空时不记录
+    'json_file': os.path.join(CURR_DIR, 'backup_metrics.jsonl'),
+    # node_exporter textfile collector 目录下的 .prom 文件，为空时不输出，比如 /var/lib/node_exporter/textfile_collector/backup.prom
+    'prom_file': '',
+    # cProfile 结果文件，为空时不开启
+    'profile_file': '',
+    # 采样式 profiler 的采样间隔（秒），0 为不开启
+    'sample_interval': 0,
+    'sample_file': os.path.join(CURR_DIR, 'backup_stacks.folded'),
+}
+_stage_records_ = []
+_stage_lock_ = threading.Lock()
+
+# 共用的 oss2.Bucket 和 smtp 连接，见 get_oss_bucket、get_smtp_server
+_oss_bucket_ = None
+_smtp_server_ = None
+_client_lock_ = threading.Lock()
+
 # 备份文件加密密码
 __archive_password__ = "<hidden>"
 
@@ -105,6 +146,223 @@ def log_exception(func):
     return wrapper
 
 
+def get_path_size(file_path_list):
+    """
+    统计文件和目录的总大小（不跟随软链接）
+    :param file_path_list: 文件路径名所组成的数组
+    :return: 字节数
+    """
+    total_size = 0
+    for file_path in file_path_list:
+        if os.path.islink(file_path) or not os.path.isdir(file_path):
+            total_size += os.lstat(file_path).st_size
+            continue
+        for root, dirs, files in os.walk(file_path):
+            for name in files:
+                try:
+                    total_size += os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+    return total_size
+
+
+def cpu_seconds():
+    """
+    当前进程以及已经结束的子进程（mysqldump、7z 等）的 CPU 时间（用户态 + 内核态）
+    :return:
+    """
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+class StageTimer(object):
+    """
+    记录一个备份阶段的墙钟时间、CPU 时间、输入输出字节数、压缩比和吞吐率，结束时由 record_stage 输出。
+    CPU 时间是进程级别的，多个阶段并发执行时会互相包含
+        with StageTimer('tar', name) as stage:
+            ...
+            stage.bytes_in = ...
+            stage.bytes_out = ...
+    """
+
+    def __init__(self, stage, target):
+        self.stage = stage
+        self.target = target
+        self.bytes_in = None
+        self.bytes_out = None
+        self.wall_seconds = 0
+        self.cpu_seconds = 0
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.start_cpu = cpu_seconds()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.wall_seconds = time.time() - self.start_time
+        self.cpu_seconds = cpu_seconds() - self.start_cpu
+        try:
+            record_stage(self, exc_type is None)
+        except Exception:
+            write_log("record stage metrics fail: {}".format(traceback.format_exc()))
+        return False
+
+    def get_ratio(self):
+        if self.bytes_in and self.bytes_out:
+            return float(self.bytes_in) / self.bytes_out
+        return None
+
+    def get_speed(self):
+        """
+        吞吐率（MB/s），按输入字节数计算，没有输入字节数时按输出字节数计算
+        :return:
+        """
+        nbytes = self.bytes_in if self.bytes_in is not None else self.bytes_out
+        if nbytes is None or self.wall_seconds <= 0:
+            return None
+        return nbytes / 1024.0 / 1024.0 / self.wall_seconds
+
+    def summary(self):
+        items = ["use seconds:  {:.2f}s".format(self.wall_seconds), "cpu: {:.2f}s".format(self.cpu_seconds)]
+        if self.bytes_in is not None:
+            items.append("in: {}".format(human_size(self.bytes_in)))
+        if self.bytes_out is not None:
+            items.append("out: {}".format(human_size(self.bytes_out)))
+        if self.get_ratio():
+            items.append("ratio: {:.2f}".format(self.get_ratio()))
+        if self.get_speed() is not None:
+            items.append("speed: {:.2f} MB/s".format(self.get_speed()))
+        return ", ".join(items)
+
+
+def record_stage(stage, success):
+    """
+    输出阶段指标：追加一行 JSON 到 json_file，并重写 prom_file（node_exporter 的 textfile collector 格式）
+    :param stage: StageTimer
+    :param success: 阶段是否成功
+    :return:
+    """
+    metrics_config = __metrics__
+    record = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'stage': stage.stage,
+        'target': stage.target,
+        'success': success,
+        'wall_seconds': round(stage.wall_seconds, 3),
+        'cpu_seconds': round(stage.cpu_seconds, 3),
+        'bytes_in': stage.bytes_in,
+        'bytes_out': stage.bytes_out,
+        'ratio': round(stage.get_ratio(), 3) if stage.get_ratio() else None,
+        'mb_per_second': round(stage.get_speed(), 3) if stage.get_speed() is not None else None,
+    }
+    with _stage_lock_:
+        _stage_records_.append(record)
+        if metrics_config.get('json_file'):
+            with open(metrics_config.get('json_file'), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        if metrics_config.get('prom_file'):
+            write_stage_prom(metrics_config.get('prom_file'))
+
+
+def write_stage_prom(prom_file):
+    """
+    把本次备份各阶段的指标（按阶段汇总）写入 prom 文件，先写临时文件再改名，避免 node_exporter 读到不完整的文件
+    :param prom_file:
+    :return:
+    """
+    script = os.path.splitext(os.path.basename(__file__))[0]
+    stages = {}
+    for record in _stage_records_:
+        values = stages.setdefault(record['stage'], {'count': 0, 'failures': 0, 'wall_seconds': 0, 'cpu_seconds': 0,
+                                                      'bytes_in': 0, 'bytes_out': 0})
+        values['count'] += 1
+        values['failures'] += 0 if record['success'] else 1
+        for name in ('wall_seconds', 'cpu_seconds', 'bytes_in', 'bytes_out'):
+            values[name] += record[name] or 0
+    lines = []
+    for name, help_text in (('count', 'stage runs'), ('failures', 'failed stage runs'),
+                            ('wall_seconds', 'stage wall clock seconds'), ('cpu_seconds', 'stage cpu seconds'),
+                            ('bytes_in', 'stage input bytes'), ('bytes_out', 'stage output bytes')):
+        lines.append('# HELP backup_stage_{} {}'.format(name, help_text))
+        lines.append('# TYPE backup_stage_{} gauge'.format(name))
+        for stage in sorted(stages.keys()):
+            lines.append('backup_stage_{}{{script="{}",stage="{}"}} {}'.format(name, script, stage, stages[stage][name]))
+    lines.append('# TYPE backup_last_stage_timestamp_seconds gauge')
+    lines.append('backup_last_stage_timestamp_seconds{{script="{}"}} {}'.format(script, int(time.time())))
+    with open(prom_file + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(prom_file + '.tmp', prom_file)
+
+
+class StackSampler(threading.Thread):
+    """
+    采样式 profiler：每隔 interval 秒抓取一次所有线程的调用栈并计数，结果为 folded stacks 格式（每行 "栈;栈 次数"），
+    可以用 flamegraph.pl 生成火焰图，开销只跟采样间隔有关，适合长时间运行的备份
+    """
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.stacks = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        own_id = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self, out_file):
+        self.stopped.set()
+        self.join()
+        with open(out_file, 'w') as f:
+            for key, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write('{} {}\n'.format(key, count))
+
+
+def start_profiling():
+    """
+    按配置开启 cProfile（profile_file）和采样式 profiler（sample_interval），默认都不开启
+    :return: (cProfile.Profile, StackSampler)
+    """
+    metrics_config = __metrics__
+    profile = None
+    sampler = None
+    if metrics_config.get('profile_file'):
+        profile = cProfile.Profile()
+        profile.enable()
+    if metrics_config.get('sample_interval'):
+        sampler = StackSampler(float(metrics_config.get('sample_interval')))
+        sampler.start()
+    return profile, sampler
+
+
+def stop_profiling(profiling):
+    """
+    停止 profiler 并保存结果（cProfile 结果可以用 python -m pstats 查看）
+    :param profiling: start_profiling 的返回值
+    :return:
+    """
+    metrics_config = __metrics__
+    profile, sampler = profiling
+    if profile:
+        profile.disable()
+        profile.dump_stats(metrics_config.get('profile_file'))
+        write_log("cProfile stats saved to {}".format(metrics_config.get('profile_file')))
+    if sampler:
+        sampler.stop(metrics_config.get('sample_file'))
+        write_log("sampled stacks ({} kinds) saved to {}".format(len(sampler.stacks), metrics_config.get('sample_file')))
+
+
 @log_exception
 def tar_gz_file(name, file_path_list):
     """
@@ -119,14 +377,23 @@ def tar_gz_file(name, file_path_list):
         if not os.path.exists(file_path):
             raise Exception('file is not exist: {file_path}'.format(file_path=file_path))
 
-    start_time = time.time()
-    tarfile = TarFile.open(name, "w:gz")
-    for file_path in file_path_list:
-        tarfile.add(file_path)
-    tarfile.close()
-    use_time = math.floor(time.time() - start_time)
+    with StageTimer('tar', name) as stage:
+        # 写入 tar 包的文件数据大小（添加文件时累加，不再遍历一次备份目录）
+        data_size = [0]
+
+        def count_size(tarinfo):
+            if tarinfo.isreg():
+                data_size[0] += tarinfo.size
+            return tarinfo
+
+        tarfile = TarFile.open(name, "w:gz")
+        for file_path in file_path_list:
+            tarfile.add(file_path, filter=count_size)
+        tarfile.close()
+        stage.bytes_in = data_size[0]
+        stage.bytes_out = os.path.getsize(name)
 
-    message = "tar and gz file [{file_name}], use seconds:  {second}s".format(file_name=name, second=use_time)
+    message = "tar and gz file [{file_name}], {summary}".format(file_name=name, summary=stage.summary())
     write_log(message)
 
 
@@ -145,21 +412,38 @@ def zip_file(name, file_path_list, password=None):
         if not os.path.exists(file_path):
             raise Exception('file is not exist: {file_path}'.format(file_path=file_path))
 
-    start_time = time.time()
-    os_command = ['7z', 'a', '-y']
-    if password:
-        os_command.append("-p{password}".format(password=password))
-    os_command.append(name)
+    with StageTimer('zip', name) as stage:
+        os_command = ['7z', 'a', '-y']
+        if password:
+            os_command.append("-p{password}".format(password=password))
+        os_command.append(name)
 
-    for file_path in file_path_list:
-        os_command.append(file_path)
+        for file_path in file_path_list:
+            os_command.append(file_path)
 
-    rc = subprocess.call(os_command)
-    use_time = math.floor(time.time() - start_time)
-    message = "zip file [{file_name}], use seconds:  {second}s".format(file_name=name, second=use_time)
+        rc = subprocess.call(os_command)
+        stage.bytes_in = get_path_size(file_path_list)
+        stage.bytes_out = os.path.getsize(name) if os.path.exists(name) else None
+    message = "zip file [{file_name}], {summary}".format(file_name=name, summary=stage.summary())
     write_log(message)
 
 
+def get_oss_bucket():
+    """
+    获取共用的 oss2.Bucket：同一次运行中所有的上传、下载共用一个连接池，复用已经建立的 HTTP 连接，
+    连接池大小不小于并发上传的线程数
+    :return: oss2.Bucket
+    """
+    global _oss_bucket_
+    with _client_lock_:
+        if _oss_bucket_ is None:
+            pool_size = max(oss2.defaults.connection_pool_size, __aliyun__.get('num_threads', 4))
+            auth = oss2.Auth(__aliyun__.get('access_key'), __aliyun__.get('access_secret'))
+            _oss_bucket_ = oss2.Bucket(auth, __aliyun__.get('oss_endpoint'), __aliyun__.get('oss_bucket'),
+                                       session=oss2.Session(pool_size=pool_size))
+        return _oss_bucket_
+
+
 @log_exception
 def upload_to_aliyun_oss(file_path):
     """
@@ -170,17 +454,95 @@ def upload_to_aliyun_oss(file_path):
     if not os.path.exists(file_path):
         raise Exception('file is not exist: {file_path}'.format(file_path=file_path))
 
-    start_time = time.time()
-    auth = oss2.Auth(__aliyun__.get('access_key'), __aliyun__.get('access_secret'))
-    bucket = oss2.Bucket(auth, __aliyun__.get('oss_endpoint'), __aliyun__.get('oss_bucket'))
-    with open(file_path, 'rb') as f:
-        bucket.put_object(os.path.basename(f.name), f)
-
-    use_time = math.floor(time.time() - start_time)
-    message = "upload file to aliyun oss [{file_name}], use seconds:  {second}s".format(file_name=file_path, second=use_time)
+    with StageTimer('upload', file_path) as stage:
+        bucket = get_oss_bucket()
+        oss_key = os.path.basename(file_path)
+        stage.bytes_in = stage.bytes_out = os.path.getsize(file_path)
+        if stage.bytes_in < __aliyun__.get('multipart_threshold', 100 * 1024 * 1024):
+            with open(file_path, 'rb') as f:
+                bucket.put_object(oss_key, f)
+        else:
+            resumable_upload_to_oss(bucket, oss_key, file_path)
+
+    message = "upload file to aliyun oss [{file_name}], {summary}".format(file_name=file_path, summary=stage.summary())
     write_log(message)
 
 
+def abort_resumable_upload(bucket, oss_key, file_path, store):
+    """
+    放弃断点续传：取消 oss 上未完成的分片上传（避免残留分片占用存储），并删除本地断点文件
+    :param bucket: oss2.Bucket
+    :param oss_key: 对象名
+    :param file_path: 文件路径名
+    :param store: oss2.ResumableStore
+    :return:
+    """
+    store_key = store.make_store_key(bucket.bucket_name, oss_key, os.path.abspath(file_path))
+    record = store.get(store_key)
+    if not record:
+        return
+    try:
+        bucket.abort_multipart_upload(oss_key, record['upload_id'])
+    except oss2.exceptions.OssError as e:
+        write_log("abort multipart upload failed, oss-key {}: {}".format(oss_key, e))
+    store.delete(store_key)
+
+
+def resumable_upload_to_oss(bucket, oss_key, file_path):
+    """
+    分片并发上传大文件。已完成的分片记录在本地断点文件中，上传中断后重试时只上传剩余的分片。
+    断点只在本次运行的重试之间有效（断点按本地文件路径记录，而备份文件名带有备份时间且失败后会被删除），
+    重试全部失败时取消 oss 上未完成的分片上传并删除断点文件
+    :param bucket: oss2.Bucket
+    :param oss_key: 对象名
+    :param file_path: 文件路径名
+    :return:
+    """
+    store = oss2.ResumableStore(root=CURR_DIR, dir='oss_checkpoint')
+    retry = max(1, int(__aliyun__.get('upload_retry', 3)))
+    for i in range(retry):
+        try:
+            oss2.resumable_upload(bucket, oss_key, file_path, store=store,
+                                  multipart_threshold=__aliyun__.get('multipart_threshold', 100 * 1024 * 1024),
+                                  part_size=__aliyun__.get('part_size', 10 * 1024 * 1024),
+                                  num_threads=__aliyun__.get('num_threads', 4))
+            return
+        except oss2.exceptions.OssError as e:
+            if i == retry - 1:
+                abort_resumable_upload(bucket, oss_key, file_path, store)
+                raise
+            write_log("multipart upload interrupted, retry({}/{}), oss-key {}: {}".format(i + 1, retry - 1, oss_key, e))
+            time.sleep(2 ** i)
+
+
+def get_smtp_server(reconnect=False):
+    """
+    获取共用的 smtp 连接：连接和登录一次，之后的邮件（比如连续的失败通知）都复用该连接，程序退出时关闭
+    :param reconnect: 为 True 时丢弃已有的连接重新连接
+    :return: smtplib.SMTP
+    """
+    global _smtp_server_
+    if _smtp_server_ is not None and not reconnect:
+        return _smtp_server_
+    close_smtp_server()
+    server = smtplib.SMTP(__email_smtp__.get('server'), __email_smtp__.get('port'))
+    server.login(__email_smtp__.get('username'), __email_smtp__.get('password'))
+    _smtp_server_ = server
+    return server
+
+
+@atexit.register
+def close_smtp_server():
+    global _smtp_server_
+    if _smtp_server_ is None:
+        return
+    try:
+        _smtp_server_.quit()
+    except (smtplib.SMTPException, socket.error):
+        pass
+    _smtp_server_ = None
+
+
 def send_email(subject, content, to_addrs):
     """
     邮件发送
@@ -197,10 +559,11 @@ def send_email(subject, content, to_addrs):
     msg['To'] = ' , '.join(to_addrs)
     msg['Subject'] = subject
 
-    server = smtplib.SMTP(__email_smtp__.get('server'), __email_smtp__.get('port'))
-    server.login(__email_smtp__.get('username'), __email_smtp__.get('password'))
-    server.sendmail(__email_smtp__.get('username'), to_addrs, msg.as_string())
-    server.quit()
+    try:
+        get_smtp_server().sendmail(__email_smtp__.get('username'), to_addrs, msg.as_string())
+    except (smtplib.SMTPServerDisconnected, socket.error):
+        # 复用的连接已经被服务器关闭（比如空闲超时），重新连接后再发送一次
+        get_smtp_server(reconnect=True).sendmail(__email_smtp__.get('username'), to_addrs, msg.as_string())
 
     message = "send email to {to_addrs}".format(to_addrs=str(to_addrs))
     write_log(message)
@@ -211,11 +574,12 @@ def dump_mysql(sql_file, db_name):
     """
     导出系统数据库数据
     """
-    start_time = time.time()
-    os.popen("mysqldump -u {username} -p{password} -P {port} {db_name} > {sql_file}"
-             .format(username=__mysql__.get('username'), password=__mysql__.get('password'), port=__mysql__.get('port'), db_name=db_name, sql_file=sql_file))
-    use_time = math.floor(time.time() - start_time)
-    message = "dump mysql data [{db_name}] to {sql_file}, use seconds:  {second}s".format(db_name=db_name, sql_file=sql_file, second=use_time)
+    with StageTimer('dump', sql_file) as stage:
+        # close() 会等待 mysqldump 结束，否则统计到的只是启动命令的时间
+        os.popen("mysqldump -u {username} -p{password} -P {port} {db_name} > {sql_file}"
+                 .format(username=__mysql__.get('username'), password=__mysql__.get('password'), port=__mysql__.get('port'), db_name=db_name, sql_file=sql_file)).close()
+        stage.bytes_out = os.path.getsize(sql_file)
+    message = "dump mysql data [{db_name}] to {sql_file}, {summary}".format(db_name=db_name, sql_file=sql_file, summary=stage.summary())
     write_log(message)
     sql_file_size = os.path.getsize(sql_file)
     # 如果备份文件小于10Kb，则认为数据dump失败。 当dump数据库不存在时，会dump出没有数据的sql文件
@@ -224,6 +588,73 @@ def dump_mysql(sql_file, db_name):
     return sql_file
 
 
+def get_db_size(db_name):
+    """
+    通过 information_schema 估算数据库的数据大小（数据 + 索引），作为导出 sql 文件大小的预估值
+    :param db_name: 数据库名
+    :return: 字节数
+    """
+    sql = "SELECT IFNULL(SUM(data_length + index_length), 0) FROM information_schema.TABLES WHERE table_schema = '{db_name}'" \
+        .format(db_name=db_name)
+    process = subprocess.Popen(['mysql', '-u', __mysql__.get('username'), '-p{}'.format(__mysql__.get('password')),
+                                '-P', str(__mysql__.get('port')), '-N', '-B', '-e', sql], stdout=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise Exception("query mysql data size fail, db:{db_name}".format(db_name=db_name))
+    return int(float(out.strip() or 0))
+
+
+def get_free_space(path):
+    """
+    路径所在磁盘的剩余可用空间（即 df 的 Avail）
+    :param path:
+    :return: 字节数
+    """
+    disk = os.statvfs(path)
+    return disk.f_bavail * disk.f_frsize
+
+
+@log_exception
+def check_scratch_space(scratch_dir, db_name):
+    """
+    备份前的临时空间预检：导出的 sql 文件在打包后马上删除，所以同时存在的临时文件最多为
+    sql 文件 + 已经生成的压缩包，或者所有的压缩包 + 最终的 zip 文件
+    :param scratch_dir: 临时目录
+    :param db_name: 需要导出的数据库名
+    :return: 可用的临时空间
+    """
+    db_size = get_db_size(db_name)
+    source_size = db_size
+    for files in __backup__.values():
+        source_size += get_path_size([f for f in files if os.path.lexists(f)])
+    compressed_size = source_size * __scratch__.get('compress_ratio', 1.0)
+    need_size = int(max(db_size + compressed_size, compressed_size * 2))
+
+    free_size = get_free_space(scratch_dir) - __scratch__.get('reserve', 0)
+    budget = max(0, min(free_size, __scratch__.get('budget')) if __scratch__.get('budget') else free_size)
+    message = "scratch preflight, source size: {source_size}, budget: {budget}, need: {need_size}" \
+        .format(source_size=human_size(source_size), budget=human_size(budget), need_size=human_size(need_size))
+    write_log(message)
+    if need_size > budget:
+        raise Exception('not enough scratch space, ' + message)
+    return budget
+
+
+@log_exception
+def check_scratch_usage(scratch_dir, budget, next_size=0):
+    """
+    检查临时目录的占用加上下一步将要生成的文件大小是否超过临时空间预算，超过时停止备份，避免把磁盘写满
+    :param scratch_dir: 临时目录
+    :param budget: 临时空间预算
+    :param next_size: 下一步将要生成的文件的预估大小
+    :return:
+    """
+    used_size = get_path_size([scratch_dir])
+    if used_size + next_size > budget:
+        raise Exception('scratch space exceeds budget, used: {used_size}, next: {next_size}, budget: {budget}'
+                        .format(used_size=human_size(used_size), next_size=human_size(next_size), budget=human_size(budget)))
+
+
 if __name__ == "__main__":
     write_log("=========================== start : backup data ==========================")
 
@@ -231,13 +662,15 @@ if __name__ == "__main__":
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
     archive_file_list = []
+    profiling = start_profiling()
 
     try:
         bak_time = time.strftime('%Y%m%d%H%M')
 
-        # 0, 导出数据库数据并添加到备份列表中
-        sql_file = os.path.join(data_dir, '<hidden>_{bak_time}.sql'.format(bak_time=time.strftime('%Y%m%d%H%M')))
+        # 0, 临时空间预检，导出数据库数据并添加到备份列表中
         db_name = '<hidden>'
+        scratch_budget = check_scratch_space(data_dir, db_name)
+        sql_file = os.path.join(data_dir, '<hidden>_{bak_time}.sql'.format(bak_time=time.strftime('%Y%m%d%H%M')))
         dump_mysql(sql_file, db_name)
         __backup__.get('mysql').append(sql_file)
 
@@ -246,10 +679,18 @@ if __name__ == "__main__":
             archive_name = os.path.join(data_dir, '{base_name}_{bak_time}.tar.gz'.format(base_name=archive_name, bak_time=bak_time))
             tar_gz_file(archive_name, files)
             archive_file_list.append(archive_name)
+            if sql_file in files:
+                # sql 文件已经打包，马上删除，不等到备份结束
+                os.remove(sql_file)
+            check_scratch_usage(data_dir, scratch_budget)
 
-        # 2，打包并加密所有的已打包的备份文件
+        # 2，打包并加密所有的已打包的备份文件（zip 文件大小和各压缩包的总大小相当）
+        check_scratch_usage(data_dir, scratch_budget, get_path_size(archive_file_list))
         bak_file = os.path.join(data_dir, '<hidden>_{bak_time}.zip'.format(bak_time=bak_time))
         zip_file(bak_file, archive_file_list, password=__archive_password__)
+        # 各压缩包已经打包进 zip 文件，马上删除
+        for archive_name in archive_file_list:
+            os.remove(archive_name)
 
         # 3、上传到阿里云对象存储（oss）服务器。
         # 备注：当前阿里云的归档存储服务没有提供归档文件相应的查看和下载界面，所以这里用oss来存储备份文件，
@@ -280,6 +721,7 @@ if __name__ == "__main__":
     finally:
         # 5，删除备份过程中的中间文件
         shutil.rmtree(data_dir)
+        stop_profiling(profiling)
 
     write_log("=========================== end : backup data ==========================")
 
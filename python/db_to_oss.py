@@ -1,14 +1,30 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import argparse
+import atexit
+import binascii
+import cProfile
+import fnmatch
+import gzip
+import importlib.util
+import json
 import math
 import os
+import pstats
+import queue
+import re
 import shutil
+import signal
 import smtplib
+import socket
 import subprocess
 import sys
+import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from tarfile import TarFile
 
 import oss2
@@ -19,12 +35,91 @@ _config_ = {
         'access_secret': '<hidden>',
         'oss_endpoint': 'http://oss-cn-beijing.aliyuncs.com',
         'oss_bucket': '<hidden>',
+        # 文件大于该值时采用分片并发上传，否则直接 put_object
+        'multipart_threshold': 100 * 1024 * 1024,
+        'part_size': 10 * 1024 * 1024,
+        'num_threads': 4,
+        # 分片上传中断后的重试次数，重试时从本地断点记录处继续上传
+        'upload_retry': 3,
+        # 上传的总带宽上限（字节/秒），同时上传的所有文件共用，0 为不限制
+        'bandwidth': 0
     },
     "mysql": {
         'username': '<hidden>',
         'password': '<hidden>',
         'port': '3306'
     },
+    # binlog 增量备份：定期做一次整库基础备份，之后只上传新切换出来的 binlog 文件，支持恢复到任意时间点
+    "binlog": {
+        # 距离上一次基础备份超过该小时数时重新做基础备份
+        "base_interval_hours": 24,
+        # 每次运行先 FLUSH BINARY LOGS，把当前 binlog 中的变更也切换出来上传
+        "flush_logs": True,
+        # 本地记录已上传 binlog 文件的状态文件（相对脚本目录）
+        "state_file": "binlog_state.json"
+    },
+    # 并行导出：多个连接在同一个一致性快照中按表（大表按主键范围切分）并行导出，需要 pymysql
+    "parallel_dump": {
+        "enabled": False,
+        "threads": 4,
+        # 行数超过该值并且是单列整数主键的表按主键范围切分成多个文件
+        "chunk_rows": 1000000,
+        # 每条 INSERT 语句的大概大小
+        "insert_batch_bytes": 1024 * 1024
+    },
+    # 临时空间：每个数据库备份前根据数据库大小预估需要的临时空间，多个数据库同时备份时占用的临时空间总和不超过预算
+    "scratch": {
+        # 配置的导出方式放不下时自动改用流式导出（只生成最终的 7z 文件）
+        "auto_stream": True,
+        # 临时空间上限（字节），0 为不限制（只受磁盘剩余空间限制）
+        "budget": 0,
+        # 磁盘上至少保留的剩余空间
+        "reserve": 1024 * 1024 * 1024,
+        # 预估的压缩率（压缩后/压缩前），按偏大取值
+        "compress_ratio": 0.5
+    },
+    # 备份阶段的指标和性能分析（文件路径相对脚本目录）
+    "metrics": {
+        # 每个备份阶段（导出、打包、加密压缩、上传）一行 JSON 记录，为空时不记录
+        "json_file": "backup_metrics.jsonl",
+        # node_exporter textfile collector 目录下的 .prom 文件，为空时不输出，比如 /var/lib/node_exporter/textfile_collector/db_backup.prom
+        "prom_file": "",
+        # cProfile 结果文件，为空时不开启
+        "profile_file": "",
+        # 采样式 profiler 的采样间隔（秒），0 为不开启
+        "sample_interval": 0,
+        "sample_file": "backup_stacks.folded"
+    },
+    # 运行环境检查：只安装缺少的 python 包和命令，检查通过后缓存结果，缓存有效期内不再检查（文件路径相对脚本目录）
+    "runtime_env": {
+        "cache_file": "runtime_env.json",
+        "cache_hours": 24
+    },
+    # 常驻调度（--daemon）：代替每个备份脚本单独的 cron 任务，配置只加载一次、运行环境只检查一次，按计划运行备份任务
+    "scheduler": {
+        # 检查到期任务的间隔（秒）
+        "tick_seconds": 30,
+        # 同时运行的任务数（数据库备份和 binlog 备份在同一进程内运行，它们之间不会同时运行）
+        "max_jobs": 2,
+        # 资源预算：1 分钟平均负载（按 cpu 核数折算）超过 max_load，或者 io 压力（/proc/pressure/io 的 some avg10，百分比）
+        # 超过 max_io_pressure 时推迟启动新任务，0 为不限制
+        "max_load": 0.8,
+        "max_io_pressure": 20,
+        # 调度进程及其启动的 mysqldump、7z、备份脚本等子进程的 nice 值和 io 优先级（ionice -c2 -n），为空时不调整
+        "nice": 10,
+        "ionice": 7,
+        # 任务状态文件（相对脚本目录），任务状态变化时写入，并上传到oss的 scheduler/{host_ip}.json，--status 汇总查看各主机的任务状态
+        "state_file": "scheduler_state.json",
+        # 大于 0 时在该端口提供任务状态接口：GET /jobs
+        "status_port": 0,
+        # type：mysql（db_names 为空时备份 db_include/db_exclude 匹配的所有数据库）、binlog、command（运行其他备份脚本，比如文件备份）
+        # 计划：at 为每天运行的时间点（%H:%M），或者 interval_minutes 为运行间隔
+        "jobs": [
+            {"name": "mysql", "type": "mysql", "db_names": [], "at": "02:00"},
+            {"name": "binlog", "type": "binlog", "interval_minutes": 60, "enabled": False},
+            {"name": "files", "type": "command", "command": ["python2", "bak_to_aliyun.py"], "at": "03:00", "enabled": False}
+        ]
+    },
     "email": {
         "smtp": {
             'server': "smtp.163.com",
@@ -36,12 +131,45 @@ _config_ = {
     "backup": {
         "host_ip": "<hidden>",
         "compress_pwd": "<hidden>",
-        "email_addressee": ["<hidden>"]
+        "email_addressee": ["<hidden>"],
+        # 流式备份：mysqldump 的输出直接通过管道压缩加密，不在磁盘上生成中间 sql 文件。
+        # 开启后备份文件从 .zip 变为 .7z（恢复时需要 7z 解压），默认关闭以保持原有的备份文件格式
+        "stream_dump": False,
+        # 使用 --all 自动发现数据库时的包含/排除规则（fnmatch 通配符）
+        "db_include": ["*"],
+        "db_exclude": ["information_schema", "performance_schema", "mysql", "sys"],
+        # 多数据库并发备份时，导出、压缩、上传各阶段的并发数
+        "dump_workers": 2,
+        "compress_workers": 4,
+        "upload_workers": 2
     }
 }
 
 CURR_DIR = os.path.dirname(os.path.abspath(__file__))
 _backup_db_ = ""
+# 为 False 时出错不再单独发送邮件，由备份汇总邮件统一通知
+_email_on_exception_ = True
+# 各备份阶段的并发数限制，见 init_stage_limits
+_stage_limits_ = {}
+# 共用的 oss2.Bucket 和 smtp 连接，见 get_oss_bucket、get_smtp_server
+_oss_bucket_ = None
+_smtp_server_ = None
+_client_lock_ = threading.Lock()
+_smtp_lock_ = threading.Lock()
+# 本次运行的临时空间预算，见 init_scratch_budget
+_scratch_budget_ = None
+# 流式备份时每次从 mysqldump 管道读取的数据块大小
+STREAM_CHUNK_SIZE = 1024 * 1024
+# 本次运行各备份阶段的指标记录，见 StageTimer
+_stage_records_ = []
+_stage_lock_ = threading.Lock()
+# 所有上传共用的带宽限制，见 get_upload_limiter
+_upload_limiter_ = None
+# 运行环境需要的 python 包（模块名: pip 包名）和命令（命令: apt 包名），见 get_runtime_packages
+RUNTIME_PACKAGES = {'oss2': 'oss2'}
+# 开启 parallel_dump 时才需要的 python 包
+PARALLEL_DUMP_PACKAGES = {'pymysql': 'pymysql'}
+RUNTIME_COMMANDS = {'7z': 'p7zip-full'}
 
 
 def get_compress_pwd():
@@ -56,11 +184,80 @@ def get_email_addressee():
     return _config_.get("backup", {}).get("email_addressee", [])
 
 
+def get_stage_workers(stage):
+    return max(1, int(_config_.get("backup", {}).get("{}_workers".format(stage), 1)))
+
+
+def get_metrics_config():
+    metrics_config = dict(_config_.get("metrics", {}))
+    for name in ("json_file", "prom_file", "profile_file", "sample_file"):
+        if metrics_config.get(name):
+            metrics_config[name] = os.path.join(CURR_DIR, metrics_config[name])
+    return metrics_config
+
+
+def get_scratch_dir():
+    return os.path.join(CURR_DIR, 'tmp_data')
+
+
+def is_stream_dump():
+    return bool(_config_.get("backup", {}).get("stream_dump", False))
+
+
+def get_runtime_packages():
+    """
+    按配置得到需要的 python 包：pymysql 只在开启 parallel_dump 时才需要
+    :return: {模块名: pip 包名}
+    """
+    packages = dict(RUNTIME_PACKAGES)
+    if _config_.get("parallel_dump", {}).get("enabled"):
+        packages.update(PARALLEL_DUMP_PACKAGES)
+    return packages
+
+
+def check_runtime_env():
+    """
+    检查运行环境缺少的 python 包和命令
+    :return: (缺少的 pip 包名列表, 缺少的 apt 包名列表)
+    """
+    importlib.invalidate_caches()
+    packages = [package for module, package in sorted(get_runtime_packages().items()) if importlib.util.find_spec(module) is None]
+    commands = [package for command, package in sorted(RUNTIME_COMMANDS.items()) if shutil.which(command) is None]
+    return packages, commands
+
+
 def prepare_runtime_env():
+    """
+    准备运行环境：只安装缺少的 python 包和命令。检查通过后把结果缓存到 cache_file，
+    缓存有效期内（同一个 python、需要的包相同）直接跳过，不再每次运行都执行 pip install、apt-get install
+    """
+    env_config = _config_.get("runtime_env", {})
+    cache_file = os.path.join(CURR_DIR, env_config.get("cache_file", "runtime_env.json"))
+    required = sorted(get_runtime_packages().values())
     try:
-        subprocess.call(['pip', 'install', 'oss2'])
-        subprocess.call(['apt-get', 'install', 'p7zip-full'])
-    except:
+        with open(cache_file) as f:
+            cache = json.load(f)
+        if cache.get("python") == sys.executable and cache.get("packages") == required and \
+                time.time() - cache.get("check_time", 0) < float(env_config.get("cache_hours", 24)) * 3600:
+            return
+    except (IOError, ValueError):
+        pass
+
+    try:
+        packages, commands = check_runtime_env()
+        if packages:
+            subprocess.call([sys.executable, '-m', 'pip', 'install'] + packages)
+        if commands:
+            subprocess.call(['apt-get', 'install', '-y'] + commands)
+        packages, commands = check_runtime_env()
+        if packages or commands:
+            # 安装失败时不缓存，下次运行时重新检查
+            write_log("prepare_runtime_env, missing: {}".format(",".join(packages + commands)))
+            return
+        with open(cache_file + '.tmp', 'w') as f:
+            json.dump({"python": sys.executable, "packages": required, "check_time": time.time()}, f)
+        os.rename(cache_file + '.tmp', cache_file)
+    except Exception:
         write_log("prepare_runtime_env fail")
 
 
@@ -96,7 +293,8 @@ def human_size(nbytes):
 
 def log_exception(func):
     """
-    记录异常到日志的装饰器函数， 在函数定义前面实用@log_exception 来装饰函数， 这样函数的异常信息会记录到日志文件中
+    记录异常到日志的装饰器函数， 在函数定义前面实用@log_exception 来装饰函数， 这样函数的异常信息会记录到日志文件中。
+    同一个异常只记录和通知一次（被装饰的函数调用了其他被装饰的函数时，异常在内层已经记录过）
     :param func:
     :return:
     """
@@ -105,8 +303,13 @@ def log_exception(func):
         try:
             return func(*args, **kw)
         except Exception as e:
+            if getattr(e, 'exception_logged', False):
+                raise
+            e.exception_logged = True
             exc_track_info = traceback.format_exc()
             write_log(exc_track_info)
+            if not _email_on_exception_:
+                raise e
 
             subject = u'[X] 数据备份失败({}/{})'.format(get_host_ip(), _backup_db_)
             content = u'''
@@ -118,6 +321,267 @@ def log_exception(func):
     return wrapper
 
 
+def get_path_size(file_path_list):
+    """
+    统计文件和目录的总大小（不跟随软链接）
+    :param file_path_list: 文件路径名所组成的数组
+    :return: 字节数
+    """
+    total_size = 0
+    for file_path in file_path_list:
+        if os.path.islink(file_path) or not os.path.isdir(file_path):
+            total_size += os.lstat(file_path).st_size
+            continue
+        for root, dirs, files in os.walk(file_path):
+            for name in files:
+                try:
+                    total_size += os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+    return total_size
+
+
+def cpu_seconds():
+    """
+    当前进程以及已经结束的子进程（mysqldump、7z 等）的 CPU 时间（用户态 + 内核态）
+    :return:
+    """
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+class StageTimer(object):
+    """
+    记录一个备份阶段的墙钟时间、CPU 时间、输入输出字节数、压缩比和吞吐率，结束时由 record_stage 输出。
+    CPU 时间是进程级别的，多个阶段并发执行时会互相包含
+        with StageTimer('tar', name) as stage:
+            ...
+            stage.bytes_in = ...
+            stage.bytes_out = ...
+    """
+
+    def __init__(self, stage, target):
+        self.stage = stage
+        self.target = target
+        self.bytes_in = None
+        self.bytes_out = None
+        self.wall_seconds = 0
+        self.cpu_seconds = 0
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.start_cpu = cpu_seconds()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.wall_seconds = time.time() - self.start_time
+        self.cpu_seconds = cpu_seconds() - self.start_cpu
+        try:
+            record_stage(self, exc_type is None)
+        except Exception:
+            write_log("record stage metrics fail: {}".format(traceback.format_exc()))
+        return False
+
+    def get_ratio(self):
+        if self.bytes_in and self.bytes_out:
+            return float(self.bytes_in) / self.bytes_out
+        return None
+
+    def get_speed(self):
+        """
+        吞吐率（MB/s），按输入字节数计算，没有输入字节数时按输出字节数计算
+        :return:
+        """
+        nbytes = self.bytes_in if self.bytes_in is not None else self.bytes_out
+        if nbytes is None or self.wall_seconds <= 0:
+            return None
+        return nbytes / 1024.0 / 1024.0 / self.wall_seconds
+
+    def summary(self):
+        items = ["use seconds:  {:.2f}s".format(self.wall_seconds), "cpu: {:.2f}s".format(self.cpu_seconds)]
+        if self.bytes_in is not None:
+            items.append("in: {}".format(human_size(self.bytes_in)))
+        if self.bytes_out is not None:
+            items.append("out: {}".format(human_size(self.bytes_out)))
+        if self.get_ratio():
+            items.append("ratio: {:.2f}".format(self.get_ratio()))
+        if self.get_speed() is not None:
+            items.append("speed: {:.2f} MB/s".format(self.get_speed()))
+        return ", ".join(items)
+
+
+def record_stage(stage, success):
+    """
+    输出阶段指标：追加一行 JSON 到 json_file，并重写 prom_file（node_exporter 的 textfile collector 格式）
+    :param stage: StageTimer
+    :param success: 阶段是否成功
+    :return:
+    """
+    metrics_config = get_metrics_config()
+    record = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'stage': stage.stage,
+        'target': stage.target,
+        'success': success,
+        'wall_seconds': round(stage.wall_seconds, 3),
+        'cpu_seconds': round(stage.cpu_seconds, 3),
+        'bytes_in': stage.bytes_in,
+        'bytes_out': stage.bytes_out,
+        'ratio': round(stage.get_ratio(), 3) if stage.get_ratio() else None,
+        'mb_per_second': round(stage.get_speed(), 3) if stage.get_speed() is not None else None,
+    }
+    with _stage_lock_:
+        _stage_records_.append(record)
+        if metrics_config.get('json_file'):
+            with open(metrics_config.get('json_file'), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        if metrics_config.get('prom_file'):
+            write_stage_prom(metrics_config.get('prom_file'))
+
+
+def reset_stage_records():
+    """
+    开始一次备份时清空之前的阶段记录（常驻调度时进程不退出），prom 文件中的指标只统计本次备份
+    """
+    with _stage_lock_:
+        del _stage_records_[:]
+
+
+def write_stage_prom(prom_file):
+    """
+    把本次备份各阶段的指标（按阶段汇总）写入 prom 文件，先写临时文件再改名，避免 node_exporter 读到不完整的文件
+    :param prom_file:
+    :return:
+    """
+    script = os.path.splitext(os.path.basename(__file__))[0]
+    stages = {}
+    for record in _stage_records_:
+        values = stages.setdefault(record['stage'], {'count': 0, 'failures': 0, 'wall_seconds': 0, 'cpu_seconds': 0,
+                                                      'bytes_in': 0, 'bytes_out': 0})
+        values['count'] += 1
+        values['failures'] += 0 if record['success'] else 1
+        for name in ('wall_seconds', 'cpu_seconds', 'bytes_in', 'bytes_out'):
+            values[name] += record[name] or 0
+    lines = []
+    for name, help_text in (('count', 'stage runs'), ('failures', 'failed stage runs'),
+                            ('wall_seconds', 'stage wall clock seconds'), ('cpu_seconds', 'stage cpu seconds'),
+                            ('bytes_in', 'stage input bytes'), ('bytes_out', 'stage output bytes')):
+        lines.append('# HELP backup_stage_{} {}'.format(name, help_text))
+        lines.append('# TYPE backup_stage_{} gauge'.format(name))
+        for stage in sorted(stages.keys()):
+            lines.append('backup_stage_{}{{script="{}",stage="{}"}} {}'.format(name, script, stage, stages[stage][name]))
+    lines.append('# TYPE backup_last_stage_timestamp_seconds gauge')
+    lines.append('backup_last_stage_timestamp_seconds{{script="{}"}} {}'.format(script, int(time.time())))
+    with open(prom_file + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(prom_file + '.tmp', prom_file)
+
+
+class StackSampler(threading.Thread):
+    """
+    采样式 profiler：每隔 interval 秒抓取一次所有线程的调用栈并计数，结果为 folded stacks 格式（每行 "栈;栈 次数"），
+    可以用 flamegraph.pl 生成火焰图，开销只跟采样间隔有关，适合长时间运行的备份
+    """
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.stacks = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        own_id = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self, out_file):
+        self.stopped.set()
+        self.join()
+        with open(out_file, 'w') as f:
+            for key, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write('{} {}\n'.format(key, count))
+
+
+class ThreadProfiler(object):
+    """
+    统计所有线程的 cProfile：python 3.12 之前 cProfile 只统计开启它的线程，而导出、压缩、上传都在线程池中运行，
+    因此通过 threading.setprofile 给之后启动的每个线程各开启一个 cProfile，保存时用 pstats 合并。
+    python 3.12 起 cProfile 基于 sys.monitoring，一个 cProfile 就能统计所有线程（同时也不能再开启第二个）
+    """
+
+    def __init__(self):
+        self.profiles = [cProfile.Profile()]
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.profiles[0].enable()
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._start_thread)
+
+    def disable(self):
+        threading.setprofile(None)
+        self.profiles[0].disable()
+
+    def dump_stats(self, file_name):
+        with self.lock:
+            stats = pstats.Stats(self.profiles[0])
+            for profile in self.profiles[1:]:
+                stats.add(profile)
+        stats.dump_stats(file_name)
+
+    def _start_thread(self, frame, event, arg):
+        # 新线程中的第一个事件：换成该线程自己的 cProfile
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+
+def start_profiling():
+    """
+    按配置开启 cProfile（profile_file）和采样式 profiler（sample_interval），默认都不开启
+    :return: (ThreadProfiler, StackSampler)
+    """
+    metrics_config = get_metrics_config()
+    profile = None
+    sampler = None
+    if metrics_config.get('profile_file'):
+        profile = ThreadProfiler()
+        profile.enable()
+    if metrics_config.get('sample_interval'):
+        sampler = StackSampler(float(metrics_config.get('sample_interval')))
+        sampler.start()
+    return profile, sampler
+
+
+def stop_profiling(profiling):
+    """
+    停止 profiler 并保存结果（cProfile 结果可以用 python -m pstats 查看）
+    :param profiling: start_profiling 的返回值
+    :return:
+    """
+    metrics_config = get_metrics_config()
+    profile, sampler = profiling
+    if profile:
+        profile.disable()
+        profile.dump_stats(metrics_config.get('profile_file'))
+        write_log("cProfile stats saved to {}".format(metrics_config.get('profile_file')))
+    if sampler:
+        sampler.stop(metrics_config.get('sample_file'))
+        write_log("sampled stacks ({} kinds) saved to {}".format(len(sampler.stacks), metrics_config.get('sample_file')))
+
+
 @log_exception
 def tar_gz_file(name, file_path_list):
     """
@@ -130,14 +594,15 @@ def tar_gz_file(name, file_path_list):
         if not os.path.exists(file_path):
             raise Exception('file is not exist: {file_path}'.format(file_path=file_path))
 
-    start_time = time.time()
-    tarfile = TarFile.open(name, "w:gz")
-    for file_path in file_path_list:
-        tarfile.add(file_path)
-    tarfile.close()
-    use_time = math.floor(time.time() - start_time)
+    with StageTimer('tar', name) as stage:
+        tarfile = TarFile.open(name, "w:gz")
+        for file_path in file_path_list:
+            tarfile.add(file_path)
+        tarfile.close()
+        stage.bytes_in = get_path_size(file_path_list)
+        stage.bytes_out = os.path.getsize(name)
 
-    message = "tar and gz file [{file_name}], use seconds:  {second}s".format(file_name=name, second=use_time)
+    message = "tar and gz file [{file_name}], {summary}".format(file_name=name, summary=stage.summary())
     write_log(message)
 
 
@@ -154,26 +619,100 @@ def zip_file(name, file_path_list, password=None):
         if not os.path.exists(file_path):
             raise Exception('file is not exist: {file_path}'.format(file_path=file_path))
 
-    start_time = time.time()
-    os_command = ['7z', 'a', '-y']
-    if password:
-        os_command.append("-p{password}".format(password=password))
-    os_command.append(name)
+    with StageTimer('zip', name) as stage:
+        os_command = ['7z', 'a', '-y']
+        if password:
+            os_command.append("-p{password}".format(password=password))
+        os_command.append(name)
 
-    for file_path in file_path_list:
-        os_command.append(file_path)
+        for file_path in file_path_list:
+            os_command.append(file_path)
 
-    rc = subprocess.call(os_command)
-    use_time = math.floor(time.time() - start_time)
-    message = "zip file [{file_name}], use seconds:  {second}s".format(file_name=name, second=use_time)
+        rc = subprocess.call(os_command)
+        stage.bytes_in = get_path_size(file_path_list)
+        stage.bytes_out = os.path.getsize(name) if os.path.exists(name) else None
+    message = "zip file [{file_name}], {summary}".format(file_name=name, summary=stage.summary())
     write_log(message)
 
 
+def get_oss_bucket():
+    """
+    获取共用的 oss2.Bucket：同一次运行中所有的上传、下载共用一个连接池，复用已经建立的 HTTP 连接，
+    连接池大小按多个数据库同时分片上传的总线程数设置
+    :return: oss2.Bucket
+    """
+    global _oss_bucket_
+    with _client_lock_:
+        if _oss_bucket_ is None:
+            oss_config = _config_.get("oss")
+            if not oss_config:
+                raise Exception('oss config miss!')
+            pool_size = max(oss2.defaults.connection_pool_size,
+                            int(oss_config.get('num_threads', 4)) * get_stage_workers('upload'))
+            auth = oss2.Auth(oss_config.get('access_key'), oss_config.get('access_secret'))
+            _oss_bucket_ = oss2.Bucket(auth, oss_config.get('oss_endpoint'), oss_config.get('oss_bucket'),
+                                       session=oss2.Session(pool_size=pool_size))
+        return _oss_bucket_
+
+
+class RateLimiter(object):
+    """
+    令牌桶限速：多个线程共用，按字节数申请，超过速率时等待（最多允许 1 秒的突发）
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def consume(self, nbytes):
+        with self.lock:
+            now = time.time()
+            self.next_time = max(self.next_time, now - 1) + nbytes / self.rate
+            wait = self.next_time - now
+        if wait > 0:
+            time.sleep(wait)
+
+
+def get_upload_limiter():
+    """
+    获取所有上传共用的带宽限制（oss.bandwidth），没有配置时返回 None
+    """
+    global _upload_limiter_
+    bandwidth = int(_config_.get("oss", {}).get("bandwidth", 0))
+    if not bandwidth:
+        return None
+    with _client_lock_:
+        if _upload_limiter_ is None:
+            _upload_limiter_ = RateLimiter(bandwidth)
+        return _upload_limiter_
+
+
+def get_upload_progress_callback():
+    """
+    上传进度回调：按已发送的字节数向共用的带宽限制申请，超过带宽时在回调中等待，从而降低发送速度
+    :return: oss2 的 progress_callback，没有配置带宽限制时返回 None
+    """
+    limiter = get_upload_limiter()
+    if limiter is None:
+        return None
+    sent = [0]
+
+    def progress_callback(consumed_bytes, total_bytes):
+        # 分片上传重试时已发送的字节数会从断点处重新计算，只对增加的部分限速
+        if consumed_bytes > sent[0]:
+            limiter.consume(consumed_bytes - sent[0])
+        sent[0] = consumed_bytes
+
+    return progress_callback
+
+
 @log_exception
-def upload_to_aliyun_oss(file_path):
+def upload_to_aliyun_oss(file_path, oss_key=None):
     """
     上传文件到阿里云对象存储服务器(oss)
     :param file_path: 文件路径名
+    :param oss_key: 对象名，为空时为 {host_ip}/{文件名}
     :return:
     """
     if not os.path.exists(file_path):
@@ -183,21 +722,103 @@ def upload_to_aliyun_oss(file_path):
     if not oss_config:
         raise Exception('oss config miss!')
 
-    host_ip = get_host_ip()
-    oss_key = "{}/{}".format(host_ip, os.path.basename(file_path))
+    if not oss_key:
+        oss_key = "{}/{}".format(get_host_ip(), os.path.basename(file_path))
 
-    start_time = time.time()
-    auth = oss2.Auth(oss_config.get('access_key'), oss_config.get('access_secret'))
-    bucket = oss2.Bucket(auth, oss_config.get('oss_endpoint'), oss_config.get('oss_bucket'))
-    with open(file_path, 'rb') as f:
-        bucket.put_object(oss_key, f)
+    with StageTimer('upload', file_path) as stage:
+        bucket = get_oss_bucket()
+        stage.bytes_in = stage.bytes_out = os.path.getsize(file_path)
+        if stage.bytes_in < oss_config.get('multipart_threshold', 100 * 1024 * 1024):
+            with open(file_path, 'rb') as f:
+                bucket.put_object(oss_key, f, progress_callback=get_upload_progress_callback())
+        else:
+            resumable_upload_to_oss(bucket, oss_key, file_path, oss_config)
 
-    use_time = math.floor(time.time() - start_time)
-    message = "upload file to aliyun success,  oss-key {}, file: {}, use seconds:  {}s".format(oss_key, file_path, use_time)
+    message = "upload file to aliyun success,  oss-key {}, file: {}, {}".format(oss_key, file_path, stage.summary())
     write_log(message)
     return oss_key
 
 
+def abort_resumable_upload(bucket, oss_key, file_path, store):
+    """
+    放弃断点续传：取消 oss 上未完成的分片上传（避免残留分片占用存储），并删除本地断点文件
+    :param bucket: oss2.Bucket
+    :param oss_key: 对象名
+    :param file_path: 文件路径名
+    :param store: oss2.ResumableStore
+    :return:
+    """
+    store_key = store.make_store_key(bucket.bucket_name, oss_key, os.path.abspath(file_path))
+    record = store.get(store_key)
+    if not record:
+        return
+    try:
+        bucket.abort_multipart_upload(oss_key, record['upload_id'])
+    except oss2.exceptions.OssError as e:
+        write_log("abort multipart upload failed, oss-key {}: {}".format(oss_key, e))
+    store.delete(store_key)
+
+
+def resumable_upload_to_oss(bucket, oss_key, file_path, oss_config):
+    """
+    分片并发上传大文件。已完成的分片记录在本地断点文件中，上传中断后重试时只上传剩余的分片。
+    断点只在本次运行的重试之间有效（断点按本地文件路径记录，而备份文件名带有备份时间且失败后会被删除），
+    重试全部失败时取消 oss 上未完成的分片上传并删除断点文件
+    :param bucket: oss2.Bucket
+    :param oss_key: 对象名
+    :param file_path: 文件路径名
+    :param oss_config: oss 配置（分片大小、并发数、重试次数）
+    :return:
+    """
+    store = oss2.ResumableStore(root=CURR_DIR, dir='oss_checkpoint')
+    retry = max(1, int(oss_config.get('upload_retry', 3)))
+    for i in range(retry):
+        try:
+            oss2.resumable_upload(bucket, oss_key, file_path, store=store,
+                                  multipart_threshold=oss_config.get('multipart_threshold', 100 * 1024 * 1024),
+                                  part_size=oss_config.get('part_size', 10 * 1024 * 1024),
+                                  num_threads=oss_config.get('num_threads', 4),
+                                  progress_callback=get_upload_progress_callback())
+            return
+        except oss2.exceptions.OssError as e:
+            if i == retry - 1:
+                abort_resumable_upload(bucket, oss_key, file_path, store)
+                raise
+            write_log("multipart upload interrupted, retry({}/{}), oss-key {}: {}".format(i + 1, retry - 1, oss_key, e))
+            time.sleep(2 ** i)
+
+
+def get_smtp_server(reconnect=False):
+    """
+    获取共用的 smtp 连接：连接和登录一次，之后的邮件（比如连续的失败通知）都复用该连接，程序退出时关闭
+    :param reconnect: 为 True 时丢弃已有的连接重新连接
+    :return: smtplib.SMTP_SSL
+    """
+    global _smtp_server_
+    if _smtp_server_ is not None and not reconnect:
+        return _smtp_server_
+    close_smtp_server()
+    smtp_config = _config_.get("email", {}).get("smtp")
+    if not smtp_config:
+        raise Exception('email smtp config miss')
+    server = smtplib.SMTP_SSL(smtp_config.get('server'), smtp_config.get('port'), timeout=10)
+    server.login(smtp_config.get('username'), smtp_config.get('password'))
+    _smtp_server_ = server
+    return server
+
+
+@atexit.register
+def close_smtp_server():
+    global _smtp_server_
+    if _smtp_server_ is None:
+        return
+    try:
+        _smtp_server_.quit()
+    except (smtplib.SMTPException, socket.error):
+        pass
+    _smtp_server_ = None
+
+
 def send_email(subject, content, to_addrs):
     """
     邮件发送
@@ -218,10 +839,12 @@ def send_email(subject, content, to_addrs):
     msg['To'] = ' , '.join(to_addrs)
     msg['Subject'] = subject
 
-    server = smtplib.SMTP_SSL(smtp_config.get('server'), smtp_config.get('port'), timeout=10)
-    server.login(smtp_config.get('username'), smtp_config.get('password'))
-    server.sendmail(smtp_config.get('username'), to_addrs, msg.as_string())
-    server.quit()
+    with _smtp_lock_:
+        try:
+            get_smtp_server().sendmail(smtp_config.get('username'), to_addrs, msg.as_string())
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            # 复用的连接已经被服务器关闭（比如空闲超时），重新连接后再发送一次
+            get_smtp_server(reconnect=True).sendmail(smtp_config.get('username'), to_addrs, msg.as_string())
 
     message = "send email to {to_addrs}".format(to_addrs=str(to_addrs))
     write_log(message)
@@ -239,11 +862,12 @@ def dump_mysql(sql_file, db_name):
     if not db_name:
         raise Exception("db_name miss")
 
-    start_time = time.time()
-    os.popen("mysqldump -u {username} -p{password} -P {port} {db_name} > {sql_file}"
-             .format(username=mysql_config.get('username'), password=mysql_config.get('password'), port=mysql_config.get('port'), db_name=db_name, sql_file=sql_file))
-    use_time = math.floor(time.time() - start_time)
-    message = "dump mysql data [{db_name}] to {sql_file}, use seconds:  {second}s".format(db_name=db_name, sql_file=sql_file, second=use_time)
+    with StageTimer('dump', sql_file) as stage:
+        # close() 会等待 mysqldump 结束，否则统计到的只是启动命令的时间
+        os.popen("mysqldump -u {username} -p{password} -P {port} {db_name} > {sql_file}"
+                 .format(username=mysql_config.get('username'), password=mysql_config.get('password'), port=mysql_config.get('port'), db_name=db_name, sql_file=sql_file)).close()
+        stage.bytes_out = os.path.getsize(sql_file)
+    message = "dump mysql data [{db_name}] to {sql_file}, {summary}".format(db_name=db_name, sql_file=sql_file, summary=stage.summary())
     write_log(message)
     sql_file_size = os.path.getsize(sql_file)
     # 如果备份文件小于10Kb，则认为数据dump失败。 当dump数据库不存在时，会dump出没有数据的sql文件
@@ -252,57 +876,1227 @@ def dump_mysql(sql_file, db_name):
     return sql_file
 
 
-if __name__ == "__main__":
-    write_log("=========================== start : backup data ==========================")
-    if len(sys.argv) > 1:
-        _backup_db_ = sys.argv[1]
+def stream_dump_to_7z(dump_command, inner_name, archive_file, password=None):
+    """
+    导出命令的输出通过管道直接交给 7z 压缩并加密
+    :param dump_command: 导出命令
+    :param inner_name: 压缩包中的文件名
+    :param archive_file: 压缩文件名（7z 格式）
+    :param password: 加密密码
+    :return: (导出数据大小, 导出数据开头的 64KB)
+    """
+    zip_command = ['7z', 'a', '-y', '-si{inner_name}'.format(inner_name=inner_name)]
+    if password:
+        zip_command.append("-p{password}".format(password=password))
+    zip_command.append(archive_file)
+
+    dump_process = subprocess.Popen(dump_command, stdout=subprocess.PIPE)
+    zip_process = subprocess.Popen(zip_command, stdin=subprocess.PIPE)
+    dump_size = 0
+    head = b''
+    try:
+        while True:
+            chunk = dump_process.stdout.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            zip_process.stdin.write(chunk)
+            if len(head) < 64 * 1024:
+                head += chunk[:64 * 1024 - len(head)]
+            dump_size += len(chunk)
+    except Exception:
+        dump_process.kill()
+        raise
+    finally:
+        try:
+            zip_process.stdin.close()
+        except OSError:
+            # 7z 进程异常退出时关闭管道会报 BrokenPipe，返回码在下面统一检查
+            pass
+        dump_rc = dump_process.wait()
+        zip_rc = zip_process.wait()
+
+    if dump_rc != 0 or zip_rc != 0:
+        raise Exception("stream dump fail, {inner_name}, dump rc:{dump_rc}, 7z rc:{zip_rc}"
+                        .format(inner_name=inner_name, dump_rc=dump_rc, zip_rc=zip_rc))
+    return dump_size, head
+
+
+@log_exception
+def dump_mysql_stream(archive_file, db_name, password=None):
+    """
+    流式导出数据库数据：mysqldump 的输出通过管道直接交给 7z 压缩并加密，不在磁盘上生成中间 sql 文件，
+    备份过程中占用的临时空间只有最终的压缩文件
+    :param archive_file: 压缩文件名（7z 从标准输入读取数据时只支持 7z 格式，所以文件后缀为 .7z）
+    :param db_name: 数据库名
+    :param password: 加密密码
+    :return: 压缩文件名
+    """
+    mysql_config = _config_.get("mysql", {})
+    if not mysql_config:
+        raise Exception('mysql config miss')
+
+    if not db_name:
+        raise Exception("db_name miss")
+
+    with StageTimer('dump_stream', archive_file) as stage:
+        dump_command = get_mysql_command('mysqldump') + [db_name]
+        dump_size, head = stream_dump_to_7z(dump_command, '{db_name}.sql'.format(db_name=db_name), archive_file, password)
+        stage.bytes_in = dump_size
+        stage.bytes_out = os.path.getsize(archive_file)
+
+    message = "dump mysql data [{db_name}] to {archive_file} (stream, sql size: {sql_size}), {summary}" \
+        .format(db_name=db_name, archive_file=archive_file, sql_size=human_size(dump_size), summary=stage.summary())
+    write_log(message)
+    # 如果导出数据小于10Kb，则认为数据dump失败。 当dump数据库不存在时，会dump出没有数据的sql
+    if dump_size < 10 * 1024:
+        raise Exception("mysql dump fail, db:{db_name}".format(db_name=db_name))
+    return archive_file
+
+
+def get_mysql_connection(db_name=None):
+    """
+    创建 mysql 连接（并行导出和导入使用 pymysql，只在用到时才导入）
+    """
+    import pymysql
+    mysql_config = _config_.get("mysql", {})
+    if not mysql_config:
+        raise Exception('mysql config miss')
+    return pymysql.connect(host=mysql_config.get('host', 'localhost'), port=int(mysql_config.get('port')),
+                           user=mysql_config.get('username'), password=mysql_config.get('password'),
+                           database=db_name, charset='utf8mb4')
+
+
+def quote_name(name):
+    return "`{}`".format(name.replace("`", "``"))
+
+
+def open_snapshot_connections(db_name, count):
+    """
+    打开 count 个处于同一个一致性快照中的连接：协调连接加全局读锁，各工作连接开启一致性快照事务后立即释放读锁，
+    加锁时间只有开启事务这一小段时间，和数据量无关
+    :param db_name: 数据库名
+    :param count: 连接数
+    :return: (连接列表, 快照对应的 binlog 位置（没有开启 binlog 时为 None）)
+    """
+    coordinator = get_mysql_connection(db_name)
+    connections = []
+    try:
+        with coordinator.cursor() as cursor:
+            cursor.execute("FLUSH TABLES WITH READ LOCK")
+            try:
+                for i in range(count):
+                    connection = get_mysql_connection(db_name)
+                    connections.append(connection)
+                    with connection.cursor() as worker_cursor:
+                        worker_cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                        worker_cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+                cursor.execute("SHOW MASTER STATUS")
+                row = cursor.fetchone()
+                binlog = {"file": row[0], "position": row[1]} if row else None
+            finally:
+                cursor.execute("UNLOCK TABLES")
+    except Exception:
+        for connection in connections:
+            connection.close()
+        raise
+    finally:
+        coordinator.close()
+    return connections, binlog
+
+
+def plan_table_chunks(connection, table):
+    """
+    按主键范围把大表切分成多个导出任务（只切分单列整数主键的表）
+    :return: where 条件列表，不切分时为 [""]
+    """
+    chunk_rows = int(_config_.get("parallel_dump", {}).get("chunk_rows", 1000000))
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", (table,))
+        row = cursor.fetchone()
+        table_rows = row[0] if row and row[0] else 0
+        if table_rows <= chunk_rows:
+            return [""]
+        cursor.execute("SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS "
+                       "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_KEY = 'PRI'", (table,))
+        primary_keys = cursor.fetchall()
+        if len(primary_keys) != 1 or primary_keys[0][1] not in ('tinyint', 'smallint', 'mediumint', 'int', 'bigint'):
+            return [""]
+        column = quote_name(primary_keys[0][0])
+        cursor.execute("SELECT MIN({column}), MAX({column}) FROM {table}".format(column=column, table=quote_name(table)))
+        min_id, max_id = cursor.fetchone()
+    if min_id is None:
+        return [""]
+    count = int(math.ceil(float(table_rows) / chunk_rows))
+    step = max(1, int(math.ceil(float(max_id - min_id + 1) / count)))
+    wheres = []
+    for start in range(min_id, max_id + 1, step):
+        wheres.append(" WHERE {column} >= {start} AND {column} < {end}".format(column=column, start=start, end=start + step))
+    return wheres
+
+
+def dump_table_chunk(connection, table, where, data_file):
+    """
+    导出表的一部分数据为 gzip 压缩的 INSERT 语句（每行一条语句）。
+    BLOB、BINARY 等二进制列的值按十六进制（X'..'）写入，文件内容始终是 ascii 兼容的 utf-8
+    :return: 导出的行数
+    """
+    import pymysql
+    batch_bytes = int(_config_.get("parallel_dump", {}).get("insert_batch_bytes", 1024 * 1024))
+    rows = 0
+    with gzip.open(data_file, 'wb') as f:
+        with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute("SELECT * FROM {table}{where}".format(table=quote_name(table), where=where))
+            prefix = "INSERT INTO {table} VALUES ".format(table=quote_name(table)).encode('utf-8')
+            values = []
+            values_size = 0
+            for row in cursor:
+                value = b"(" + b",".join(escape_value(connection, v) for v in row) + b")"
+                values.append(value)
+                values_size += len(value)
+                rows += 1
+                if values_size >= batch_bytes:
+                    f.write(prefix + b",".join(values) + b";\n")
+                    values = []
+                    values_size = 0
+            if values:
+                f.write(prefix + b",".join(values) + b";\n")
+    return rows
+
+
+def escape_value(connection, value):
+    """
+    把一个列值转义成 sql 字面量（utf-8 编码的 bytes），二进制值转成十六进制字面量
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return b"X'" + binascii.hexlify(value) + b"'"
+    return connection.escape(value).encode('utf-8')
+
+
+# 随表结构和数据一起导出的其他数据库对象：(类型, 列出对象的语句, 对象名所在列, SHOW CREATE 语句, 建表语句所在列)，按导入顺序排列
+SCHEMA_OBJECT_TYPES = [
+    ("view", "SHOW FULL TABLES WHERE Table_type = 'VIEW'", 0, "SHOW CREATE VIEW {name}", 1),
+    ("procedure", "SHOW PROCEDURE STATUS WHERE Db = DATABASE()", 1, "SHOW CREATE PROCEDURE {name}", 2),
+    ("function", "SHOW FUNCTION STATUS WHERE Db = DATABASE()", 1, "SHOW CREATE FUNCTION {name}", 2),
+    ("trigger", "SHOW TRIGGERS", 0, "SHOW CREATE TRIGGER {name}", 2),
+    ("event", "SHOW EVENTS", 1, "SHOW CREATE EVENT {name}", 3),
+]
+
+
+def dump_schema_objects(connection, dump_dir):
+    """
+    导出视图、存储过程、函数、触发器和事件的创建语句（每个对象一个 gzip 文件）
+    :param connection: 一致性快照中的连接
+    :param dump_dir: 导出目录
+    :return: [{type, name, file}]，按导入顺序排列
+    """
+    objects = []
+    for object_type, list_sql, name_index, create_sql, create_index in SCHEMA_OBJECT_TYPES:
+        with connection.cursor() as cursor:
+            cursor.execute(list_sql)
+            names = [row[name_index] for row in cursor.fetchall()]
+        for name in names:
+            with connection.cursor() as cursor:
+                cursor.execute(create_sql.format(name=quote_name(name)))
+                create_statement = cursor.fetchone()[create_index]
+            if not create_statement:
+                # 没有 SHOW_ROUTINE 等权限时拿不到存储过程的定义
+                raise Exception("can not get create statement of {} {}".format(object_type, name))
+            object_file = "object.{:05d}.sql.gz".format(len(objects))
+            with gzip.open(os.path.join(dump_dir, object_file), 'wt', encoding='utf-8') as f:
+                f.write(create_statement)
+            objects.append({"type": object_type, "name": name, "file": object_file})
+    return objects
+
+
+def restore_schema_objects(dump_dir, db_name, objects):
+    """
+    数据导入完成后按顺序创建视图、存储过程、函数、触发器和事件。
+    视图之间可能互相引用，创建失败的视图在其他视图创建后重试，直到没有新的视图创建成功
+    """
+    pending = list(objects)
+    while pending:
+        failed = []
+        errors = []
+        for schema_object in pending:
+            try:
+                load_sql_file(db_name, os.path.join(dump_dir, schema_object["file"]), single_statement=True)
+            except Exception as e:
+                if schema_object["type"] != "view":
+                    raise
+                failed.append(schema_object)
+                errors.append(e)
+        if len(failed) == len(pending):
+            raise errors[0]
+        pending = failed
+
+
+@log_exception
+def dump_mysql_parallel(dump_dir, db_name):
+    """
+    并行导出数据库数据：多个连接在同一个一致性快照中，按表（大表按主键范围切分）并行导出为多个 gzip 文件，
+    manifest.json 记录表结构文件、数据文件、视图等其他对象的创建语句文件和快照对应的 binlog 位置，供 restore_mysql_parallel 并行导入
+    :param dump_dir: 导出目录
+    :param db_name: 数据库名
+    :return: 导出目录
+    """
+    if not db_name:
+        raise Exception("db_name miss")
+    if not os.path.exists(dump_dir):
+        os.makedirs(dump_dir)
+
+    with StageTimer('dump_parallel', dump_dir) as stage:
+        threads = max(1, int(_config_.get("parallel_dump", {}).get("threads", 4)))
+        connections, binlog = open_snapshot_connections(db_name, threads)
+        try:
+            connection = connections[0]
+            with connection.cursor() as cursor:
+                cursor.execute("SHOW FULL TABLES WHERE Table_type = 'BASE TABLE'")
+                tables = [row[0] for row in cursor.fetchall()]
+
+            manifest = {"db_name": db_name, "binlog": binlog, "tables": [],
+                        "objects": dump_schema_objects(connection, dump_dir)}
+            tasks = queue.Queue()
+            for i, table in enumerate(tables):
+                schema_file = "{:05d}.schema.sql.gz".format(i)
+                with connection.cursor() as cursor:
+                    cursor.execute("SHOW CREATE TABLE {table}".format(table=quote_name(table)))
+                    create_sql = cursor.fetchone()[1]
+                with gzip.open(os.path.join(dump_dir, schema_file), 'wt', encoding='utf-8') as f:
+                    f.write(create_sql)
+                table_info = {"name": table, "schema": schema_file, "data": [], "rows": 0}
+                for j, where in enumerate(plan_table_chunks(connection, table)):
+                    data_file = "{:05d}.{:05d}.sql.gz".format(i, j)
+                    table_info["data"].append(data_file)
+                    tasks.put((table_info, table, where, data_file))
+                manifest["tables"].append(table_info)
+
+            errors = []
+            lock = threading.Lock()
+
+            def worker(worker_connection):
+                while not errors:
+                    try:
+                        table_info, table, where, data_file = tasks.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        rows = dump_table_chunk(worker_connection, table, where, os.path.join(dump_dir, data_file))
+                        with lock:
+                            table_info["rows"] += rows
+                    except Exception as e:
+                        errors.append(e)
+
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                for worker_connection in connections:
+                    executor.submit(worker, worker_connection)
+            if errors:
+                raise errors[0]
+        finally:
+            for connection in connections:
+                connection.close()
+
+        with open(os.path.join(dump_dir, "manifest.json"), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        stage.bytes_out = get_path_size([dump_dir])
+
+    message = "parallel dump mysql data [{db_name}] to {dump_dir}, tables: {tables}, objects: {objects}, files: {files}, {summary}" \
+        .format(db_name=db_name, dump_dir=dump_dir, tables=len(tables), objects=len(manifest["objects"]), summary=stage.summary(),
+                files=sum(len(table_info["data"]) for table_info in manifest["tables"]))
+    write_log(message)
+    return dump_dir
+
+
+def load_sql_file(db_name, sql_file, single_statement=False):
+    """
+    导入 dump_mysql_parallel 生成的 gzip sql 文件
+    :param db_name: 数据库名
+    :param sql_file: sql 文件，数据文件每行一条语句
+    :param single_statement: 为 True 时整个文件是一条语句（表结构文件）
+    """
+    connection = get_mysql_connection(db_name)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SET SESSION foreign_key_checks = 0")
+            cursor.execute("SET SESSION unique_checks = 0")
+            with gzip.open(sql_file, 'rt', encoding='utf-8') as f:
+                if single_statement:
+                    cursor.execute(f.read())
+                else:
+                    for line in f:
+                        if line.strip():
+                            cursor.execute(line)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+@log_exception
+def restore_mysql_parallel(dump_dir, db_name):
+    """
+    并行导入 dump_mysql_parallel 导出的数据：先创建所有表，再用多个连接并行导入数据文件，
+    最后创建视图、存储过程、函数、触发器和事件（触发器在数据导入后创建，导入时不会触发）
+    :param dump_dir: 导出目录（包含 manifest.json）
+    :param db_name: 导入的数据库名，不存在时自动创建
+    :return:
+    """
+    start_time = time.time()
+    with open(os.path.join(dump_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    connection = get_mysql_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE DATABASE IF NOT EXISTS {db_name}".format(db_name=quote_name(db_name)))
+    finally:
+        connection.close()
+
+    threads = max(1, int(_config_.get("parallel_dump", {}).get("threads", 4)))
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        schema_files = [os.path.join(dump_dir, table_info["schema"]) for table_info in manifest["tables"]]
+        list(executor.map(lambda sql_file: load_sql_file(db_name, sql_file, single_statement=True), schema_files))
+        data_files = [os.path.join(dump_dir, data_file) for table_info in manifest["tables"] for data_file in table_info["data"]]
+        list(executor.map(lambda sql_file: load_sql_file(db_name, sql_file), data_files))
+    restore_schema_objects(dump_dir, db_name, manifest.get("objects", []))
+
+    use_time = math.floor(time.time() - start_time)
+    message = "parallel restore mysql data [{db_name}] from {dump_dir}, tables: {tables}, use seconds:  {second}s" \
+        .format(db_name=db_name, dump_dir=dump_dir, tables=len(manifest["tables"]), second=use_time)
+    write_log(message)
+
+
+def restore_from_oss(oss_key, db_name):
+    """
+    从oss下载 dump_mysql_parallel 的备份文件，解压后并行导入到数据库
+    :param oss_key: 备份文件的 oss key
+    :param db_name: 导入的数据库名
+    :return:
+    """
+    oss_config = _config_.get("oss")
+    if not oss_config:
+        raise Exception('oss config miss!')
+
+    restore_dir = os.path.join(CURR_DIR, 'tmp_data', 'restore_{}'.format(db_name))
+    if not os.path.exists(restore_dir):
+        os.makedirs(restore_dir)
+    try:
+        bucket = get_oss_bucket()
+        zip_file_path = os.path.join(restore_dir, os.path.basename(oss_key))
+        bucket.get_object_to_file(oss_key, zip_file_path)
+        rc = subprocess.call(['7z', 'x', '-y', '-p{}'.format(get_compress_pwd()), '-o{}'.format(restore_dir), zip_file_path])
+        if rc != 0:
+            raise Exception('unzip backup file fail: {}'.format(oss_key))
+        for root, dirs, files in os.walk(restore_dir):
+            if "manifest.json" in files:
+                restore_mysql_parallel(root, db_name)
+                return
+        raise Exception('manifest.json not found in backup file: {}'.format(oss_key))
+    finally:
+        shutil.rmtree(restore_dir)
+
+
+def get_mysql_command(program):
+    """
+    mysql 命令行工具（mysql、mysqldump、mysqlbinlog 等）的连接参数
+    """
+    mysql_config = _config_.get("mysql", {})
+    if not mysql_config:
+        raise Exception('mysql config miss')
+    return [program, '-u', mysql_config.get('username'), '-p{}'.format(mysql_config.get('password')),
+            '-P', str(mysql_config.get('port'))]
+
+
+def mysql_query(sql):
+    """
+    通过 mysql 命令行执行查询
+    :return: 结果行列表，每行为字段值列表
+    """
+    out = subprocess.check_output(get_mysql_command('mysql') + ['-N', '-B', '-e', sql]).decode('utf-8')
+    return [line.split('\t') for line in out.splitlines() if line]
+
+
+def get_binlog_state_file():
+    return os.path.join(CURR_DIR, _config_.get("binlog", {}).get("state_file", "binlog_state.json"))
+
+
+def load_binlog_state():
+    state_file = get_binlog_state_file()
+    if not os.path.exists(state_file):
+        return {"last_base_time": None, "base_binlog_file": None, "uploaded": []}
+    with open(state_file) as f:
+        return json.load(f)
 
-    write_log("backup db name: {}".format(_backup_db_))
-    prepare_runtime_env()
 
-    data_dir = os.path.join(CURR_DIR, 'tmp_data', _backup_db_)
+def save_binlog_state(state):
+    state_file = get_binlog_state_file()
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.rename(state_file + '.tmp', state_file)
+
+
+def get_binlog_oss_prefix(host_ip=None):
+    return "{}/binlog/".format(host_ip or get_host_ip())
+
+
+def dump_mysql_base(data_dir, bak_time):
+    """
+    基础备份：整库一致性导出（--single-transaction），--flush-logs 让导出之后的变更都写入新的 binlog 文件，
+    --master-data=2 记录导出对应的 binlog 位置，基础备份的 oss key 中带上该位置，供时间点恢复时从该位置开始重放 binlog
+    :param data_dir: 临时目录
+    :param bak_time: 备份时间
+    :return: (oss_key, binlog 文件名, binlog 位置)
+    """
+    archive_file = os.path.join(data_dir, "base-{}.7z".format(bak_time))
+    dump_command = get_mysql_command('mysqldump') + ['--all-databases', '--single-transaction', '--flush-logs',
+                                                     '--master-data=2', '--routines', '--events', '--triggers']
+    dump_size, head = stream_dump_to_7z(dump_command, 'all-databases.sql', archive_file, get_compress_pwd())
+    match = re.search(br"MASTER_LOG_FILE='([^']+)', MASTER_LOG_POS=(\d+)", head)
+    if not match:
+        raise Exception("binlog position not found in base dump, is binlog enabled?")
+    binlog_file, binlog_pos = match.group(1).decode('utf-8'), int(match.group(2))
+    oss_key = upload_to_aliyun_oss(archive_file, "{prefix}base-{bak_time}-{binlog_file}-{binlog_pos}.7z".format(
+        prefix=get_binlog_oss_prefix(), bak_time=bak_time, binlog_file=binlog_file, binlog_pos=binlog_pos))
+    os.remove(archive_file)
+    write_log("mysql base backup [{oss_key}], sql size: {sql_size}".format(oss_key=oss_key, sql_size=human_size(dump_size)))
+    return oss_key, binlog_file, binlog_pos
+
+
+def ship_binlogs(data_dir, state):
+    """
+    上传已经切换出来（不再写入）并且还没有上传过的 binlog 文件
+    :param data_dir: 临时目录
+    :param state: binlog 备份状态，上传成功的文件记录到 state["uploaded"] 中
+    :return: 本次上传的 binlog 文件名列表
+    """
+    if _config_.get("binlog", {}).get("flush_logs", True):
+        # 切换出新的 binlog 文件，让当前 binlog 中的变更也能在本次上传
+        mysql_query("FLUSH BINARY LOGS")
+    binlog_basename = mysql_query("SELECT @@log_bin_basename")[0][0]
+    if not binlog_basename or binlog_basename == 'NULL':
+        raise Exception("binlog is not enabled")
+    binlog_dir = os.path.dirname(binlog_basename)
+    binlog_files = [row[0] for row in mysql_query("SHOW BINARY LOGS")]
+    current_file = mysql_query("SHOW MASTER STATUS")[0][0]
+
+    shipped = []
+    for binlog_file in binlog_files:
+        if binlog_file == current_file or binlog_file in state["uploaded"]:
+            continue
+        if state.get("base_binlog_file") and binlog_file < state["base_binlog_file"]:
+            continue
+        zip_file_path = os.path.join(data_dir, "{}.zip".format(binlog_file))
+        zip_file(zip_file_path, [os.path.join(binlog_dir, binlog_file)], password=get_compress_pwd())
+        upload_to_aliyun_oss(zip_file_path, get_binlog_oss_prefix() + os.path.basename(zip_file_path))
+        os.remove(zip_file_path)
+        state["uploaded"].append(binlog_file)
+        save_binlog_state(state)
+        shipped.append(binlog_file)
+    return shipped
+
+
+@log_exception
+def binlog_backup():
+    """
+    binlog 增量备份：距离上一次基础备份超过 base_interval_hours 时做一次基础备份，
+    之后每次运行只上传新切换出来的 binlog 文件
+    :return: (本次基础备份的 oss key（没有做基础备份时为 None）, 本次上传的 binlog 文件名列表)
+    """
+    data_dir = os.path.join(CURR_DIR, 'tmp_data', 'binlog')
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
+    try:
+        state = load_binlog_state()
+        base_key = None
+        base_interval = _config_.get("binlog", {}).get("base_interval_hours", 24) * 3600
+        last_base_time = state.get("last_base_time")
+        if not last_base_time or time.time() - time.mktime(time.strptime(last_base_time, '%Y%m%d%H%M')) >= base_interval:
+            bak_time = time.strftime('%Y%m%d%H%M')
+            base_key, binlog_file, binlog_pos = dump_mysql_base(data_dir, bak_time)
+            state["last_base_time"] = bak_time
+            state["base_binlog_file"] = binlog_file
+            state["uploaded"] = [f for f in state["uploaded"] if f >= binlog_file]
+            save_binlog_state(state)
+        return base_key, ship_binlogs(data_dir, state)
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def restore_binlog_pitr(until_time, host_ip=None):
+    """
+    时间点恢复：导入不晚于 until_time 的最近一次基础备份，再用 mysqlbinlog 从基础备份的 binlog 位置重放到 until_time
+    :param until_time: 恢复到的时间点（格式: %Y-%m-%d %H:%M:%S）
+    :param host_ip: 备份所在服务器的 ip（oss key 前缀），为空时为本机
+    :return:
+    """
+    oss_config = _config_.get("oss")
+    if not oss_config:
+        raise Exception('oss config miss!')
+
+    until_key_time = time.strftime('%Y%m%d%H%M', time.strptime(until_time, '%Y-%m-%d %H:%M:%S'))
+    bucket = get_oss_bucket()
+    prefix = get_binlog_oss_prefix(host_ip)
+    bases = []
+    binlog_keys = []
+    for obj in oss2.ObjectIterator(bucket, prefix=prefix):
+        name = obj.key[len(prefix):]
+        match = re.match(r'base-(\d{12})-(.+)-(\d+)\.7z$', name)
+        if match:
+            if match.group(1) <= until_key_time:
+                bases.append((match.group(1), match.group(2), int(match.group(3)), obj.key))
+        elif name.endswith('.zip'):
+            binlog_keys.append((name[:-len('.zip')], obj.key))
+    if not bases:
+        raise Exception('no mysql base backup found before: {}'.format(until_time))
+    base_time, base_binlog_file, base_binlog_pos, base_key = sorted(bases)[-1]
 
-    archive_file_list = []
+    restore_dir = os.path.join(CURR_DIR, 'tmp_data', 'binlog_restore')
+    if not os.path.exists(restore_dir):
+        os.makedirs(restore_dir)
     try:
-        bak_time = time.strftime('%Y%m%d%H%M')
-        # 导出数据库数据并添加到备份列表中
-        sql_file = os.path.join(data_dir, '{db_name}_{bak_time}.sql'.format(db_name=_backup_db_, bak_time=time.strftime('%Y%m%d%H%M')))
-        dump_mysql(sql_file, _backup_db_)
-        archive_file_list.append(sql_file)
+        # 1, 导入基础备份
+        base_file = os.path.join(restore_dir, os.path.basename(base_key))
+        bucket.get_object_to_file(base_key, base_file)
+        unzip_process = subprocess.Popen(['7z', 'x', '-so', '-p{}'.format(get_compress_pwd()), base_file], stdout=subprocess.PIPE)
+        mysql_rc = subprocess.call(get_mysql_command('mysql'), stdin=unzip_process.stdout)
+        unzip_process.stdout.close()
+        if unzip_process.wait() != 0 or mysql_rc != 0:
+            raise Exception('restore mysql base backup fail: {}'.format(base_key))
+        os.remove(base_file)
+        write_log("restore mysql base backup [{}]".format(base_key))
+
+        # 2, 重放基础备份之后的 binlog，所有文件在一次 mysqlbinlog 调用中处理，--start-position 只作用于第一个文件
+        binlog_files = []
+        for binlog_file, oss_key in sorted(binlog_keys):
+            if binlog_file < base_binlog_file:
+                continue
+            zip_file_path = os.path.join(restore_dir, os.path.basename(oss_key))
+            bucket.get_object_to_file(oss_key, zip_file_path)
+            rc = subprocess.call(['7z', 'x', '-y', '-p{}'.format(get_compress_pwd()), '-o{}'.format(restore_dir), zip_file_path])
+            if rc != 0:
+                raise Exception('unzip binlog fail: {}'.format(oss_key))
+            os.remove(zip_file_path)
+            binlog_files.append(os.path.join(restore_dir, binlog_file))
+        if not binlog_files or os.path.basename(binlog_files[0]) != base_binlog_file:
+            raise Exception('binlog {} of base backup not found in oss'.format(base_binlog_file))
+        binlog_command = ['mysqlbinlog', '--start-position={}'.format(base_binlog_pos),
+                          '--stop-datetime={}'.format(until_time)] + binlog_files
+        binlog_process = subprocess.Popen(binlog_command, stdout=subprocess.PIPE)
+        mysql_rc = subprocess.call(get_mysql_command('mysql'), stdin=binlog_process.stdout)
+        binlog_process.stdout.close()
+        if binlog_process.wait() != 0 or mysql_rc != 0:
+            raise Exception('replay binlog fail')
+        write_log("replay binlog {} ~ {} until {}".format(os.path.basename(binlog_files[0]), os.path.basename(binlog_files[-1]), until_time))
+    finally:
+        shutil.rmtree(restore_dir)
+
+
+def list_databases():
+    """
+    通过 SHOW DATABASES 获取数据库列表，并按照配置的包含/排除规则过滤
+    :return: 数据库名列表
+    """
+    includes = _config_.get("backup", {}).get("db_include", ["*"])
+    excludes = _config_.get("backup", {}).get("db_exclude", [])
+    db_names = []
+    for db_name in [row[0] for row in mysql_query('SHOW DATABASES')]:
+        if not any(fnmatch.fnmatch(db_name, pattern) for pattern in includes):
+            continue
+        if any(fnmatch.fnmatch(db_name, pattern) for pattern in excludes):
+            continue
+        db_names.append(db_name)
+    return db_names
+
+
+def init_stage_limits():
+    """
+    初始化导出、压缩、上传各阶段的并发数限制
+    """
+    for stage in ('dump', 'compress', 'upload'):
+        _stage_limits_[stage] = threading.BoundedSemaphore(get_stage_workers(stage))
+
+
+def get_dump_mode():
+    if _config_.get("parallel_dump", {}).get("enabled"):
+        return 'parallel'
+    return 'stream' if is_stream_dump() else 'staged'
+
+
+def get_free_space(path):
+    """
+    路径所在磁盘的剩余可用空间（即 df 的 Avail）
+    """
+    disk = os.statvfs(path)
+    return disk.f_bavail * disk.f_frsize
+
+
+def get_db_size(db_name):
+    """
+    通过 information_schema 估算数据库的数据大小（数据 + 索引），作为导出数据大小的预估值
+    """
+    rows = mysql_query("SELECT IFNULL(SUM(data_length + index_length), 0) FROM information_schema.TABLES "
+                       "WHERE table_schema = '{}'".format(db_name.replace("'", "''")))
+    return int(float(rows[0][0])) if rows else 0
+
+
+def estimate_scratch_size(dump_size, mode):
+    """
+    预估各导出方式备份过程中同时存在的临时文件大小
+    staged：sql 文件 + zip 文件；parallel：gzip 导出文件 + zip 文件；stream：只有最终的 7z 文件
+    :param dump_size: 导出数据大小
+    :param mode: 导出方式，见 get_dump_mode
+    :return: 字节数
+    """
+    compressed_size = dump_size * float(_config_.get("scratch", {}).get("compress_ratio", 1.0))
+    if mode == 'staged':
+        return int(dump_size + compressed_size)
+    if mode == 'parallel':
+        return int(compressed_size * 2)
+    return int(compressed_size)
+
+
+class ScratchBudget(object):
+    """
+    临时空间预算：每个数据库备份前按预估大小申请临时空间，预算不足时等待其他数据库备份完成后释放
+    """
 
-        # 打包压缩和加密备份文件
-        zip_name = "{}-{}.zip".format(_backup_db_, time.strftime('%Y%m%d%H%M'))
-        zip_file_path = os.path.join(data_dir, zip_name)
-        zip_file(zip_file_path, archive_file_list, password=get_compress_pwd())
+    def __init__(self, total):
+        self.total = total
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, nbytes, blocking=True):
+        with self.condition:
+            while self.used + nbytes > self.total:
+                if not blocking or nbytes > self.total:
+                    return False
+                self.condition.wait()
+            self.used += nbytes
+            return True
+
+    def release(self, nbytes):
+        with self.condition:
+            self.used -= nbytes
+            self.condition.notify_all()
+
+
+def init_scratch_budget():
+    """
+    根据临时目录所在磁盘的剩余空间和配置的上限初始化本次运行的临时空间预算
+    """
+    global _scratch_budget_
+    scratch_config = _config_.get("scratch", {})
+    scratch_dir = get_scratch_dir()
+    if not os.path.exists(scratch_dir):
+        os.makedirs(scratch_dir)
+    free_size = get_free_space(scratch_dir) - int(scratch_config.get("reserve", 0))
+    budget = int(scratch_config.get("budget", 0))
+    _scratch_budget_ = ScratchBudget(max(0, min(free_size, budget) if budget else free_size))
+    write_log("scratch budget: {}, free: {}".format(human_size(_scratch_budget_.total), human_size(free_size)))
+
+
+@log_exception
+def choose_dump_mode(db_name):
+    """
+    备份前的临时空间预检：按数据库大小预估配置的导出方式需要的临时空间，超过预算时（auto_stream）改用流式导出
+    :param db_name: 数据库名
+    :return: (导出方式, 预估临时空间大小)
+    """
+    mode = get_dump_mode()
+    db_size = get_db_size(db_name)
+    need_size = estimate_scratch_size(db_size, mode)
+    if need_size > _scratch_budget_.total and mode != 'stream' and _config_.get("scratch", {}).get("auto_stream", True):
+        write_log("scratch space of {} dump ({}) exceeds budget ({}), use stream dump, db:{}"
+                  .format(mode, human_size(need_size), human_size(_scratch_budget_.total), db_name))
+        mode, need_size = 'stream', estimate_scratch_size(db_size, 'stream')
+    if need_size > _scratch_budget_.total:
+        raise Exception("not enough scratch space, db:{}, size: {}, need: {}, budget: {}".format(
+            db_name, human_size(db_size), human_size(need_size), human_size(_scratch_budget_.total)))
+    return mode, need_size
+
+
+def backup_database(db_name, bak_time):
+    """
+    备份单个数据库：导出、压缩加密、上传到oss。
+    每个阶段分别受对应的并发数限制，多个数据库同时备份时各阶段形成流水线
+    :param db_name: 数据库名
+    :param bak_time: 备份时间
+    :return: (oss_key, 备份文件大小)
+    """
+    # 按预估大小申请临时空间，多个数据库同时备份时占用的临时空间总和不超过预算
+    mode, scratch_size = choose_dump_mode(db_name)
+    _scratch_budget_.acquire(scratch_size)
+    data_dir = os.path.join(get_scratch_dir(), db_name)
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    try:
+        if mode == 'parallel':
+            # 并行导出数据库数据，导出的 gzip 文件已经压缩过，再用 7z 打包加密
+            dump_dir = os.path.join(data_dir, '{db_name}_{bak_time}'.format(db_name=db_name, bak_time=bak_time))
+            with _stage_limits_['dump']:
+                dump_mysql_parallel(dump_dir, db_name)
+
+            zip_file_path = os.path.join(data_dir, "{}-{}.zip".format(db_name, bak_time))
+            with _stage_limits_['compress']:
+                zip_file(zip_file_path, [dump_dir], password=get_compress_pwd())
+            shutil.rmtree(dump_dir)
+        elif mode == 'stream':
+            # 流式导出数据库数据，直接压缩加密成最终的备份文件（导出和压缩同时进行，占用两个阶段的并发数）
+            zip_file_path = os.path.join(data_dir, "{}-{}.7z".format(db_name, bak_time))
+            with _stage_limits_['dump'], _stage_limits_['compress']:
+                dump_mysql_stream(zip_file_path, db_name, password=get_compress_pwd())
+        else:
+            # 导出数据库数据
+            sql_file = os.path.join(data_dir, '{db_name}_{bak_time}.sql'.format(db_name=db_name, bak_time=bak_time))
+            with _stage_limits_['dump']:
+                dump_mysql(sql_file, db_name)
+
+            # 导出的 sql 文件比预估的大时，按实际大小补充申请临时空间，预算不足时不再继续压缩
+            extra_size = estimate_scratch_size(os.path.getsize(sql_file), mode) - scratch_size
+            if extra_size > 0:
+                if not _scratch_budget_.acquire(extra_size, blocking=False):
+                    raise Exception("scratch space exceeds budget, db:{}, sql size: {}"
+                                    .format(db_name, human_size(os.path.getsize(sql_file))))
+                scratch_size += extra_size
+
+            # 打包压缩和加密备份文件
+            zip_file_path = os.path.join(data_dir, "{}-{}.zip".format(db_name, bak_time))
+            with _stage_limits_['compress']:
+                zip_file(zip_file_path, [sql_file], password=get_compress_pwd())
+            os.remove(sql_file)
 
         # 上传到阿里云对象存储（oss）服务器。
         # 备注：当前阿里云的归档存储服务没有提供归档文件相应的查看和下载界面，所以这里用oss来存储备份文件，
         # 而且oss具有很好的生命周期规则可以设置，从而不需要自己来控制数据的过期删除。
-        oss_key = upload_to_aliyun_oss(zip_file_path)
-
-        # 邮件通知备份结果
-        subject = u'[√] 数据备份成功({})'.format(oss_key)
-        content = u'''
-                    <p><b>bucket：</b>   {oss_bucket}</p>
-                    <p><b>备份路径：</b>   {oss_key}</p>
-                    <p><b>文件大小：</b>   {file_size}</p>
-                '''.format(oss_bucket=_config_.get("oss", {}).get('oss_bucket', "-"), oss_key=oss_key, file_size=human_size(os.path.getsize(zip_file_path)))
-
-        try:
-            '''获取磁盘信息'''
-            process = subprocess.Popen(['df', '-h'], stdout=subprocess.PIPE)
-            out, err = process.communicate()
-            content = content + u'''
-                        <p><b>服务器磁盘信息：</b><pre style='padding:10px;background-color:#eee'>{disk_info}</pre></p>
-                    '''.format(disk_info=out)
-        except Exception:
-            pass
-        send_email(subject, content, get_email_addressee())
+        with _stage_limits_['upload']:
+            oss_key = upload_to_aliyun_oss(zip_file_path)
+        return oss_key, os.path.getsize(zip_file_path)
     finally:
         # 删除备份过程中的中间文件
         shutil.rmtree(data_dir)
+        _scratch_budget_.release(scratch_size)
+
+
+def run_binlog_backup():
+    """
+    binlog 增量备份（--binlog 和调度中 binlog 类型的任务）
+    """
+    global _backup_db_, _email_on_exception_
+    write_log("=========================== start : binlog backup ==========================")
+    reset_stage_records()
+    _backup_db_ = "binlog"
+    _email_on_exception_ = True
+    base_key, shipped = binlog_backup()
+    write_log("binlog backup, base: {}, binlog files: {}".format(base_key or "-", ",".join(shipped) or "-"))
+    write_log("=========================== end : binlog backup ==========================")
+
+
+def run_database_backup(db_names=None):
+    """
+    备份多个数据库并把结果汇总到一封邮件中（命令行备份和调度中 mysql 类型的任务）
+    :param db_names: 数据库名列表，为 None 时备份 db_include/db_exclude 匹配的所有数据库
+    :return: 是否全部备份成功
+    """
+    global _backup_db_, _email_on_exception_
+    write_log("=========================== start : backup data ==========================")
+    reset_stage_records()
+    if db_names is None:
+        db_names = list_databases()
+    _backup_db_ = ",".join(db_names)
+    write_log("backup db name: {}".format(_backup_db_))
+
+    # 每个数据库的失败信息都汇总到一封邮件里，不再逐个发送
+    _email_on_exception_ = False
+    init_stage_limits()
+    init_scratch_budget()
+    profiling = start_profiling()
+    bak_time = time.strftime('%Y%m%d%H%M')
+    max_workers = max(1, sum(get_stage_workers(stage) for stage in ('dump', 'compress', 'upload')))
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict((db_name, executor.submit(backup_database, db_name, bak_time)) for db_name in db_names)
+        for db_name, future in futures.items():
+            try:
+                results[db_name] = (True, future.result())
+            except Exception:
+                results[db_name] = (False, traceback.format_exc())
+    stop_profiling(profiling)
+
+    # 邮件通知备份结果
+    fail_db_names = [db_name for db_name in db_names if not results[db_name][0]]
+    if not db_names:
+        subject = u'[X] 数据备份失败({}/没有需要备份的数据库)'.format(get_host_ip())
+    elif fail_db_names:
+        subject = u'[X] 数据备份失败({}/{})'.format(get_host_ip(), ",".join(fail_db_names))
+    else:
+        subject = u'[√] 数据备份成功({}/{})'.format(get_host_ip(), _backup_db_)
+    content = u'''
+                <p><b>bucket：</b>   {oss_bucket}</p>
+            '''.format(oss_bucket=_config_.get("oss", {}).get('oss_bucket', "-"))
+    for db_name in db_names:
+        success, result = results[db_name]
+        if success:
+            content = content + u'''
+                <p><b>{db_name}：</b>   {oss_key}（{file_size}）</p>
+            '''.format(db_name=db_name, oss_key=result[0], file_size=human_size(result[1]))
+        else:
+            content = content + u'''
+                <p><b>{db_name}：</b>   备份失败</p>
+                <p><b>错误信息：</b><pre style='padding:10px;background-color:#eee'>{err_info}</pre></p>
+            '''.format(db_name=db_name, err_info=result)
+
+    try:
+        '''获取磁盘信息'''
+        process = subprocess.Popen(['df', '-h'], stdout=subprocess.PIPE)
+        out, err = process.communicate()
+        content = content + u'''
+                    <p><b>服务器磁盘信息：</b><pre style='padding:10px;background-color:#eee'>{disk_info}</pre></p>
+                '''.format(disk_info=out)
+    except Exception:
         pass
+    send_email(subject, content, get_email_addressee())
 
     write_log("=========================== end : backup data ==========================")
+    return bool(db_names) and not fail_db_names
+
+
+def get_scheduler_config():
+    return _config_.get("scheduler", {})
+
+
+def get_load_ratio():
+    """
+    1 分钟平均负载按 cpu 核数折算后的值
+    """
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+def get_io_pressure():
+    """
+    io 压力：/proc/pressure/io 中 some 的 avg10（最近 10 秒内有任务在等待 io 的时间百分比），内核不支持时返回 None
+    """
+    try:
+        with open('/proc/pressure/io') as f:
+            for line in f:
+                if line.startswith('some'):
+                    return float(line.split()[1].split('=')[1])
+    except (IOError, IndexError, ValueError):
+        pass
+    return None
+
+
+def set_process_priority():
+    """
+    按配置调低调度进程的 cpu 和 io 优先级，之后启动的线程和子进程（mysqldump、7z、备份脚本等）都继承该优先级
+    """
+    scheduler_config = get_scheduler_config()
+    if scheduler_config.get("nice"):
+        os.nice(int(scheduler_config["nice"]))
+    if scheduler_config.get("ionice") is not None:
+        try:
+            subprocess.call(['ionice', '-c2', '-n{}'.format(scheduler_config["ionice"]), '-p', str(os.getpid())])
+        except OSError:
+            write_log("ionice is not available, io priority is not changed")
+
+
+def get_next_run_time(job, last_time):
+    """
+    计算任务的下一次运行时间
+    :param job: 任务配置，at 为每天运行的时间点（%H:%M），interval_minutes 为运行间隔
+    :param last_time: 上一次运行的开始时间（没有运行过时为当前时间）
+    :return: 时间戳
+    """
+    if job.get("at"):
+        hour, minute = [int(n) for n in job["at"].split(":")]
+        t = time.localtime(last_time)
+        next_time = time.mktime((t.tm_year, t.tm_mon, t.tm_mday, hour, minute, 0, 0, 0, -1))
+        if next_time <= last_time:
+            next_time = time.mktime((t.tm_year, t.tm_mon, t.tm_mday + 1, hour, minute, 0, 0, 0, -1))
+        return next_time
+    return last_time + float(job.get("interval_minutes", 1440)) * 60
+
+
+def run_job(job):
+    """
+    运行一次备份任务
+    :param job: 任务配置
+    :return:
+    """
+    job_type = job.get("type")
+    if job_type == "mysql":
+        if not run_database_backup(job.get("db_names") or None):
+            raise Exception("database backup fail, see email and log for detail")
+    elif job_type == "binlog":
+        run_binlog_backup()
+    elif job_type == "command":
+        rc = subprocess.call(job["command"], cwd=CURR_DIR)
+        if rc != 0:
+            raise Exception("command fail, rc: {}".format(rc))
+    else:
+        raise Exception("unsupported job type: {}".format(job_type))
+
+
+class BackupScheduler(object):
+    """
+    常驻调度：按计划启动到期的备份任务。同时运行的任务数受 max_jobs 限制，负载或 io 压力超过预算时推迟启动新任务，
+    数据库备份和 binlog 备份共用进程内的阶段并发数、临时空间预算等状态，它们之间不同时运行。
+    任务状态（状态、下一次运行时间、上一次运行的结果等）写入状态文件、上传到oss，并可以通过 GET /jobs 查看
+    """
+    # 在进程内运行的任务类型
+    IN_PROCESS_TYPES = ('mysql', 'binlog')
+
+    def __init__(self):
+        scheduler_config = get_scheduler_config()
+        self.state_file = os.path.join(CURR_DIR, scheduler_config.get("state_file", "scheduler_state.json"))
+        self.max_jobs = max(1, int(scheduler_config.get("max_jobs", 1)))
+        self.lock = threading.Lock()
+        # 调度线程和各任务线程都会保存状态，保存时串行执行
+        self.save_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads = []
+        old_states = {}
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file) as f:
+                    old_states = dict((state["name"], state) for state in json.load(f).get("jobs", []))
+            except (IOError, ValueError, KeyError, AttributeError) as e:
+                # 状态文件损坏时不影响启动，所有任务按没有运行过计算下一次运行时间
+                write_log("scheduler state file is unreadable, ignored: {}".format(e))
+        now = time.time()
+        self.jobs = []
+        for job in scheduler_config.get("jobs", []):
+            if not job.get("enabled", True):
+                continue
+            old_state = old_states.get(job["name"], {})
+            # 按上一次运行的时间计算下一次运行时间，调度进程停止期间错过的任务在启动后马上补跑
+            last_start = old_state.get("last_start")
+            state = {
+                "name": job["name"],
+                "type": job.get("type"),
+                "status": "idle",
+                "wait_reason": None,
+                "next_run": get_next_run_time(job, last_start or now),
+                "last_start": last_start,
+                "last_end": old_state.get("last_end"),
+                "last_status": old_state.get("last_status"),
+                "last_error": old_state.get("last_error"),
+                "runs": old_state.get("runs", 0),
+                "failures": old_state.get("failures", 0)
+            }
+            self.jobs.append((job, state))
+
+    def get_state(self):
+        with self.lock:
+            return {
+                "host_ip": get_host_ip(),
+                "update_time": time.time(),
+                "load_ratio": round(get_load_ratio(), 2),
+                "io_pressure": get_io_pressure(),
+                "jobs": [dict(state) for job, state in self.jobs]
+            }
+
+    def save_state(self):
+        """
+        写入状态文件并上传到oss（上传失败只记录日志）
+        """
+        with self.save_lock:
+            state = self.get_state()
+            tmp_file = "{}.{}.tmp".format(self.state_file, threading.get_ident())
+            with open(tmp_file, 'w') as f:
+                json.dump(state, f, indent=2)
+            os.rename(tmp_file, self.state_file)
+            try:
+                get_oss_bucket().put_object("scheduler/{}.json".format(get_host_ip()), json.dumps(state))
+            except Exception as e:
+                write_log("upload scheduler state fail: {}".format(e))
+
+    def check_budget(self, job):
+        """
+        检查是否可以启动任务
+        :return: 不能启动的原因，可以启动时返回 None
+        """
+        scheduler_config = get_scheduler_config()
+        running = [j for j, state in self.jobs if state["status"] == "running"]
+        if len(running) >= self.max_jobs:
+            return "max jobs {} running".format(self.max_jobs)
+        if job.get("type") in self.IN_PROCESS_TYPES and any(j.get("type") in self.IN_PROCESS_TYPES for j in running):
+            return "database job running"
+        max_load = float(scheduler_config.get("max_load", 0))
+        load_ratio = get_load_ratio()
+        if max_load and load_ratio > max_load:
+            return "load {:.2f} > {}".format(load_ratio, max_load)
+        max_io_pressure = float(scheduler_config.get("max_io_pressure", 0))
+        io_pressure = get_io_pressure()
+        if max_io_pressure and io_pressure is not None and io_pressure > max_io_pressure:
+            return "io pressure {:.2f} > {}".format(io_pressure, max_io_pressure)
+        return None
+
+    def tick(self):
+        """
+        启动到期并且资源预算允许的任务
+        :return: 任务状态是否有变化
+        """
+        changed = False
+        now = time.time()
+        for job, state in self.jobs:
+            with self.lock:
+                if state["status"] == "running" or state["next_run"] > now:
+                    continue
+                reason = self.check_budget(job)
+                if reason:
+                    if state["wait_reason"] != reason:
+                        write_log("scheduler, job {} is waiting: {}".format(job["name"], reason))
+                        state["status"], state["wait_reason"] = "waiting", reason
+                        changed = True
+                    continue
+                state["status"], state["wait_reason"] = "running", None
+                state["last_start"] = now
+                changed = True
+            thread = threading.Thread(target=self.run, args=(job, state))
+            thread.start()
+            self.threads.append(thread)
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        return changed
+
+    def run(self, job, state):
+        write_log("scheduler, job {} start".format(job["name"]))
+        error = None
+        try:
+            run_job(job)
+        except Exception:
+            error = traceback.format_exc()
+            write_log(error)
+        with self.lock:
+            state["status"] = "idle"
+            state["last_end"] = time.time()
+            state["last_status"] = "fail" if error else "success"
+            state["last_error"] = error.strip().splitlines()[-1] if error else None
+            state["runs"] += 1
+            state["failures"] += 1 if error else 0
+            state["next_run"] = get_next_run_time(job, state["last_start"])
+        write_log("scheduler, job {} {}, use seconds: {:.2f}s".format(
+            job["name"], state["last_status"], state["last_end"] - state["last_start"]))
+        self.save_state()
+
+    def run_forever(self):
+        tick_seconds = float(get_scheduler_config().get("tick_seconds", 30))
+        self.save_state()
+        while not self.stopped.is_set():
+            if self.tick():
+                self.save_state()
+            self.stopped.wait(tick_seconds)
+        write_log("scheduler stopping, wait for running jobs: {}".format(
+            ",".join(job["name"] for job, state in self.jobs if state["status"] == "running") or "-"))
+        for thread in self.threads:
+            thread.join()
+
+    def stop(self, *args):
+        self.stopped.set()
+
+
+class SchedulerStatusHandler(BaseHTTPRequestHandler):
+    """
+    输出调度任务状态：GET /jobs
+    """
+    scheduler = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/jobs":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps(SchedulerStatusHandler.scheduler.get_state(), indent=2).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_scheduler():
+    """
+    常驻调度进程（--daemon）：配置只加载一次、运行环境只检查一次，之后按计划运行备份任务，收到 SIGTERM/SIGINT 时
+    不再启动新任务，等待运行中的任务结束后退出
+    """
+    write_log("=========================== start : backup scheduler ==========================")
+    prepare_runtime_env()
+    set_process_priority()
+    scheduler = BackupScheduler()
+    for job, state in scheduler.jobs:
+        write_log("scheduler, job {}, next run: {}".format(
+            job["name"], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state["next_run"]))))
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+    status_port = int(get_scheduler_config().get("status_port", 0))
+    if status_port:
+        SchedulerStatusHandler.scheduler = scheduler
+        server = ThreadingHTTPServer(("", status_port), SchedulerStatusHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        write_log("scheduler status server listen on port: {}, path: /jobs".format(status_port))
+    scheduler.run_forever()
+    write_log("=========================== end : backup scheduler ==========================")
+
+
+def show_scheduler_status():
+    """
+    汇总显示各主机上传到oss的调度任务状态（--status）
+    """
+    bucket = get_oss_bucket()
+    for obj in oss2.ObjectIterator(bucket, prefix="scheduler/"):
+        if not obj.key.endswith(".json"):
+            continue
+        state = json.loads(bucket.get_object(obj.key).read())
+        print("{host_ip}  (update: {update_time}, load: {load_ratio}, io pressure: {io_pressure})".format(
+            host_ip=state.get("host_ip"), update_time=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state["update_time"])),
+            load_ratio=state.get("load_ratio"), io_pressure=state.get("io_pressure")))
+        for job in state.get("jobs", []):
+            last_start = job.get("last_start")
+            print("    {name:<16}{status:<10}next: {next_run}  last: {last_start} {last_status}  runs: {runs}  failures: {failures}{detail}".format(
+                name=job["name"], status=job["status"],
+                next_run=time.strftime('%Y-%m-%d %H:%M', time.localtime(job["next_run"])),
+                last_start=time.strftime('%Y-%m-%d %H:%M', time.localtime(last_start)) if last_start else "-",
+                last_status=job.get("last_status") or "-", runs=job.get("runs", 0), failures=job.get("failures", 0),
+                detail="  ({})".format(job.get("wait_reason") or job.get("last_error")) if job.get("wait_reason") or job.get("last_error") else ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="backup mysql databases to aliyun oss")
+    parser.add_argument("db_names", nargs="*", help="databases to backup")
+    parser.add_argument("--all", action="store_true", help="backup all databases matched by db_include/db_exclude")
+    parser.add_argument("--restore", metavar="OSS_KEY", help="restore a parallel dump backup from oss")
+    parser.add_argument("--restore-db", help="database to restore into")
+    parser.add_argument("--binlog", action="store_true", help="take a base backup when due, then ship rotated binlogs")
+    parser.add_argument("--binlog-restore", metavar="UNTIL", help="point-in-time restore until '%%Y-%%m-%%d %%H:%%M:%%S'")
+    parser.add_argument("--host-ip", help="host ip (oss key prefix) of the backups to restore, default is this host")
+    parser.add_argument("--daemon", action="store_true", help="run as a scheduler daemon, see scheduler config")
+    parser.add_argument("--status", action="store_true", help="show scheduler job state of all hosts from oss")
+    args = parser.parse_args()
+
+    if args.status:
+        show_scheduler_status()
+        sys.exit(0)
+
+    if args.daemon:
+        run_scheduler()
+        sys.exit(0)
+
+    if args.binlog_restore:
+        restore_binlog_pitr(args.binlog_restore, args.host_ip)
+        sys.exit(0)
+
+    if args.binlog:
+        run_binlog_backup()
+        sys.exit(0)
+
+    if args.restore:
+        if not args.restore_db:
+            parser.error("--restore-db is required with --restore")
+        restore_from_oss(args.restore, args.restore_db)
+        sys.exit(0)
+
+    prepare_runtime_env()
+    if not run_database_backup(None if args.all else args.db_names):
+        sys.exit(1)
@@ -1,8 +1,15 @@
-import copy
+import contextlib
+import hashlib
+import itertools
 import json
+import math
 import os
+import random
+import threading
 import time
-from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, urlparse
 
 import gitlab
 import requests
@@ -17,30 +24,217 @@ class Constant:
     ENV_SPINNAKER_PASSWORD = "SPINNAKER_PASSWORD"
     ENV_SPINNAKER_PARAM_GIT_URL_NAME = "SPINNAKER_PARAM_GIT_URL_NAME"
     ENV_SPINNAKER_PARAM_BRANCH_OR_TAG = "SPINNAKER_PARAM_BRANCH_OR_TAG"
+    ENV_SYNC_THREADS = "SYNC_THREADS"
+    ENV_GITLAB_MAX_CONCURRENCY = "GITLAB_MAX_CONCURRENCY"
+    ENV_SPINNAKER_MAX_CONCURRENCY = "SPINNAKER_MAX_CONCURRENCY"
+    ENV_GIT_REF_CACHE_TTL_SECOND = "GIT_REF_CACHE_TTL_SECOND"
+    ENV_WEBHOOK_PORT = "WEBHOOK_PORT"
+    ENV_WEBHOOK_SECRET_TOKEN = "WEBHOOK_SECRET_TOKEN"
+    ENV_RECONCILE_PERIOD_SECOND = "RECONCILE_PERIOD_SECOND"
+    ENV_GIT_REF_MAX_OPTIONS = "GIT_REF_MAX_OPTIONS"
+    ENV_GIT_REF_MAX_STALE_SECOND = "GIT_REF_MAX_STALE_SECOND"
+    ENV_PIPELINE_INDEX_FILE = "PIPELINE_INDEX_FILE"
+    ENV_PIPELINE_INDEX_REFRESH_SECOND = "PIPELINE_INDEX_REFRESH_SECOND"
+    ENV_SPINNAKER_UPDATE_CONCURRENCY = "SPINNAKER_UPDATE_CONCURRENCY"
+    ENV_SPINNAKER_UPDATE_RATE = "SPINNAKER_UPDATE_RATE"
+    ENV_SPINNAKER_UPDATE_RETRY = "SPINNAKER_UPDATE_RETRY"
+    ENV_METRICS_PORT = "METRICS_PORT"
+    ENV_LOG_LEVEL = "LOG_LEVEL"
+    # LOG_LEVEL=DEBUG 时才打印详细的数据（application 列表、pipeline 更新前后的选项）
+    DEBUG = os.getenv(ENV_LOG_LEVEL, "INFO").upper() == "DEBUG"
+
+
+class Metrics:
+    """
+    同步过程的指标：周期耗时、GitLab/Spinnaker 各接口的耗时直方图和失败数、pipeline 同步结果计数，
+    以 Prometheus 文本格式在 METRICS_PORT 端口的 /metrics 输出
+    """
+    prefix = "spinnaker_tag_sync_"
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+    lock = threading.Lock()
+    # {(name, labels): {"count", "sum", "buckets"}}
+    histograms = {}
+    # {(name, labels): value}
+    counters = {}
+    gauges = {}
+
+    @staticmethod
+    def get_labels(labels):
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def observe(name, value, **labels):
+        key = (name, Metrics.get_labels(labels))
+        with Metrics.lock:
+            histogram = Metrics.histograms.setdefault(key, {"count": 0, "sum": 0.0,
+                                                            "buckets": [0] * len(Metrics.buckets)})
+            histogram["count"] += 1
+            histogram["sum"] += value
+            for i, bucket in enumerate(Metrics.buckets):
+                if value <= bucket:
+                    histogram["buckets"][i] += 1
+
+    @staticmethod
+    def inc(name, value=1, **labels):
+        key = (name, Metrics.get_labels(labels))
+        with Metrics.lock:
+            Metrics.counters[key] = Metrics.counters.get(key, 0) + value
+
+    @staticmethod
+    def set(name, value, **labels):
+        with Metrics.lock:
+            Metrics.gauges[(name, Metrics.get_labels(labels))] = value
+
+    @staticmethod
+    @contextlib.contextmanager
+    def timer(api, method):
+        """
+        记录一次接口调用的耗时，调用抛出异常时同时计入失败数
+        :param api: gitlab / spinnaker
+        :param method: 方法名
+        :return:
+        """
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            Metrics.inc("api_errors_total", api=api, method=method)
+            raise
+        finally:
+            Metrics.observe("api_request_seconds", time.time() - start, api=api, method=method)
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join('{0}="{1}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+    @staticmethod
+    def render():
+        """
+        生成 Prometheus 文本格式的指标
+        :return:
+        """
+        lines = []
+
+        def __add_type(name, metric_type):
+            line = "# TYPE {0}{1} {2}".format(Metrics.prefix, name, metric_type)
+            if line not in lines:
+                lines.append(line)
+
+        with Metrics.lock:
+            for (name, labels), value in sorted(Metrics.counters.items()):
+                __add_type(name, "counter")
+                lines.append("{0}{1}{2} {3}".format(Metrics.prefix, name, Metrics.format_labels(labels), value))
+            for (name, labels), value in sorted(Metrics.gauges.items()):
+                __add_type(name, "gauge")
+                lines.append("{0}{1}{2} {3}".format(Metrics.prefix, name, Metrics.format_labels(labels), value))
+            for (name, labels), histogram in sorted(Metrics.histograms.items()):
+                __add_type(name, "histogram")
+                for i, bucket in enumerate(Metrics.buckets):
+                    lines.append("{0}{1}_bucket{2} {3}".format(
+                        Metrics.prefix, name, Metrics.format_labels(labels, [("le", bucket)]), histogram["buckets"][i]))
+                lines.append("{0}{1}_bucket{2} {3}".format(
+                    Metrics.prefix, name, Metrics.format_labels(labels, [("le", "+Inf")]), histogram["count"]))
+                lines.append("{0}{1}_sum{2} {3}".format(Metrics.prefix, name, Metrics.format_labels(labels),
+                                                        histogram["sum"]))
+                lines.append("{0}{1}_count{2} {3}".format(Metrics.prefix, name, Metrics.format_labels(labels),
+                                                          histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+
+def new_http_session(pool_size):
+    """
+    创建复用连接（keep-alive）的 HTTP 会话，连接池大小和访问该服务的最大并发请求数一致，
+    并发请求时不会因为连接池不够用而频繁新建连接（重新握手）
+    :param pool_size: 连接池大小
+    :return: requests.Session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
 class GitLabApi:
     url = os.getenv(Constant.ENV_GITLAB_HOST, "<hidden>")
     private_token = os.getenv(Constant.ENV_GITLAB_PRIVATE_TOKEN, "<hidden>")
     client = None
+    # 同时访问 GitLab 的请求数上限，避免并发同步时压垮 GitLab
+    max_concurrency = int(os.getenv(Constant.ENV_GITLAB_MAX_CONCURRENCY, 8))
+    semaphore = threading.BoundedSemaphore(max_concurrency)
+    page_size = 100
+    # 分支和标签各自最多保留的选项数，0 表示不限制
+    max_options = int(os.getenv(Constant.ENV_GIT_REF_MAX_OPTIONS, 200))
 
     @staticmethod
     def login():
         """
-        登录
+        登录：客户端只创建一次，之后的同步周期和 webhook 同步都复用同一个客户端和连接池
         :return:
         """
-        GitLabApi.client = gitlab.Gitlab(GitLabApi.url, private_token=GitLabApi.private_token)
+        if GitLabApi.client is None:
+            GitLabApi.client = gitlab.Gitlab(GitLabApi.url, private_token=GitLabApi.private_token,
+                                             session=new_http_session(GitLabApi.max_concurrency))
 
     @staticmethod
     def get_project_path(project_url):
-        project_path = urlparse(project_url).path
+        project_url = project_url.strip()
+        if "://" not in project_url and ":" in project_url:
+            # scp 形式的 ssh 地址，比如 git@gitlab.example.com:group/project.git
+            project_path = project_url.split(":", 1)[1]
+        else:
+            project_path = urlparse(project_url).path
+        project_path = project_path.rstrip("/")
         if project_path.endswith(".git"):
             project_path = project_path[:len(project_path) - 4]
         if project_path.startswith("/"):
             project_path = project_path[1:]
         return project_path
 
+    @staticmethod
+    def get_project(project_url):
+        """
+        获取项目（一次请求，可以通过 last_activity_at 判断项目是否有变化）
+        :param project_url:
+        :return:
+        """
+        project_path = GitLabApi.get_project_path(project_url)
+        with GitLabApi.semaphore, Metrics.timer("gitlab", "get_project"):
+            return GitLabApi.client.projects.get(project_path)
+
+    @staticmethod
+    def list_branches(project):
+        """
+        获取项目的全部分支（分页遍历），按分支名排序，最多返回 GIT_REF_MAX_OPTIONS 个
+        （不按提交时间排序：否则每次推送都会打乱选项顺序，导致项目下所有 pipeline 都被重写）
+        :param project:
+        :return:
+        """
+        with GitLabApi.semaphore, Metrics.timer("gitlab", "list_branches"):
+            branch_obj_list = list(project.branches.list(iterator=True, per_page=GitLabApi.page_size))
+        branch_names = sorted(map(lambda branch: branch.name, branch_obj_list))
+        if GitLabApi.max_options > 0:
+            branch_names = branch_names[:GitLabApi.max_options]
+        return branch_names
+
+    @staticmethod
+    def list_tags(project):
+        """
+        获取项目的标签（分页遍历），按更新时间倒序，取够 GIT_REF_MAX_OPTIONS 个后不再请求后面的页
+        :param project:
+        :return:
+        """
+        with GitLabApi.semaphore, Metrics.timer("gitlab", "list_tags"):
+            tags_obj_iter = project.tags.list(iterator=True, per_page=GitLabApi.page_size, order_by="updated",
+                                              sort="desc")
+            if GitLabApi.max_options > 0:
+                tags_obj_iter = itertools.islice(tags_obj_iter, GitLabApi.max_options)
+            tags_obj_list = list(tags_obj_iter)
+        return list(map(lambda tag: tag.name, tags_obj_list))
+
     @staticmethod
     def get_branches(project_url):
         """
@@ -48,17 +242,106 @@ class GitLabApi:
         :param project_url:
         :return:
         """
-        project_path = GitLabApi.get_project_path(project_url)
-        project = GitLabApi.client.projects.get(project_path)
-        branch_obj_list = project.branches.list(page=1, per_page=100)
-        return list(map(lambda branch: branch.name, branch_obj_list))
+        return GitLabApi.list_branches(GitLabApi.get_project(project_url))
 
     @staticmethod
     def get_tags(project_url):
-        project_path = GitLabApi.get_project_path(project_url)
-        project = GitLabApi.client.projects.get(project_path)
-        tags_obj_list = project.tags.list(page=1, per_page=100)
-        return list(map(lambda branch: branch.name, tags_obj_list))
+        return GitLabApi.list_tags(GitLabApi.get_project(project_url))
+
+    @staticmethod
+    def get_refs(project_url):
+        """
+        获取所有分支和标签（只查询一次项目）
+        :param project_url:
+        :return: (branches, tags)
+        """
+        project = GitLabApi.get_project(project_url)
+        return GitLabApi.list_branches(project), GitLabApi.list_tags(project)
+
+
+class GitRefCache:
+    """
+    按规范化的项目路径缓存 GitLab 的分支和标签。多个pipeline（dev/staging/prod等）引用同一个项目时，
+    一个同步周期内只查询一次；GIT_REF_CACHE_TTL_SECOND 大于 0 时缓存在有效期内可以跨周期使用，不发请求。
+    跨周期时先查询项目，last_activity_at 没有变化就沿用上次的结果，只花一次请求。GitLab 对 last_activity_at
+    的更新有节流（约一小时一次），所以缓存最长只沿用 GIT_REF_MAX_STALE_SECOND 秒，超过后重新获取
+    """
+    ttl = int(os.getenv(Constant.ENV_GIT_REF_CACHE_TTL_SECOND, 0))
+    max_stale = int(os.getenv(Constant.ENV_GIT_REF_MAX_STALE_SECOND, 3600))
+    lock = threading.Lock()
+    entries = {}
+    cycle = 0
+    hits = 0
+    unchanged = 0
+    misses = 0
+
+    @staticmethod
+    def get_refs(project_url):
+        """
+        获取项目的分支和标签，优先使用缓存
+        :param project_url:
+        :return: (branches, tags)
+        """
+        project_key = GitLabApi.get_project_path(project_url).lower()
+        with GitRefCache.lock:
+            entry = GitRefCache.entries.setdefault(project_key, {"lock": threading.Lock(), "refs": None, "time": 0,
+                                                                 "activity": None, "cycle": -1})
+        # 同一个项目的并发查询只有一个线程访问 GitLab，其他线程等待并使用它的结果
+        with entry["lock"]:
+            now = time.time()
+            with GitRefCache.lock:
+                if entry["refs"] is not None and (entry["cycle"] == GitRefCache.cycle
+                                                  or now - entry["time"] < GitRefCache.ttl):
+                    GitRefCache.hits += 1
+                    return entry["refs"]
+            project = GitLabApi.get_project(project_url)
+            activity = getattr(project, "last_activity_at", None)
+            with GitRefCache.lock:
+                if entry["refs"] is not None and activity and activity == entry["activity"] \
+                        and now - entry["time"] < GitRefCache.max_stale:
+                    GitRefCache.unchanged += 1
+                    entry["cycle"] = GitRefCache.cycle
+                    return entry["refs"]
+                GitRefCache.misses += 1
+            refs = GitLabApi.list_branches(project), GitLabApi.list_tags(project)
+            entry["refs"] = refs
+            entry["time"] = now
+            entry["activity"] = activity
+            entry["cycle"] = GitRefCache.cycle
+            return refs
+
+    @staticmethod
+    def invalidate(project_path):
+        """
+        删除项目的缓存（收到项目的 push/tag 事件时调用）
+        :param project_path:
+        :return:
+        """
+        with GitRefCache.lock:
+            GitRefCache.entries.pop(project_path.lower(), None)
+
+    @staticmethod
+    def new_cycle():
+        """
+        开始新的同步周期：删除已经不能再使用的缓存（不再被引用的项目），重置命中计数
+        :return:
+        """
+        now = time.time()
+        with GitRefCache.lock:
+            GitRefCache.cycle += 1
+            max_age = max(GitRefCache.ttl, GitRefCache.max_stale)
+            for project_key in list(GitRefCache.entries.keys()):
+                if now - GitRefCache.entries[project_key]["time"] >= max_age:
+                    del GitRefCache.entries[project_key]
+            GitRefCache.hits = 0
+            GitRefCache.unchanged = 0
+            GitRefCache.misses = 0
+
+    @staticmethod
+    def stats():
+        return "git ref cache, projects: {size}, hit: {hits}, unchanged: {unchanged}, miss: {misses}".format(
+            size=len(GitRefCache.entries), hits=GitRefCache.hits, unchanged=GitRefCache.unchanged,
+            misses=GitRefCache.misses)
 
 
 class SpinnakerGateApi:
@@ -67,21 +350,51 @@ class SpinnakerGateApi:
     password = os.getenv(Constant.ENV_SPINNAKER_PASSWORD, "<hidden>")
     param_of_git_url = os.getenv(Constant.ENV_SPINNAKER_PARAM_GIT_URL_NAME, "git_url")
     param_of_branch_or_tag = os.getenv(Constant.ENV_SPINNAKER_PARAM_BRANCH_OR_TAG, "branch_or_tag")
-    session = requests.Session()
+    # 同时访问 Spinnaker Gate 的请求数上限
+    max_concurrency = int(os.getenv(Constant.ENV_SPINNAKER_MAX_CONCURRENCY, 4))
+    semaphore = threading.BoundedSemaphore(max_concurrency)
+    session = new_http_session(max_concurrency)
+    login_lock = threading.Lock()
+    # 登录次数，会话失效时用来判断是否已经被其他线程重新登录
+    login_count = 0
 
     @staticmethod
-    def login():
+    def login(expired_count=None):
         """
-        登录
+        登录：会话（cookie）在同步周期之间复用，只在第一次和会话失效（Gate 返回 401）时登录
+        :param expired_count: 发现会话失效的请求发出时的登录次数，为空时只在还没有登录过时登录
         :return:
         """
-        headers = {"Content-Type": "application/x-www-form-urlencoded"}
-        params = {
-            "username": SpinnakerGateApi.username,
-            "password": SpinnakerGateApi.password,
-            "submit": "Login"
-        }
-        SpinnakerGateApi.session.post(SpinnakerGateApi.url + "/login", params=params, headers=headers)
+        with SpinnakerGateApi.login_lock:
+            if expired_count is None and SpinnakerGateApi.login_count > 0:
+                return
+            if expired_count is not None and expired_count != SpinnakerGateApi.login_count:
+                # 其他线程已经重新登录过
+                return
+            headers = {"Content-Type": "application/x-www-form-urlencoded"}
+            params = {
+                "username": SpinnakerGateApi.username,
+                "password": SpinnakerGateApi.password,
+                "submit": "Login"
+            }
+            with Metrics.timer("spinnaker", "login"):
+                SpinnakerGateApi.session.post(SpinnakerGateApi.url + "/login", params=params, headers=headers)
+            SpinnakerGateApi.login_count += 1
+
+    @staticmethod
+    def request(method, path, **kwargs):
+        """
+        请求 Gate 接口，返回 401（会话失效）时重新登录后再请求一次
+        :param method: 请求方法
+        :param path: 接口路径
+        :return: requests.Response
+        """
+        login_count = SpinnakerGateApi.login_count
+        resp = SpinnakerGateApi.session.request(method, SpinnakerGateApi.url + path, **kwargs)
+        if resp.status_code == 401:
+            SpinnakerGateApi.login(login_count)
+            resp = SpinnakerGateApi.session.request(method, SpinnakerGateApi.url + path, **kwargs)
+        return resp
 
     @staticmethod
     def get_all_applications():
@@ -89,7 +402,8 @@ class SpinnakerGateApi:
         获取所有的application，包含spinnaker从kubernetes自动抓取的app
         :return:
         """
-        resp = SpinnakerGateApi.session.get(SpinnakerGateApi.url + "/applications", timeout=5)
+        with SpinnakerGateApi.semaphore, Metrics.timer("spinnaker", "get_all_applications"):
+            resp = SpinnakerGateApi.request("GET", "/applications", timeout=5)
         return resp.json()
 
     @staticmethod
@@ -104,35 +418,293 @@ class SpinnakerGateApi:
 
     @staticmethod
     def get_pipelines(app_name):
-        resp = SpinnakerGateApi.session.get(
-            SpinnakerGateApi.url + "/applications/{app}/pipelineConfigs".format(app=app_name), timeout=5)
+        with SpinnakerGateApi.semaphore, Metrics.timer("spinnaker", "get_pipelines"):
+            resp = SpinnakerGateApi.request(
+                "GET", "/applications/{app}/pipelineConfigs".format(app=app_name), timeout=5)
+        return resp.json()
+
+    @staticmethod
+    def get_pipeline(app_name, pipeline_name):
+        """
+        获取单个pipeline
+        :param app_name:
+        :param pipeline_name:
+        :return:
+        """
+        with SpinnakerGateApi.semaphore, Metrics.timer("spinnaker", "get_pipeline"):
+            resp = SpinnakerGateApi.request(
+                "GET", "/applications/{app}/pipelineConfigs/{name}".format(
+                    app=app_name, name=quote(pipeline_name, safe="")), timeout=5)
+        if resp.status_code != 200:
+            raise Exception("pipeline get, status: {status_code}, response: {response_body}"
+                            .format(status_code=resp.status_code, response_body=resp.text))
         return resp.json()
 
     @staticmethod
     def update_pipeline(data):
         """
-        更新Pipeline
+        更新Pipeline，Gate 返回 429 或 5xx 时按 Retry-After 或指数退避重试
         :param data: pipeline 数据
         :return:
         """
         headers = {
             "Content-Type": "application/json;charset=UTF-8"
         }
-        resp = SpinnakerGateApi.session.post(SpinnakerGateApi.url + "/pipelines", json=data, headers=headers,
-                                             timeout=20)
-        if resp.status_code != 200:
+        attempt = 0
+        while True:
+            PipelineUpdateQueue.acquire()
+            with SpinnakerGateApi.semaphore, Metrics.timer("spinnaker", "update_pipeline"):
+                resp = SpinnakerGateApi.request("POST", "/pipelines", json=data, headers=headers, timeout=20)
+            if resp.status_code == 200:
+                return
+            if (resp.status_code == 429 or resp.status_code >= 500) and attempt < PipelineUpdateQueue.max_retries:
+                attempt += 1
+                retry_after = resp.headers.get("Retry-After", "")
+                delay = int(retry_after) if retry_after.isdigit() else 2 ** attempt
+                time.sleep(delay + random.uniform(0, 1))
+                continue
             raise Exception("pipeline update, status: {status_code}, response: {response_body}"
                             .format(status_code=resp.status_code, response_body=resp.text))
 
 
+class PipelineUpdateQueue:
+    """
+    pipeline 更新队列：变化的pipeline提交后由固定数量的线程并发写入 Gate，写入速率受 SPINNAKER_UPDATE_RATE（每秒请求数）限制。
+    同一个pipeline还没开始写入时再次提交，只保留最新的数据，合并为一次写入
+    """
+    executor = ThreadPoolExecutor(max_workers=int(os.getenv(Constant.ENV_SPINNAKER_UPDATE_CONCURRENCY, 4)))
+    rate = float(os.getenv(Constant.ENV_SPINNAKER_UPDATE_RATE, 5))
+    max_retries = int(os.getenv(Constant.ENV_SPINNAKER_UPDATE_RETRY, 3))
+    lock = threading.Lock()
+    pending = {}
+    next_time = 0
+
+    @staticmethod
+    def submit(pipeline):
+        """
+        提交pipeline更新
+        :param pipeline:
+        :return: Future
+        """
+        key = pipeline.get("id") or pipeline["name"]
+        with PipelineUpdateQueue.lock:
+            item = PipelineUpdateQueue.pending.get(key)
+            if item:
+                item["data"] = pipeline
+                return item["future"]
+            item = {"data": pipeline}
+            PipelineUpdateQueue.pending[key] = item
+            item["future"] = PipelineUpdateQueue.executor.submit(PipelineUpdateQueue.run, key)
+            return item["future"]
+
+    @staticmethod
+    def run(key):
+        with PipelineUpdateQueue.lock:
+            item = PipelineUpdateQueue.pending.pop(key)
+        SpinnakerGateApi.update_pipeline(item["data"])
+
+    @staticmethod
+    def acquire():
+        """
+        按 SPINNAKER_UPDATE_RATE 限速，必要时等待
+        :return:
+        """
+        if PipelineUpdateQueue.rate <= 0:
+            return
+        with PipelineUpdateQueue.lock:
+            now = time.time()
+            wait = max(0, PipelineUpdateQueue.next_time - now)
+            PipelineUpdateQueue.next_time = max(now, PipelineUpdateQueue.next_time) + 1 / PipelineUpdateQueue.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class PipelineIndex:
+    """
+    项目路径到引用它的pipeline的索引，保存到本地文件，重启后继续使用：
+    pipelines: {pipeline_id: {"app", "name", "update_ts", "project", "params", "options_digest"}}
+    synced: {项目路径: 上次同步成功时分支和标签的摘要}
+    每隔 PIPELINE_INDEX_REFRESH_SECOND 秒重新枚举一次 app 和 pipeline，updateTs 没变的 pipeline 沿用已有的索引项，
+    其余时间的同步只遍历索引中的项目，分支和标签有变化时才获取和更新对应的pipeline
+    """
+    file = os.getenv(Constant.ENV_PIPELINE_INDEX_FILE,
+                     os.path.join(os.path.dirname(os.path.abspath(__file__)), "pipeline_index.json"))
+    refresh_period = int(os.getenv(Constant.ENV_PIPELINE_INDEX_REFRESH_SECOND, 3600))
+    lock = threading.Lock()
+    pipelines = {}
+    synced = {}
+    refresh_time = 0
+
+    @staticmethod
+    def load():
+        """
+        从本地文件加载索引
+        :return:
+        """
+        if not os.path.exists(PipelineIndex.file):
+            return
+        try:
+            with open(PipelineIndex.file, "r") as f:
+                data = json.load(f)
+            with PipelineIndex.lock:
+                PipelineIndex.pipelines = data.get("pipelines", {})
+                PipelineIndex.synced = data.get("synced", {})
+                PipelineIndex.refresh_time = data.get("refresh_time", 0)
+        except Exception as ex:
+            print("load pipeline index fail: {0}".format(ex))
+
+    @staticmethod
+    def save():
+        """
+        保存索引到本地文件（先写临时文件再替换，避免中断时损坏）
+        :return:
+        """
+        with PipelineIndex.lock:
+            data = {"pipelines": PipelineIndex.pipelines, "synced": PipelineIndex.synced,
+                    "refresh_time": PipelineIndex.refresh_time}
+            tmp_file = PipelineIndex.file + ".tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_file, PipelineIndex.file)
+
+    @staticmethod
+    def need_refresh():
+        return not PipelineIndex.pipelines or time.time() - PipelineIndex.refresh_time >= PipelineIndex.refresh_period
+
+    @staticmethod
+    def get_index_entry(app_name, pipeline):
+        """
+        生成pipeline的索引项
+        :param app_name:
+        :param pipeline:
+        :return: 没有git地址参数或分支/标签参数时 project 为 None
+        """
+        params = dict((param.get("name"), param) for param in pipeline.get("parameterConfig") or [])
+        param_git_url = params.get(SpinnakerGateApi.param_of_git_url)
+        project_url = param_git_url.get("default") if param_git_url else None
+        project = None
+        if project_url and project_url.strip() and SpinnakerGateApi.param_of_branch_or_tag in params:
+            project = GitLabApi.get_project_path(project_url).lower()
+        return {
+            "app": app_name,
+            "name": pipeline["name"],
+            "update_ts": pipeline.get("updateTs"),
+            "project": project,
+            "params": [SpinnakerGateApi.param_of_git_url, SpinnakerGateApi.param_of_branch_or_tag]
+        }
+
+    @staticmethod
+    def refresh(app_pipelines):
+        """
+        根据最新的pipeline列表增量刷新索引：updateTs 没变的沿用旧的索引项，新增或修改过的重新解析，
+        并让它们引用的项目在本周期重新同步
+        :param app_pipelines: [(app_name, pipeline)]
+        :return: 新增/修改/删除的pipeline数
+        """
+        with PipelineIndex.lock:
+            old_pipelines = PipelineIndex.pipelines
+            pipelines = {}
+            changed_projects = set()
+            changed = 0
+            for app_name, pipeline in app_pipelines:
+                if "id" not in pipeline:
+                    continue
+                entry = old_pipelines.get(pipeline["id"])
+                if not entry or entry["update_ts"] != pipeline.get("updateTs") \
+                        or entry["params"] != [SpinnakerGateApi.param_of_git_url,
+                                               SpinnakerGateApi.param_of_branch_or_tag]:
+                    entry = PipelineIndex.get_index_entry(app_name, pipeline)
+                    changed_projects.add(entry["project"])
+                    changed += 1
+                pipelines[pipeline["id"]] = entry
+            for pipeline_id in set(old_pipelines.keys()) - set(pipelines.keys()):
+                changed_projects.add(old_pipelines[pipeline_id]["project"])
+                changed += 1
+            for project in changed_projects:
+                PipelineIndex.synced.pop(project, None)
+            projects = set(entry["project"] for entry in pipelines.values())
+            for project in list(PipelineIndex.synced.keys()):
+                if project not in projects:
+                    del PipelineIndex.synced[project]
+            PipelineIndex.pipelines = pipelines
+            PipelineIndex.refresh_time = time.time()
+            return changed
+
+    @staticmethod
+    def projects():
+        with PipelineIndex.lock:
+            return sorted(set(entry["project"] for entry in PipelineIndex.pipelines.values() if entry["project"]))
+
+    @staticmethod
+    def lookup(project_path):
+        """
+        获取引用了项目的pipeline
+        :param project_path:
+        :return: [(app_name, pipeline_name, pipeline_id)]
+        """
+        project_key = project_path.lower()
+        with PipelineIndex.lock:
+            return sorted((entry["app"], entry["name"], pipeline_id)
+                          for pipeline_id, entry in PipelineIndex.pipelines.items()
+                          if entry["project"] == project_key)
+
+    @staticmethod
+    def get_options_digest(pipeline_id):
+        with PipelineIndex.lock:
+            entry = PipelineIndex.pipelines.get(pipeline_id)
+            return entry.get("options_digest") if entry else None
+
+    @staticmethod
+    def set_options_digest(pipeline_id, options_digest):
+        with PipelineIndex.lock:
+            entry = PipelineIndex.pipelines.get(pipeline_id)
+            if entry:
+                entry["options_digest"] = options_digest
+
+    @staticmethod
+    def get_refs_digest(refs):
+        return hashlib.sha1(json.dumps(refs).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def is_synced(project_path, refs):
+        with PipelineIndex.lock:
+            return PipelineIndex.synced.get(project_path.lower()) == PipelineIndex.get_refs_digest(refs)
+
+    @staticmethod
+    def mark_synced(project_path, refs):
+        with PipelineIndex.lock:
+            PipelineIndex.synced[project_path.lower()] = PipelineIndex.get_refs_digest(refs)
+
+
+def get_option_values(refs):
+    """
+    根据分支和标签生成参数的选项值
+    :param refs: (branches, tags)
+    :return:
+    """
+    branches, tags = refs
+    return list(map(lambda x: "branch-" + x, branches)) + list(tags)
+
+
+def get_options_digest(values):
+    """
+    选项值的指纹（稳定的哈希，与顺序无关），用于判断选项是否有变化
+    :param values:
+    :return:
+    """
+    return hashlib.sha1("\n".join(sorted(values)).encode("utf-8")).hexdigest()
+
+
 def update_pipeline_param_of_git(pipeline):
     """
-    更新pipeline下对应参数中的git branch 和 tag 选项值
+    更新pipeline下对应参数中的git branch 和 tag 选项值（只修改pipeline数据，写入 Gate 由 PipelineUpdateQueue 完成）
     :param pipeline:
-    :return: （status,message）
+    :return: （status,message,选项指纹,修改前的选项）
     """
     status = "fail"
     message = ""
+    options_digest = None
+    old_options = None
 
     class SkipException(Exception):
         def __init__(self, err):
@@ -160,14 +732,14 @@ def update_pipeline_param_of_git(pipeline):
         project_url = param_git_url["default"]
         if not project_url or not project_url.strip():
             raise SkipException("pipeline/parameterConfig [{0}] no default value".format(param_1))
-        branches = GitLabApi.get_branches(project_url)
-        tags = GitLabApi.get_tags(project_url)
-        branches = list(map(lambda x: "branch-" + x, branches))
-        options = branches + tags
-        options = list(map(lambda x: {"value": x}, options))
-        if not param_branch_or_tag["options"] == options:
-            param_branch_or_tag["options"] = options
-            SpinnakerGateApi.update_pipeline(pipeline)
+        values = get_option_values(GitRefCache.get_refs(project_url))
+        options_digest = get_options_digest(values)
+        old_options = param_branch_or_tag.get("options") or []
+        old_values = list(map(lambda x: x.get("value"), old_options))
+        # 只比较选项集合，顺序变化不触发写入
+        if len(old_values) != len(values) or set(old_values) != set(values) \
+                or any(len(x) != 1 for x in old_options):
+            param_branch_or_tag["options"] = list(map(lambda x: {"value": x}, values))
             status = "success"
         else:
             raise SkipException("pipeline/parameterConfig [{0}] options value not change".format(param_2))
@@ -177,35 +749,260 @@ def update_pipeline_param_of_git(pipeline):
     except Exception as ex:
         # traceback.print_exc()
         message = str(ex)
-    return status, message
+    return status, message, options_digest, old_options
+
+
+def print_sync_result(app_name, pipeline_name, status, message, old_options=None, new_options=None):
+    """
+    打印单个pipeline的同步结果并计数，LOG_LEVEL=DEBUG 时才序列化更新的pipeline的新旧选项
+    :return:
+    """
+    Metrics.inc("pipeline_sync_total", status=status)
+    if Constant.DEBUG and status == "success":
+        print("|---- {app_name}/{pipe_name}/update {status} | {message} | old: {old} | new: {new}"
+              .format(app_name=app_name, pipe_name=pipeline_name, status=status,
+                      message=message, old=json.dumps(old_options), new=json.dumps(new_options)))
+    else:
+        print("|---- {app_name}/{pipe_name}/update {status} | {message}"
+              .format(app_name=app_name, pipe_name=pipeline_name, status=status, message=message))
+
+
+def refresh_pipeline_index(executor):
+    """
+    枚举所有application下的pipeline（各app并发获取），增量刷新索引
+    :param executor:
+    :return:
+    """
+    apps = SpinnakerGateApi.get_created_applications()
+    if Constant.DEBUG:
+        print("|-- applications: {0}".format(json.dumps(apps)))
+    else:
+        print("|-- applications: {0}".format(len(apps)))
+    pipeline_futures = []
+    for app in apps:
+        try:
+            app_name = app["name"]
+            pipeline_futures.append((app_name, executor.submit(SpinnakerGateApi.get_pipelines, app_name)))
+        except Exception as ex:
+            print(ex)
+    app_pipelines = []
+    for app_name, future in pipeline_futures:
+        try:
+            for pipeline in future.result():
+                app_pipelines.append((app_name, pipeline))
+        except Exception as ex:
+            print(ex)
+    changed = PipelineIndex.refresh(app_pipelines)
+    print("|-- pipeline index refreshed, pipelines: {count}, changed: {changed}".format(
+        count=len(app_pipelines), changed=changed))
+
+
+def sync_project(project_path):
+    """
+    同步引用了指定项目的pipeline：分支和标签与上次同步成功时相同则跳过；否则选项指纹与上次写入时相同的pipeline也跳过，
+    其余的逐个获取，选项有变化的提交到 PipelineUpdateQueue 并等待写入完成
+    :param project_path: 项目路径，比如 group/project
+    :return:
+    """
+    try:
+        refs = GitRefCache.get_refs(project_path)
+        if PipelineIndex.is_synced(project_path, refs):
+            return
+        expected_digest = get_options_digest(get_option_values(refs))
+        all_success = True
+        updates = []
+        for app_name, pipeline_name, pipeline_id in PipelineIndex.lookup(project_path):
+            if PipelineIndex.get_options_digest(pipeline_id) == expected_digest:
+                print_sync_result(app_name, pipeline_name, "skip", "options fingerprint not change")
+                continue
+            try:
+                pipeline = SpinnakerGateApi.get_pipeline(app_name, pipeline_name)
+            except Exception as ex:
+                print_sync_result(app_name, pipeline_name, "fail", str(ex))
+                all_success = False
+                continue
+            status, message, options_digest, old_options = update_pipeline_param_of_git(pipeline)
+            if status == "success":
+                updates.append((app_name, pipeline, options_digest, old_options,
+                                PipelineUpdateQueue.submit(pipeline)))
+                continue
+            print_sync_result(app_name, pipeline_name, status, message)
+            if status == "skip" and options_digest:
+                PipelineIndex.set_options_digest(pipeline_id, options_digest)
+            elif status == "fail":
+                all_success = False
+        for app_name, pipeline, options_digest, old_options, future in updates:
+            try:
+                future.result()
+                PipelineIndex.set_options_digest(pipeline.get("id"), options_digest)
+                print_sync_result(app_name, pipeline["name"], "success", "", old_options,
+                                  pipeline_options(pipeline))
+            except Exception as ex:
+                print_sync_result(app_name, pipeline["name"], "fail", str(ex))
+                all_success = False
+        if all_success:
+            PipelineIndex.mark_synced(project_path, refs)
+    except Exception as ex:
+        print(ex)
+
+
+def pipeline_options(pipeline):
+    for param in pipeline.get("parameterConfig") or []:
+        if param.get("name") == SpinnakerGateApi.param_of_branch_or_tag:
+            return param.get("options")
+    return None
+
+
+def sync_all_pipelines():
+    """
+    并发同步索引中的所有项目：需要时先刷新pipeline索引，然后每个项目（GitLab查询、pipeline获取和更新）并发执行，
+    对GitLab和Spinnaker Gate的并发请求数分别受 GitLabApi.semaphore 和 SpinnakerGateApi.semaphore 限制
+    :return:
+    """
+    start = time.time()
+    status = "fail"
+    try:
+        SpinnakerGateApi.login()
+        GitLabApi.login()
+        GitRefCache.new_cycle()
+        with ThreadPoolExecutor(max_workers=int(os.getenv(Constant.ENV_SYNC_THREADS, 16))) as executor:
+            if PipelineIndex.need_refresh():
+                refresh_pipeline_index(executor)
+            projects = PipelineIndex.projects()
+            for future in [executor.submit(sync_project, project) for project in projects]:
+                future.result()
+        PipelineIndex.save()
+        status = "success"
+    finally:
+        second = time.time() - start
+        Metrics.observe("cycle_seconds", second, status=status)
+        Metrics.set("last_cycle_seconds", second)
+        Metrics.set("last_cycle_timestamp_seconds", time.time())
+    Metrics.set("projects", len(projects))
+    Metrics.set("git_ref_cache_requests", GitRefCache.hits, result="hit")
+    Metrics.set("git_ref_cache_requests", GitRefCache.unchanged, result="unchanged")
+    Metrics.set("git_ref_cache_requests", GitRefCache.misses, result="miss")
+    print("|-- projects: {count}, {stats}, use seconds: {second}s".format(
+        count=len(projects), stats=GitRefCache.stats(), second=math.floor(second)))
+
+
+def sync_project_pipelines(project_path):
+    """
+    只同步引用了指定项目的pipeline（收到 GitLab push/tag 事件时调用）
+    :param project_path: 项目路径，比如 group/project
+    :return:
+    """
+    try:
+        SpinnakerGateApi.login()
+        GitLabApi.login()
+        GitRefCache.invalidate(project_path)
+        print("|-- gitlab event: {project}, pipelines: {count}".format(
+            project=project_path, count=len(PipelineIndex.lookup(project_path))))
+        sync_project(project_path)
+        PipelineIndex.save()
+    except Exception as ex:
+        print(ex)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    接收 GitLab 的 push 和 tag push webhook 事件，在后台同步引用了该项目的pipeline
+    """
+    executor = None
+    events = ("Push Hook", "Tag Push Hook")
+
+    def do_POST(self):
+        secret_token = os.getenv(Constant.ENV_WEBHOOK_SECRET_TOKEN, "")
+        if secret_token and self.headers.get("X-Gitlab-Token") != secret_token:
+            self.send_response(403)
+            self.end_headers()
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            event = json.loads(body.decode("utf-8"))
+            project_path = event["project"]["path_with_namespace"]
+        except Exception:
+            self.send_response(400)
+            self.end_headers()
+            return
+        if self.headers.get("X-Gitlab-Event") in WebhookHandler.events:
+            WebhookHandler.executor.submit(sync_project_pipelines, project_path)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    输出 Prometheus 指标：GET /metrics
+    """
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = Metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, handler):
+    """
+    在后台线程中启动 http 服务
+    :param port: 监听端口
+    :param handler:
+    :return:
+    """
+    server = ThreadingHTTPServer(("", port), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def start_webhook_server(port):
+    """
+    在后台线程中启动 webhook 服务
+    :param port: 监听端口
+    :return:
+    """
+    WebhookHandler.executor = ThreadPoolExecutor(max_workers=int(os.getenv(Constant.ENV_SYNC_THREADS, 16)))
+    start_http_server(port, WebhookHandler)
+    print("|-- webhook server listen on port: {port}".format(port=port))
+
+
+def start_metrics_server(port):
+    start_http_server(port, MetricsHandler)
+    print("|-- metrics server listen on port: {port}, path: /metrics".format(port=port))
 
 
 if __name__ == "__main__":
+    PipelineIndex.load()
+    metrics_port = int(os.getenv(Constant.ENV_METRICS_PORT, 0))
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    webhook_port = int(os.getenv(Constant.ENV_WEBHOOK_PORT, 0))
+    if webhook_port:
+        # webhook 模式下由事件触发同步，全量同步只作为低频的兜底对账
+        start_webhook_server(webhook_port)
     while True:
         print("=================  sync pipeline parameter start, time: {time} ================= ".format(
             time=time.strftime('%Y-%m-%d %H:%M:%S')))
         try:
-            SpinnakerGateApi.login()
-            GitLabApi.login()
-            apps = SpinnakerGateApi.get_created_applications()
-            print("|-- applications: {0}".format(json.dumps(apps)))
-            for app in apps:
-                try:
-                    app_name = app["name"]
-                    pipelines = SpinnakerGateApi.get_pipelines(app_name)
-                    for pipeline in pipelines:
-                        pipeline_name = pipeline["name"]
-                        old = copy.deepcopy(pipeline)
-                        sync_status, sync_message = update_pipeline_param_of_git(pipeline)
-                        old_json = json.dumps(old) if not sync_status == "skip" else ""
-                        new_json = json.dumps(pipeline) if sync_status == "success" else ""
-                        print("|---- {app_name}/{pipe_name}/update {status} | {message} | old: {old} | new: {new}"
-                              .format(app_name=app_name, pipe_name=pipeline_name, status=sync_status,
-                                      message=sync_message, old=old_json, new=new_json))
-                except Exception as ex1:
-                    print(ex1)
+            sync_all_pipelines()
         except Exception as ex2:
             print(ex2)
         print("===========================  sync pipeline parameter over ===========================")
-        sleep_time = int(os.getenv(Constant.ENV_TASK_PERIOD_SECOND, 600))
+        if webhook_port:
+            sleep_time = int(os.getenv(Constant.ENV_RECONCILE_PERIOD_SECOND, 3600))
+        else:
+            sleep_time = int(os.getenv(Constant.ENV_TASK_PERIOD_SECOND, 600))
         time.sleep(sleep_time)